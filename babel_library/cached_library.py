@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+
+
+class CachedLibrary:
+    """Keeps the most recently read values of a library in memory, up to
+    `max_bytes`. Writes and deletes go through to the library and update the
+    cache (appends remove the value from it), so the cached values are always
+    the stored ones.
+    The librarian never runs two requests on the same key at once, so the
+    lock only protects the cache structure."""
+
+    def __init__(self, library, max_bytes:int):
+        self.library = library
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def handle_read(self, request):
+        key = (str(request.client), str(request.stream))
+        with self.lock:
+            value = self.values.get(key)
+            if value is not None:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = self.library.handle_read(request)
+        with self.lock:
+            self.put(key, value)
+        return value
+
+    def handle_uncached_read(self, request):
+        """Reads the value from the library without caching it"""
+        return self.library.handle_read(request)
+
+    def handle_read_range(self, request):
+        # ranges are used to scan large values, which are not worth caching
+        return self.library.handle_read_range(request)
+
+    def handle_write(self, request):
+        self.library.handle_write(request)
+
+        key = (str(request.client), str(request.stream))
+        with self.lock:
+            if request.replace:
+                self.put(key, request.payload)
+            else:
+                # concatenating would copy the whole value on every append, so
+                # it's read again from the library instead
+                self.remove(key)
+
+    def handle_lock(self, request):
+        self.invalidate(request)
+        self.library.handle_lock(request)
+
+    def handle_unlock(self, request):
+        self.invalidate(request)
+        self.library.handle_unlock(request)
+
+    def handle_delete(self, request):
+        self.invalidate(request)
+        self.library.handle_delete(request)
+
+    def list_files(self):
+        return self.library.list_files()
+
+    def key_digests(self):
+        return self.library.key_digests()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.values),
+                "bytes": self.size,
+            }
+
+    def invalidate(self, request):
+        with self.lock:
+            self.remove((str(request.client), str(request.stream)))
+
+    def put(self, key, value):
+        """Caches the value, evicting the least recently used ones to stay
+        within the budget. Must be called holding the lock."""
+        self.remove(key)
+        if len(value) > self.max_bytes:
+            return
+
+        self.values[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.values.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def remove(self, key):
+        value = self.values.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
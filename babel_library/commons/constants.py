@@ -6,5 +6,10 @@ UNLOCK_REQUEST = 5
 OK_STATUS = 200
 ERROR_STATUS = 500
 CLIENT_ERROR_STATUS = 400
+NOT_FOUND_STATUS = 404
 STORAGE_SERVICE = 5
-READY = 321
\ No newline at end of file
+READY = 321
+DIGEST_REQUEST = 6
+BULK_READ_REQUEST = 7
+STORAGE_EXCHANGE = 'storage'
+STORAGE_DIRECT_EXCHANGE = 'storage_direct'
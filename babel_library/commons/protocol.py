@@ -0,0 +1,64 @@
+"""
+Wire format of the storage requests and responses.
+The operation metadata (type, client, stream, etc.) travels in the AMQP headers
+and the value is sent as the raw message body, so the librarians can store it as
+is. Messages without the binary content type are JSON documents sent by older
+clients, which are still accepted (see `decode_request`).
+"""
+import json
+import babel_library.commons.constants as constants
+
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+# name of the request field sent as the message body
+PAYLOAD = 'payload'
+
+
+def encode_request(req:dict):
+    """Returns the headers and body of the message for the request `req`."""
+    headers = { key: value for key, value in req.items() if key != PAYLOAD and value is not None }
+    return headers, _to_bytes(req.get(PAYLOAD))
+
+
+def decode_request(properties, body:bytes) -> dict:
+    """Returns the request sent in a message."""
+    if properties.content_type != BINARY_CONTENT_TYPE:
+        # JSON requests carry the payload as a string
+        req = json.loads(body)
+        if isinstance(req.get(PAYLOAD), str):
+            req[PAYLOAD] = req[PAYLOAD].encode('utf-8')
+        return req
+
+    req = dict(properties.headers or {})
+    req[PAYLOAD] = body
+    return req
+
+
+def encode_response(response:dict, binary:bool):
+    """Returns the content type and body of the message for the `response`.
+    If `binary` is false, a JSON response is built for the older clients."""
+    if binary:
+        return BINARY_CONTENT_TYPE, { "status": response["status"] }, _to_bytes(response.get("message"))
+
+    if isinstance(response.get("message"), bytes):
+        response = { **response, "message": response["message"].decode('utf-8', errors='replace') }
+    return None, None, json.dumps(response)
+
+
+def decode_response(properties, body:bytes) -> dict:
+    """Returns the response sent in a message."""
+    if properties.content_type != BINARY_CONTENT_TYPE:
+        try:
+            return json.loads(body)
+        except Exception as err:
+            return { "status": constants.ERROR_STATUS, "message": f"invalid response: {err}" }
+
+    return { "status": (properties.headers or {}).get("status"), "message": body }
+
+
+def _to_bytes(value) -> bytes:
+    if value is None:
+        return b''
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
@@ -1,16 +1,26 @@
 import os
+import queue
+import threading
+import zlib
+from functools import partial
 from babel_library.requests.delete import Delete
 from babel_library.requests.write import Write
 from babel_library.requests.read import Read
 from babel_library.requests.lock import Lock
 from babel_library.requests.unlock import Unlock
+from babel_library.requests.digest import Digest, client_digests
+from babel_library.requests.bulk_read import BulkRead, parse_values
 from babel_library.library import Library
+from babel_library.log_structured_library import LogStructuredLibrary
+from babel_library.cached_library import CachedLibrary
 from babel_library_client.borges import Borges
 from babel_library.commons.helpers import intTryParse, tryParse
-from services import killer
+from babel_library.commons import protocol
+from services import killer, liveness_agent
 import babel_library.commons.constants as constants
 import json
 import middleware
+import service_config
 import pika
 
 WORKER_ID = intTryParse(os.environ.get('WORKER_ID')) or 1
@@ -20,10 +30,14 @@ class Librarian:
     def __init__(self):
         self.read_counter = 0
         self.write_counter = 0
-        self.library = Library()
+        self.library = LogStructuredLibrary() if service_config.STORAGE_ENGINE == 'log' else Library()
+        if service_config.STORAGE_CACHE_BYTES:
+            self.library = CachedLibrary(self.library, service_config.STORAGE_CACHE_BYTES)
+            liveness_agent.register_status_provider('cache', self.library.stats)
         self.recover()
 
         self.init_rabbit()
+        self.init_workers()
         self.init_action_input_queue()
         self.channel.start_consuming()
         print(f"Librarian ready...")
@@ -31,26 +45,53 @@ class Librarian:
     def handle(self, ch, method, properties, body):
         """Saves/Reads the request to/from it's own storage,
          and dispatches the requests to the other librarians to get quorum"""
-        request = tryParse(body)
+        """The request is executed by the worker assigned to its key, so the requests
+        of the same stream are applied in order while the rest run concurrently"""
+        request = protocol.decode_request(properties, body)
         req = self.parse(request)
 
         killer.kill_if_applies("handling_read_request", read_counter=self.read_counter)
         killer.kill_if_applies("handling_write_request", write_counter=self.write_counter)
 
+        key = f'{req.client}/{req.stream}'.encode('utf-8')
+        worker = self.workers[zlib.crc32(key) % len(self.workers)]
+        worker.put((req, method, properties))
+
+    def work(self, requests):
+        """Executes the requests assigned to a worker thread. The connection is not
+        thread safe, so the response and ack are sent from the connection thread"""
+        while True:
+            req, method, properties = requests.get()
+
+            res = None
+            if req.source != WORKER_ID:
+                try:
+                    res = req.execute(self)
+                except Exception as err:
+                    # an error must not stop the thread, or the rest of its requests would never complete
+                    res = { "status": constants.ERROR_STATUS, "message": str(err) }
+
+            self.connection.add_callback_threadsafe(partial(self.complete, req, res, method, properties))
+
+    def complete(self, req, res, method, properties):
+        """Responds and acks a request once it was executed"""
         if req.source != WORKER_ID:
-            res = req.execute(self)
             self.respond(res, properties)
             self.channel.basic_ack(delivery_tag=method.delivery_tag)
 
         if req.source == WORKER_ID and req.type == constants.WRITE_REQUEST:
             self.channel.basic_ack(delivery_tag=method.delivery_tag)
-        
+
+
     def respond(self, response, props):
         """Return a response to the client that requested it through the queue provided in the request"""
+        """The response uses the same protocol (binary or JSON) as the request"""
+        binary = props.content_type == protocol.BINARY_CONTENT_TYPE
+        content_type, headers, body = protocol.encode_response(response, binary)
         self.channel.basic_publish(exchange='',
                      routing_key=props.reply_to,
-                     properties=pika.BasicProperties(correlation_id = props.correlation_id),
-                     body=json.dumps(response))
+                     properties=pika.BasicProperties(correlation_id = props.correlation_id, content_type=content_type, headers=headers),
+                     body=body)
 
     def parse(self, request):
         if request["type"] == constants.READ_REQUEST:
@@ -65,41 +106,87 @@ class Librarian:
             return Lock(request)
         elif request["type"] == constants.UNLOCK_REQUEST:
             return Unlock(request)
+        elif request["type"] == constants.DIGEST_REQUEST:
+            self.read_counter+=1
+            return Digest(request)
+        elif request["type"] == constants.BULK_READ_REQUEST:
+            self.read_counter+=1
+            return BulkRead(request)
 
     def recover(self):
-        """This method will create a request to retrieve the existing files on the system and sync with that"""
-        req = Read({
-            "metadata": True
-        })
-        client = Borges()
-        response = client.execute(req.to_dictionary()) # Recover the file tree
-        
+        """This method will compare the digests of the stored files with another storage node and only
+        retrieve the files that differ"""
+        """The digests of each client are compared first, so only the clients that differ are compared stream by stream"""
+        client = Borges(timeout=service_config.STORAGE_RECOVERY_TIMEOUT, exclude=WORKER_ID)
+        response = client.execute(Digest({}).to_dictionary())
+
         if response["status"] != constants.OK_STATUS:
             print("Storage node could not recover data")
             return
 
-        # Make a read request for each one
-        logs = tryParse(response["message"])
-        for log in logs:
-            print("Retrieving log: ", log)
-            req = Read({ "client": log["client"], "stream": log["stream"], "source": WORKER_ID })
-            res = client.execute(req.to_dictionary())
-            
-            req = Write({ "client": log["client"], "stream": log["stream"], "payload": res["message"].rstrip('\n'), "source": WORKER_ID, "replace": True })
-            req.execute(self)
+        remote = tryParse(response["message"])
+        digests = self.library.key_digests()
+        local = client_digests(digests)
+        for name, digest in remote.items():
+            if local.get(name) != digest:
+                self.recover_client(client, name, digests)
+
+        # the clients deleted while this node was down
+        for name in local:
+            if name not in remote:
+                self.recover_client(client, name, digests)
+
+    def recover_client(self, client, name, digests):
+        """Retrieves the streams of a client that differ from another storage node, in batches.
+        `digests` are the local digests of every stream (see `key_digests`)"""
+        response = client.execute(Digest({ "client": name }).to_dictionary())
+        if response["status"] != constants.OK_STATUS:
+            print(f"Storage node could not recover client {name}")
+            return
+
+        remote = tryParse(response["message"])
+        local = { stream: digest for (c, stream), digest in digests.items() if c == name }
+
+        for stream in local:
+            if stream not in remote:
+                Delete({ "client": name, "stream": stream }).execute(self)
+
+        streams = [stream for stream, digest in remote.items() if local.get(stream) != digest]
+        print(f"Retrieving {len(streams)} streams of client {name}")
+        for i in range(0, len(streams), service_config.STORAGE_RECOVERY_BATCH_SIZE):
+            batch = streams[i:i + service_config.STORAGE_RECOVERY_BATCH_SIZE]
+            res = client.execute(BulkRead({ "client": name, "payload": json.dumps(batch) }).to_dictionary())
+            if res["status"] != constants.OK_STATUS:
+                print(f"Storage node could not recover client {name}")
+                return
+
+            for stream, value in parse_values(batch, res["message"]).items():
+                req = Write({ "client": name, "stream": stream, "payload": value, "source": WORKER_ID, "replace": True })
+                req.execute(self)
 
     def init_rabbit(self):
         self.connection = middleware.connect(RABBITMQ_ADDRESS)
         self.channel = self.connection.channel()
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=service_config.LIBRARIAN_PREFETCH_COUNT)
+
+    def init_workers(self):
+        """Starts the threads that execute the requests. Each one has its own queue"""
+        self.workers = []
+        for _ in range(service_config.LIBRARIAN_WORKERS):
+            requests = queue.Queue()
+            threading.Thread(target=self.work, args=(requests,), daemon=True).start()
+            self.workers.append(requests)
 
     def init_action_input_queue(self):
         """This method will initialize the input request queue for this worker"""
         """AUTO_ACK is disabled, since the ack will be given after responding to the request"""
         """A single fanout exchange will be responsible for delivering the requests to each of the storage nodes"""
-        self.channel.exchange_declare(exchange='storage', exchange_type='fanout')
+        """Reads are sent to a single storage node through the direct exchange, using the node ID as routing key"""
+        self.channel.exchange_declare(exchange=constants.STORAGE_EXCHANGE, exchange_type='fanout')
+        self.channel.exchange_declare(exchange=constants.STORAGE_DIRECT_EXCHANGE, exchange_type='direct')
         result = self.channel.queue_declare(queue=f'storage_{WORKER_ID}')
         queue_name = result.method.queue
-        self.channel.queue_bind(exchange='storage', queue=queue_name)
+        self.channel.queue_bind(exchange=constants.STORAGE_EXCHANGE, queue=queue_name)
+        self.channel.queue_bind(exchange=constants.STORAGE_DIRECT_EXCHANGE, queue=queue_name, routing_key=str(WORKER_ID))
 
         self.channel.basic_consume(queue=queue_name, on_message_callback=self.handle, auto_ack=False)
\ No newline at end of file
@@ -4,33 +4,60 @@ import babel_library.commons.constants as constants
 from pathlib import Path
 from babel_library.commons.helpers import intTryParse
 import json
+import zlib
+import threading
 from datetime import datetime, date
 
 WORKER_ID = intTryParse(os.environ.get('WORKER_ID')) or 1
 
 class Library:
     def __init__(self):
-        pass
+        # crc32 of each file by (client, stream). They are kept in memory and
+        # updated with every write. The missing ones (e.g. after a restart) are
+        # computed when the digests are requested
+        self.digests = {}
+        # number of the last write of each file, to discard the digests computed
+        # while the file was written
+        self.versions = {}
+        self.writes = 0
+        self.digests_lock = threading.Lock()
 
     def handle_read(self, request):
-        with open(f'./data_{WORKER_ID}/{request.client}/{request.stream}', "r") as file:
+        with open(f'./data_{WORKER_ID}/{request.client}/{request.stream}', "rb") as file:
             payload = file.read()
 
         return payload
 
+    # there is no cache in the library, see `CachedLibrary`
+    handle_uncached_read = handle_read
+
+    def handle_read_range(self, request):
+        with open(f'./data_{WORKER_ID}/{request.client}/{request.stream}', "rb") as file:
+            file.seek(request.offset)
+            return file.read(request.length)
+
     def handle_write(self, request):
         try: 
             Path(f'./data_{WORKER_ID}/{request.client}').mkdir(parents=True, exist_ok=True)
         except Exception as error:
             raise Exception(str(error)) 
 
-        mode = 'a'
+        mode = 'ab'
         if request.replace:
-            mode = 'w'
+            mode = 'wb'
 
-        with open(f'./data_{WORKER_ID}/{request.client}/{request.stream}', mode) as file:
+        path = f'./data_{WORKER_ID}/{request.client}/{request.stream}'
+        with open(path, mode) as file:
+            # the position is the previous size of the file when appending
+            previous_size = file.tell()
             file.write(request.payload)
 
+        with self.digests_lock:
+            previous = 0 if request.replace or previous_size == 0 else self.digests.get((str(request.client), str(request.stream)))
+
+        # if the previous digest is unknown, it's computed when it's needed
+        self.update_digest(request.client, request.stream, None if previous is None else zlib.crc32(request.payload, previous))
+
     def handle_lock(self, request):
         path = f'./data_{WORKER_ID}/{request.client}/{request.stream}'
 
@@ -49,11 +76,13 @@ class Library:
 
         with open(f'./data_{WORKER_ID}/{request.client}/{request.stream}', 'w') as file:
             file.write(request.timeout)
+        self.update_digest(request.client, request.stream, zlib.crc32(request.timeout.encode('utf-8')))
 
     def handle_unlock(self, request):
         try:
             path = f'./data_{WORKER_ID}/{request.client}/{request.stream}'
             os.remove(path)
+            self.remove_digest(request.client, request.stream)
         except Exception as error:
             raise Exception(str(error))
 
@@ -62,6 +91,7 @@ class Library:
             path = f'./data_{WORKER_ID}/{request.client}/{request.stream}'
             if os.path.exists(path):
                 os.remove(path)
+            self.remove_digest(request.client, request.stream)
         except Exception as error:
             raise Exception(str(error))
 
@@ -75,4 +105,46 @@ class Library:
             for sd in stream_files:
                 responses.append({ "client": cd.name, "stream": sd.name })
 
-        return json.dumps(responses)
\ No newline at end of file
+        return json.dumps(responses)
+
+    def key_digests(self):
+        """Returns the crc32 of each stored file by (client, stream). Only the files
+        whose digest is not known yet are read"""
+        digests = {}
+        if not os.path.exists(f'./data_{WORKER_ID}/'):
+            return digests
+
+        for cd in os.scandir(f'./data_{WORKER_ID}/'):
+            for sd in os.scandir(f'./data_{WORKER_ID}/{cd.name}'):
+                key = (cd.name, sd.name)
+                with self.digests_lock:
+                    digest = self.digests.get(key)
+                    version = self.versions.get(key)
+
+                if digest is None:
+                    with open(sd.path, 'rb') as file:
+                        digest = zlib.crc32(file.read())
+                    with self.digests_lock:
+                        if self.versions.get(key) == version:
+                            self.digests[key] = digest
+                digests[key] = digest
+
+        return digests
+
+    def update_digest(self, client, stream, digest):
+        """Registers the crc32 of the file after a write. If it's None, it's
+        computed when it's needed"""
+        key = (str(client), str(stream))
+        with self.digests_lock:
+            self.writes += 1
+            self.versions[key] = self.writes
+            if digest is None:
+                self.digests.pop(key, None)
+            else:
+                self.digests[key] = digest
+
+    def remove_digest(self, client, stream):
+        key = (str(client), str(stream))
+        with self.digests_lock:
+            self.digests.pop(key, None)
+            self.versions.pop(key, None)
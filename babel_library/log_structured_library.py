@@ -0,0 +1,300 @@
+import os
+import json
+import zlib
+import struct
+import threading
+from datetime import datetime
+from babel_library.commons.helpers import intTryParse
+import service_config
+
+WORKER_ID = intTryParse(os.environ.get('WORKER_ID')) or 1
+
+# types of the records written to the segments
+PUT = 1
+APPEND = 2
+DELETE = 3
+
+# each record is: crc32 | type | client length | stream length | value length,
+# followed by the client, stream and value bytes. The crc32 covers everything
+# after itself, so a record torn by a crash is detected when rebuilding the index
+RECORD_HEADER = struct.Struct('>IBHHI')
+
+SEGMENT_SUFFIX = '.seg'
+
+
+class LogStructuredLibrary:
+    """Storage engine that appends every write to a segment file instead of
+    keeping a file per key.
+    The index maps each key (client, stream) to the list of extents
+    (segment, offset, length) that make up its value: a write replacing the value
+    resets the list and an append adds an extent, so appending never copies the
+    previous value. Deletes are written as tombstones. The crc32 of each value is
+    updated with every write, so digests never need to read the values.
+    Segments are named `{first}-{last}.seg` after the range of segments they
+    contain. The active segment is rolled once it reaches
+    `service_config.STORAGE_SEGMENT_BYTES` and, once there are
+    `service_config.STORAGE_COMPACTION_SEGMENTS` closed segments, a background
+    thread merges them keeping only the live values.
+    On startup the index is rebuilt replaying the segments in order."""
+
+    def __init__(self, path=None):
+        self.path = path or f'./log_{WORKER_ID}'
+        os.makedirs(self.path, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.index = {}
+        self.crcs = {}
+        self.read_fds = {}
+        self.closed = []
+
+        self.rebuild()
+        self.open_segment(self.next_segment_number())
+
+        self.compaction_needed = threading.Event()
+        if len(self.closed) >= service_config.STORAGE_COMPACTION_SEGMENTS:
+            self.compaction_needed.set()
+        threading.Thread(target=self.compact_forever, daemon=True).start()
+
+    def handle_read(self, request):
+        with self.lock:
+            extents = self.index.get(key_of(request))
+            if extents is None:
+                raise FileNotFoundError(f'{request.client}/{request.stream} does not exist')
+
+            return b''.join(os.pread(self.read_fds[segment], length, offset) for segment, offset, length in extents)
+
+    # there is no cache in the library, see `CachedLibrary`
+    handle_uncached_read = handle_read
+
+    def handle_read_range(self, request):
+        with self.lock:
+            extents = self.index.get(key_of(request))
+            if extents is None:
+                raise FileNotFoundError(f'{request.client}/{request.stream} does not exist')
+
+            # skips the extents before the range and reads the ones it overlaps
+            chunks, skip, remaining = [], request.offset, request.length
+            for segment, offset, length in extents:
+                if remaining <= 0:
+                    break
+                if skip >= length:
+                    skip -= length
+                    continue
+
+                size = min(length - skip, remaining)
+                chunks.append(os.pread(self.read_fds[segment], size, offset + skip))
+                skip, remaining = 0, remaining - size
+
+            return b''.join(chunks)
+
+    def handle_write(self, request):
+        with self.lock:
+            self.write(PUT if request.replace else APPEND, request.client, request.stream, request.payload)
+
+    def handle_lock(self, request):
+        with self.lock:
+            key = key_of(request)
+            if key in self.index:
+                content = b''.join(os.pread(self.read_fds[segment], length, offset) for segment, offset, length in self.index[key])
+                expiry = datetime.fromisoformat(content.decode('utf-8'))
+                if datetime.utcnow() < expiry:
+                    raise Exception("Lock already aquired")
+
+            self.write(PUT, request.client, request.stream, request.timeout.encode('utf-8'))
+
+    def handle_unlock(self, request):
+        with self.lock:
+            if key_of(request) not in self.index:
+                raise Exception(f'{request.client}/{request.stream} is not locked')
+
+            self.write(DELETE, request.client, request.stream, b'')
+
+    def handle_delete(self, request):
+        with self.lock:
+            if key_of(request) in self.index:
+                self.write(DELETE, request.client, request.stream, b'')
+
+    def list_files(self):
+        with self.lock:
+            keys = list(self.index)
+
+        return json.dumps([{ "client": client, "stream": stream } for client, stream in keys])
+
+    def key_digests(self):
+        with self.lock:
+            return dict(self.crcs)
+
+    def write(self, type, client, stream, value):
+        """Appends a record to the active segment and updates the index. Must be
+        called holding the lock."""
+        client, stream = str(client), str(stream)
+        record = encode_record(type, client, stream, value)
+        offset = self.active_size
+        os.write(self.active_fd, record)
+        self.active_size += len(record)
+
+        self.apply(type, (client, stream), (self.active, offset + len(record) - len(value), len(value)), value)
+
+        if self.active_size >= service_config.STORAGE_SEGMENT_BYTES:
+            self.roll()
+
+    def apply(self, type, key, extent, value):
+        if type == PUT:
+            self.index[key] = [extent]
+            self.crcs[key] = zlib.crc32(value)
+        elif type == APPEND:
+            self.index.setdefault(key, []).append(extent)
+            self.crcs[key] = zlib.crc32(value, self.crcs.get(key, 0))
+        else:
+            self.index.pop(key, None)
+            self.crcs.pop(key, None)
+
+    def roll(self):
+        """Closes the active segment and opens a new one."""
+        os.close(self.active_fd)
+        self.closed.append(self.active)
+        self.open_segment(self.next_segment_number())
+
+        if len(self.closed) >= service_config.STORAGE_COMPACTION_SEGMENTS:
+            self.compaction_needed.set()
+
+    def open_segment(self, number):
+        self.active = segment_name(number, number)
+        path = os.path.join(self.path, self.active)
+        self.active_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.active_size = os.fstat(self.active_fd).st_size
+        self.read_fds[self.active] = os.open(path, os.O_RDONLY)
+
+    def next_segment_number(self):
+        segments = self.closed + ([self.active] if hasattr(self, 'active') else [])
+        return max((segment_range(name)[1] for name in segments), default=0) + 1
+
+    def rebuild(self):
+        """Rebuilds the index replaying the segments in order. Segments whose
+        range is contained in another one were already compacted, but the
+        library stopped before removing them. A torn record at the end of a
+        segment is truncated."""
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.path, name))
+
+        segments = [name for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX)]
+        ranges = { name: segment_range(name) for name in segments }
+        for name, (first, last) in ranges.items():
+            if any(other != name and o_first <= first and last <= o_last for other, (o_first, o_last) in ranges.items()):
+                os.remove(os.path.join(self.path, name))
+                segments.remove(name)
+
+        for name in sorted(segments, key=lambda name: ranges[name]):
+            path = os.path.join(self.path, name)
+            with open(path, 'rb') as file:
+                data = file.read()
+
+            offset = 0
+            for type, client, stream, value_offset, value_length in decode_records(data):
+                self.apply(type, (client, stream), (name, value_offset, value_length), data[value_offset:value_offset + value_length])
+                offset = value_offset + value_length
+
+            if offset < len(data):
+                print(f'Truncating torn record in segment {name} at offset {offset}')
+                os.truncate(path, offset)
+
+            self.read_fds[name] = os.open(path, os.O_RDONLY)
+            self.closed.append(name)
+
+    def compact_forever(self):
+        while True:
+            self.compaction_needed.wait()
+            self.compaction_needed.clear()
+            self.compact()
+
+    def compact(self):
+        """Merges the closed segments into a single one with the live values.
+        Since the closed segments are always the oldest ones, tombstones and
+        overwritten values can be dropped."""
+        with self.lock:
+            segments = list(self.closed)
+            compacted = set(segments)
+            # the extents of each key stored in the compacted segments. They are
+            # always a prefix of the extents of the key
+            prefixes = {}
+            for key, extents in self.index.items():
+                prefix = []
+                for extent in extents:
+                    if extent[0] not in compacted:
+                        break
+                    prefix.append(extent)
+                if prefix:
+                    prefixes[key] = prefix
+
+        if len(segments) < 2:
+            return
+
+        first, last = segment_range(segments[0])[0], segment_range(segments[-1])[1]
+        name = segment_name(first, last)
+        path = os.path.join(self.path, name)
+
+        # the closed segments are immutable, so they can be read without the lock
+        locations, offset = {}, 0
+        with open(path + '.tmp', 'wb') as file:
+            for (client, stream), prefix in prefixes.items():
+                value = b''.join(os.pread(self.read_fds[segment], length, extent_offset) for segment, extent_offset, length in prefix)
+                record = encode_record(PUT, client, stream, value)
+                file.write(record)
+                offset += len(record)
+                locations[(client, stream)] = (name, offset - len(value), len(value))
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.rename(path + '.tmp', path)
+
+        with self.lock:
+            for key, prefix in prefixes.items():
+                extents = self.index.get(key)
+                # skip the keys replaced or deleted during the compaction
+                if extents is not None and extents[:len(prefix)] == prefix:
+                    self.index[key] = [locations[key]] + extents[len(prefix):]
+
+            self.read_fds[name] = os.open(path, os.O_RDONLY)
+            self.closed = [name] + self.closed[len(segments):]
+            for segment in segments:
+                if segment != name:
+                    os.close(self.read_fds.pop(segment))
+                    os.remove(os.path.join(self.path, segment))
+
+
+def key_of(request):
+    return str(request.client), str(request.stream)
+
+
+def segment_name(first:int, last:int) -> str:
+    return f'{first:08d}-{last:08d}{SEGMENT_SUFFIX}'
+
+
+def segment_range(name:str):
+    first, last = name[:-len(SEGMENT_SUFFIX)].split('-')
+    return int(first), int(last)
+
+
+def encode_record(type:int, client:str, stream:str, value:bytes) -> bytes:
+    client, stream = client.encode('utf-8'), stream.encode('utf-8')
+    body = RECORD_HEADER.pack(0, type, len(client), len(stream), len(value))[4:] + client + stream + value
+    return struct.pack('>I', zlib.crc32(body)) + body
+
+
+def decode_records(data:bytes):
+    """Yields the records of a segment as (type, client, stream, value offset,
+    value length). Stops at the first incomplete or corrupted record."""
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        crc, type, client_length, stream_length, value_length = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + client_length + stream_length + value_length
+        if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+            return
+
+        client_offset = offset + RECORD_HEADER.size
+        stream_offset = client_offset + client_length
+        client = data[client_offset:stream_offset].decode('utf-8')
+        stream = data[stream_offset:stream_offset + stream_length].decode('utf-8')
+        yield type, client, stream, stream_offset + stream_length, value_length
+        offset = end
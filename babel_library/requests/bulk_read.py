@@ -0,0 +1,51 @@
+import json
+import struct
+import babel_library.commons.constants as constants
+from babel_library.requests.read import Read
+
+# each value of the response is prefixed by its length. Missing streams are
+# sent with the MISSING length and no value
+VALUE_LEN = struct.Struct('>I')
+MISSING = 0xFFFFFFFF
+
+class BulkRead():
+    def __init__(self, req):
+        self.type = constants.BULK_READ_REQUEST
+        self.client = req["client"]
+        self.stream = None
+        self.streams = json.loads(req["payload"])
+        self.source = req.get("source")
+
+    def execute(self, librarian):
+        """Reads several streams of the same client with a single request. The
+        streams are not read by the threads assigned to them, so the values are
+        not cached (the cache relies on each stream being handled by a single thread)"""
+        values = []
+        for stream in self.streams:
+            try:
+                value = librarian.library.handle_uncached_read(Read({ "client": self.client, "stream": stream }))
+                values.append(VALUE_LEN.pack(len(value)) + value)
+            except Exception:
+                values.append(VALUE_LEN.pack(MISSING))
+
+        return { "status": constants.OK_STATUS, "message": b''.join(values) }
+
+    def to_dictionary(self):
+        return {
+            "type": self.type,
+            "client": self.client,
+            "payload": json.dumps(self.streams)
+        }
+
+
+def parse_values(streams, message:bytes):
+    """Returns the values of a bulk read response by stream"""
+    values, offset = {}, 0
+    for stream in streams:
+        length, = VALUE_LEN.unpack_from(message, offset)
+        offset += VALUE_LEN.size
+        if length != MISSING:
+            values[stream] = message[offset:offset + length]
+            offset += length
+
+    return values
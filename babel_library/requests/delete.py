@@ -5,6 +5,7 @@ class Delete():
         self.type = constants.DELETE_REQUEST
         self.client = req["client"]
         self.stream = req["stream"]
+        self.source = req.get("source")
 
     def handle_internal(self, library):
         library.handle_delete(self)
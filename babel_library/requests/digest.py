@@ -0,0 +1,38 @@
+import json
+import zlib
+import babel_library.commons.constants as constants
+
+class Digest():
+    def __init__(self, req):
+        self.type = constants.DIGEST_REQUEST
+        self.client = req.get("client")
+        self.stream = None
+        self.source = req.get("source")
+
+    def execute(self, librarian):
+        """Without a client, returns a digest of each client directory. Otherwise,
+        returns the digest of each stream of the client"""
+        try:
+            digests = librarian.library.key_digests()
+            if self.client is None:
+                message = client_digests(digests)
+            else:
+                message = { stream: digest for (client, stream), digest in digests.items() if client == str(self.client) }
+            return { "status": constants.OK_STATUS, "message": json.dumps(message) }
+        except Exception as err:
+            return { "status": constants.ERROR_STATUS, "message": str(err) }
+
+    def to_dictionary(self):
+        return {
+            "type": self.type,
+            "client": self.client
+        }
+
+
+def client_digests(digests):
+    """Combines the digests of the streams of each client in a single one"""
+    streams = {}
+    for (client, stream), digest in digests.items():
+        streams.setdefault(client, []).append(f'{stream}:{digest}')
+
+    return { client: zlib.crc32('\n'.join(sorted(entries)).encode('utf-8')) for client, entries in streams.items() }
@@ -8,14 +8,21 @@ class Read():
         self.stream = req.get("stream")
         self.metadata = req.get("metadata")
         self.source = req.get("source")
+        # if given, only `length` bytes of the value are read from `offset`
+        self.offset = req.get("offset")
+        self.length = req.get("length")
 
     def execute(self, librarian):
         #print(f'Executing read: client:{self.client} stream: {self.stream}')
         try:
             if self.metadata:
                 return { "status": constants.OK_STATUS, "message": librarian.library.list_files() }
+            elif self.offset is not None:
+                return { "status": constants.OK_STATUS, "message": librarian.library.handle_read_range(self) }
             else:
                 return { "status": constants.OK_STATUS, "message": librarian.library.handle_read(self) }
+        except FileNotFoundError as err:
+            return { "status": constants.NOT_FOUND_STATUS, "message": str(err) }
         except Exception as err:
             return { "status": constants.ERROR_STATUS, "message": str(err) }
 
@@ -24,5 +31,7 @@ class Read():
             "type": self.type,
             "client": self.client,
             "stream": self.stream,
-            "metadata": self.metadata
+            "metadata": self.metadata,
+            "offset": self.offset,
+            "length": self.length
         }
\ No newline at end of file
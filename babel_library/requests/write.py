@@ -6,6 +6,9 @@ class Write():
         self.client = req["client"]
         self.stream = req["stream"]
         self.payload = req["payload"]
+        if isinstance(self.payload, str):
+            # JSON requests send the payload as text, but it's stored as bytes
+            self.payload = self.payload.encode('utf-8')
         self.replace = req["replace"]
         self.source = req.get("source")
 
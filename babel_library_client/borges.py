@@ -3,13 +3,20 @@ import datetime
 import pika
 import os
 import json
+import random
+from collections import Counter, deque
 from babel_library.commons.helpers import tryParse, get_correlation_id
+from babel_library.commons import protocol
 import babel_library.commons.constants as constants
+import service_config
 import logging
 import datetime
 
 RABBITMQ_ADDRESS = os.environ.get('RABBITMQ_ADDRESS') or 'localhost'
 
+# requests that don't modify the storage, so they are sent to a single librarian
+READ_REQUESTS = (constants.READ_REQUEST, constants.DIGEST_REQUEST, constants.BULK_READ_REQUEST)
+
 def connect(address:str, retries:int = 25):
     """Connects to a RabbitMQ instance in the given address with the defined
     number of retries."""
@@ -30,10 +37,125 @@ def connect(address:str, retries:int = 25):
     finally:
         logging.getLogger("pika").propagate = True
 
+class StorageFuture:
+    """Pending response of a request sent to the storage. The response is
+    received while the client processes the connection events, so calling
+    `result` drives the client until the response arrives or the request
+    times out.
+    The request is done once `quorum` librarians answered. Reads are done
+    once `quorum` librarians returned the same response: if they disagree, the
+    request is sent to another of the `replicas` and the response of the
+    majority is returned. Reads may also be hedged: if there is no response by
+    `hedge_at`, the request is sent to another librarian."""
+
+    def __init__(self, client, corr_id, deadline, quorum=1, parse=None, req=None, hedge_at=None, replicas=None):
+        self.client = client
+        self.corr_id = corr_id
+        self.deadline = deadline
+        self.quorum = quorum
+        self.parse = parse
+        self.req = req
+        self.hedge_at = hedge_at
+        # librarians a read can be sent to. The first `asked` were already asked
+        self.replicas = replicas or []
+        self.asked = min(quorum, len(self.replicas))
+        self.start = time.monotonic()
+        self.responses = []
+        self.response = None
+
+    def done(self):
+        return self.response is not None
+
+    def add_response(self, response):
+        """Registers the response of a librarian. Returns whether the quorum
+        was reached."""
+        if self.replicas:
+            return self.add_read_response(response)
+
+        self.responses.append(response)
+        if len(self.responses) < self.quorum:
+            return False
+
+        ok = [res for res in self.responses if res.get("status") == constants.OK_STATUS]
+        if len(ok) < len(self.responses):
+            # any failure (e.g. a lock held in one of the replicas) fails the request
+            self.set_response(next(res for res in self.responses if res not in ok))
+        else:
+            # the replicas should agree, but if they don't we return the
+            # value returned by most of them
+            messages = Counter(res.get("message") for res in ok)
+            most_common = messages.most_common(1)[0][0]
+            self.set_response(next(res for res in ok if res.get("message") == most_common))
+        return True
+
+    def add_read_response(self, response):
+        self.responses.append(response)
+        votes = Counter(_vote(res) for res in self.responses)
+        vote, count = votes.most_common(1)[0]
+        if count < self.quorum and len(self.responses) < self.asked:
+            return False
+
+        if count < self.quorum and self.ask_next():
+            # the librarians disagree (e.g. one of them missed a write), so
+            # the next one breaks the tie
+            return False
+
+        # once every librarian was asked we return the response of most of them
+        self.set_response(next(res for res in self.responses if _vote(res) == vote))
+        return True
+
+    def ask_next(self):
+        """Sends the read to a librarian that was not asked yet. Returns
+        whether there was one."""
+        if self.asked >= len(self.replicas):
+            return False
+
+        self.client.publish_to(self.replicas[self.asked], self.req, self.corr_id)
+        self.asked += 1
+        return True
+
+    def set_response(self, response):
+        self.response = response
+
+    def next_event(self):
+        """Returns the time when the client has to act on the request."""
+        if self.hedge_at is not None:
+            return min(self.deadline, self.hedge_at)
+        return self.deadline
+
+    def result(self):
+        self.client.wait([self])
+        if self.parse:
+            return self.parse(self.response)
+        return self.response
+
+
 class Borges:
-    def __init__(self, timeout=3):
+    """Client of the storage service.
+    Writes, deletes and locks are sent to every librarian through the fanout
+    exchange and return once `service_config.STORAGE_WRITE_QUORUM` of them
+    answered. Reads are sent to `service_config.STORAGE_READ_QUORUM` preferred
+    librarians through the direct exchange, and to the next one if they
+    disagree, so each read is executed by R of the N librarians instead of all
+    of them. If a read takes longer than the `STORAGE_HEDGE_PERCENTILE` of the
+    recent read latencies, it's also sent to the next librarian.
+    Requests from the same client are queued in each librarian in order, so
+    reads always see the writes made before by the same client.
+    `exclude` is the ID of a librarian that must not be read from (used by the
+    librarians to recover from the rest of the cluster)."""
+
+    def __init__(self, timeout=3, exclude=None):
         self.timeout = timeout
-        self.responses = {}
+        # requests waiting for a response by correlation ID
+        self.pending = {}
+
+        # each client prefers a different librarian to spread the reads
+        replicas = [lib["id"] for lib in service_config.LIBRARIANS if lib["id"] != exclude]
+        offset = random.randrange(len(replicas))
+        self.replicas = replicas[offset:] + replicas[:offset]
+        self.read_quorum = min(service_config.STORAGE_READ_QUORUM, len(self.replicas))
+        self.write_quorum = min(service_config.STORAGE_WRITE_QUORUM, len(service_config.LIBRARIANS))
+        self.read_latencies = deque(maxlen=200)
         self.init_rabbit()
         self.init_callback_queue()
         self.init_read_storage_queues()
@@ -62,28 +184,18 @@ class Borges:
         """This will initialize the exchange and queue that the client will use to send request to and receive responses
         from the storage server for the READ request"""
         self.channel.queue_declare(queue='reads_queue', durable=True)
+        self.channel.exchange_declare(exchange=constants.STORAGE_DIRECT_EXCHANGE, exchange_type='direct')
 
 
     def on_response(self, ch, method, props, body):
-        corr_id = props.correlation_id
+        # once the quorum is reached the rest of the responses are discarded
+        future = self.pending.get(props.correlation_id)
+        if future is not None and future.add_response(protocol.decode_response(props, body)):
+            del self.pending[props.correlation_id]
+            if future.req["type"] == constants.READ_REQUEST:
+                self.read_latencies.append(time.monotonic() - future.start)
 
-        res = tryParse(body)
-        res["timetolive"] = datetime.datetime.utcnow() + datetime.timedelta(seconds=5) # The entry will clear itself after this time
-        self.responses[corr_id] = res
-
-        self.clear_responses()
-
-    def clear_responses(self):
-        toremove = []
-        currenttime = datetime.datetime.utcnow()
-        for key, value in self.responses.items():
-            if value["timetolive"] < currenttime:
-                toremove.append(key)
-
-        for key in toremove:
-            del self.responses[key]
-
-    def save(self, client, stream, payload):
+    def save(self, client, stream, payload, wait=True, parse=None):
         req = {
             "type": constants.WRITE_REQUEST,
             "client": client,
@@ -91,9 +203,19 @@ class Borges:
             "payload": payload,
             "replace": True
         }
-        return self.execute(req)
+        return self.dispatch(req, wait, parse)
 
-    def try_lock(self, client, stream):
+    def append(self, client, stream, payload, wait=True, parse=None):
+        req = {
+            "type": constants.WRITE_REQUEST,
+            "client": client,
+            "stream": stream,
+            "payload": payload,
+            "replace": False
+        }
+        return self.dispatch(req, wait, parse)
+
+    def try_lock(self, client, stream, wait=True, parse=None):
         timeout = (datetime.datetime.utcnow() + datetime.timedelta(seconds=5)).isoformat()
         req = {
             "type": constants.LOCK_REQUEST,
@@ -101,50 +223,125 @@ class Borges:
             "stream": stream,
             "timeout": timeout
         }
-        return self.execute(req)
+        return self.dispatch(req, wait, parse)
 
-    def unlock(self, client, stream):
+    def unlock(self, client, stream, wait=True, parse=None):
         req = {
             "type": constants.UNLOCK_REQUEST,
             "client": client,
             "stream": stream
         }
-        return self.execute(req)
+        return self.dispatch(req, wait, parse)
 
-    def read(self, client, stream):
+    def read(self, client, stream, wait=True, parse=None, offset=None, length=None):
+        """Reads the value of the stream. If `offset` is given, only reads up
+        to `length` bytes starting from it."""
         req = {
             "type": constants.READ_REQUEST,
             "client": client,
-            "stream": stream
+            "stream": stream,
+            "offset": offset,
+            "length": length
         }
-        return self.execute(req)
+        return self.dispatch(req, wait, parse)
 
-    def delete(self, client, stream):
+    def delete(self, client, stream, wait=True, parse=None):
         req = {
             "type": constants.DELETE_REQUEST,
             "client": client,
             "stream": stream,
         }
-        return self.execute(req)
+        return self.dispatch(req, wait, parse)
 
 
     def execute(self, req):
+        return self.submit(req).result()
+
+    def dispatch(self, req, wait, parse=None):
+        """Executes the request if `wait` is set. Otherwise, just submits it
+        and returns the `StorageFuture`."""
+        future = self.submit(req, parse)
+        if wait:
+            return future.result()
+        return future
+
+    def submit(self, req, parse=None):
+        """Sends the request without waiting for the response. Returns a
+        `StorageFuture` that can be waited with `result` or `gather`. If given,
+        `parse` is applied to the response when calling `result`."""
         corr_id = get_correlation_id()
+        deadline = time.monotonic() + self.timeout
+
+        if req["type"] in READ_REQUESTS:
+            for replica in self.replicas[:self.read_quorum]:
+                self.publish_to(replica, req, corr_id)
+
+            hedge_at = None
+            if len(self.replicas) > self.read_quorum:
+                hedge_at = time.monotonic() + self.hedge_delay()
+
+            future = StorageFuture(self, corr_id, deadline, self.read_quorum, parse, req, hedge_at, self.replicas)
+        else:
+            self.publish(constants.STORAGE_EXCHANGE, '', req, corr_id)
+            future = StorageFuture(self, corr_id, deadline, self.write_quorum, parse, req)
 
-        self.channel.basic_publish(exchange='storage', routing_key='', body=json.dumps(req),
-            properties=pika.BasicProperties(reply_to=self.callback_queue, correlation_id=corr_id)
+        self.pending[corr_id] = future
+        return future
+
+    def publish_to(self, replica, req, corr_id):
+        """Sends the request to a single librarian."""
+        self.publish(constants.STORAGE_DIRECT_EXCHANGE, str(replica), req, corr_id)
+
+    def publish(self, exchange, routing_key, req, corr_id):
+        """Sends the request with the binary protocol: the request fields go in
+        the headers and the payload is the body of the message."""
+        headers, body = protocol.encode_request(req)
+        self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+            properties=pika.BasicProperties(reply_to=self.callback_queue, correlation_id=corr_id,
+                content_type=protocol.BINARY_CONTENT_TYPE, headers=headers)
         )
 
-        return self.wait_for_response(corr_id)
-        
-    def wait_for_response(self, corr_id):
-        start = time.time()
-        while corr_id not in self.responses and time.time() - start < self.timeout:
-            self.connection.process_data_events()
-
-        if corr_id not in self.responses:
-            return { "status": constants.ERROR_STATUS, "message": "Storage did not respond, please try again" }
-            
-        response = self.responses[corr_id]
-        del self.responses[corr_id]
-        return response
+    def hedge_delay(self):
+        """Time to wait for a read before sending it to another librarian."""
+        if len(self.read_latencies) < 20:
+            return service_config.STORAGE_HEDGE_MIN_DELAY
+
+        latencies = sorted(self.read_latencies)
+        index = int(service_config.STORAGE_HEDGE_PERCENTILE / 100 * (len(latencies) - 1))
+        return max(service_config.STORAGE_HEDGE_MIN_DELAY, latencies[index])
+
+    def gather(self, futures):
+        """Waits until all the `futures` are done or timed out and returns
+        their results in the same order."""
+        self.wait(futures)
+        return [future.result() for future in futures]
+
+    def wait(self, futures):
+        """Processes the connection events until all the `futures` are done or
+        timed out."""
+        waiting = [future for future in futures if not future.done()]
+        while waiting:
+            remaining = min(future.next_event() for future in waiting) - time.monotonic()
+            if remaining > 0:
+                # returns as soon as a response is dispatched or the time is up
+                self.connection.process_data_events(time_limit=remaining)
+
+            now = time.monotonic()
+            for future in waiting:
+                if future.done():
+                    continue
+
+                if future.deadline <= now:
+                    del self.pending[future.corr_id]
+                    future.set_response({ "status": constants.ERROR_STATUS, "message": "Storage did not respond, please try again" })
+                elif future.hedge_at is not None and future.hedge_at <= now:
+                    # the preferred librarians are slow, so we also ask the next one
+                    future.hedge_at = None
+                    future.ask_next()
+
+            waiting = [future for future in waiting if not future.done()]
+
+
+def _vote(response):
+    """Key used to compare the responses of the librarians to a read."""
+    return response.get("status"), response.get("message")
@@ -0,0 +1,95 @@
+"""
+Compares the rows per second parsed by the CSV parser stages with the previous
+parser, which built a dict for every row with `csv.DictReader`, copied the
+selected columns for each destination and converted the sharding key of each
+row. The chunks are synthetic CSVs with the columns of the StackOverflow
+dataset.
+
+Requires the dependencies of the pipeline:
+
+    python -m benchmarks.csv_parser
+"""
+
+import os
+import csv
+import time
+import random
+import string
+
+from io import StringIO
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'benchmark')
+
+from pipeline.input import CsvProjection, ANSWERS_EDGES, QUESTIONS_EDGES
+from serialization import RecordBatch
+
+
+LINES_PER_CHUNK = [1000, 10000]
+CHUNKS = 10
+SHARDS = 4
+
+ANSWERS_HEADER = ['Id', 'OwnerUserId', 'CreationDate', 'ParentId', 'Score', 'Body']
+QUESTIONS_HEADER = ['Id', 'OwnerUserId', 'CreationDate', 'ClosedDate', 'Score', 'Title', 'Body', 'Tags']
+
+
+def _text(min_length:int, max_length:int) -> str:
+    words = random.choices(['<p>', 'the', 'code', 'python', 'does', 'not', 'work', '"quoted"', 'a,b', '\n'], k=random.randint(min_length, max_length) // 5)
+    return ' '.join(words)
+
+
+def _answers(lines:int) -> bytes:
+    rows = [
+        [i, random.choice(['', random.randint(1, 10**6)]), '2010-01-01T00:00:00Z', random.randint(1, 10**6), random.randint(-5, 50), _text(200, 2000)]
+        for i in range(lines)
+    ]
+    return _serialize(ANSWERS_HEADER, rows)
+
+
+def _questions(lines:int) -> bytes:
+    rows = [
+        [i, random.randint(1, 10**6), '2010-01-01T00:00:00Z', '', random.randint(-5, 50), _text(20, 100), _text(200, 2000), ' '.join(random.choices(string.ascii_lowercase, k=3))]
+        for i in range(lines)
+    ]
+    return _serialize(QUESTIONS_HEADER, rows)
+
+
+def _serialize(header, rows) -> bytes:
+    sio = StringIO()
+    writer = csv.writer(sio)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return sio.getvalue().encode('utf-8')
+
+
+def run_dict_reader(chunks, edges, shard_column):
+    for body in chunks:
+        rows = list(csv.DictReader(StringIO(body.decode('utf-8'))))
+        for cols in edges.values():
+            selected = [{field: row[field] for field in cols} for row in rows]
+
+        shards = [list() for _ in range(SHARDS)]
+        for row in selected:
+            shards[int(row[shard_column]) % SHARDS].append(row)
+
+
+def run_projection(chunks, edges, shard_column):
+    parser = CsvProjection(edges=edges, shard_column=shard_column, shards=SHARDS)
+    for body in chunks:
+        shards = parser.parse(body)
+        rows = RecordBatch.concat(shards)
+        for cols in edges.values():
+            rows.select(cols)
+
+
+if __name__ == '__main__':
+    print(f'{"file":>10} {"lines":>7} {"parser":>12} {"rows/s":>10}')
+    files = [('answers', _answers, ANSWERS_EDGES, 'ParentId'), ('questions', _questions, QUESTIONS_EDGES, 'Id')]
+    for name, generate, edges, shard_column in files:
+        for lines in LINES_PER_CHUNK:
+            chunks = [generate(lines) for _ in range(CHUNKS)]
+            for parser, run in [('dict reader', run_dict_reader), ('projection', run_projection)]:
+                start = time.monotonic()
+                run(chunks, edges, shard_column)
+                elapsed = time.monotonic() - start
+                print(f'{name:>10} {lines:>7} {parser:>12} {lines * CHUNKS / elapsed:>10.0f}')
@@ -0,0 +1,137 @@
+"""
+Measures how the DONE messages reach the worker they are meant for in a stage
+whose replicas share the input queue. Each replica runs in its own process with
+the middleware code used by `consume_from`: it consumes its input and control
+queues with `_InputQueues` and forwards the DONE messages meant for another
+replica with `_forward_foreign_done`. The DONE messages are sent with
+`send_done`. For each number of replicas, it prints the deliveries, the
+forwarded and redelivered messages and the time until every DONE was received.
+
+Requires a running RabbitMQ instance:
+
+    RABBITMQ_ADDRESS=localhost python -m benchmarks.done_redeliveries
+"""
+
+import os
+import time
+import pika
+import multiprocessing
+
+from collections import Counter
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'benchmark')
+
+import middleware
+import service_config
+
+
+RABBITMQ_ADDRESS = os.environ.get('RABBITMQ_ADDRESS', 'localhost')
+
+REPLICAS = [2, 8, 32]
+
+# number of streams finished on each run (each one sends a DONE per replica)
+STREAMS = 20
+
+STAGE = 'bench_done'
+
+
+def _declare_queues(channel, replicas:int):
+    channel.exchange_declare(exchange=middleware.CONTROL_EXCHANGE, exchange_type='direct')
+    channel.queue_declare(queue=STAGE, durable=True)
+    channel.queue_purge(queue=STAGE)
+    for i in range(replicas):
+        control_queue = middleware._control_queue_name(worker=STAGE, worker_id=i)
+        channel.queue_declare(queue=control_queue, durable=True)
+        channel.queue_purge(queue=control_queue)
+        channel.queue_bind(exchange=middleware.CONTROL_EXCHANGE, queue=control_queue, routing_key=f'{STAGE}_{i}')
+
+
+def _delete_queues(channel, replicas:int):
+    channel.queue_delete(queue=STAGE)
+    for i in range(replicas):
+        channel.queue_delete(queue=middleware._control_queue_name(worker=STAGE, worker_id=i))
+
+
+def _replica(replicas:int, events:multiprocessing.Queue):
+    """Consumes the DONE messages as a replica of the stage. The ID of the
+    replica is the WORKER_ID of the process."""
+
+    service_config.WORKERS[STAGE] = replicas
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_ADDRESS))
+    channel = connection.channel()
+    channel.basic_qos(prefetch_count=service_config.DEFAULT_PREFETCH_COUNT)
+
+    inputs = middleware._InputQueues(channel=channel, queue_name=STAGE, control_queue=middleware._control_queue_name(worker=STAGE, worker_id=middleware.WORKER_ID))
+    events.put(('ready', False))
+
+    for method, properties, body, is_control in inputs.consume(on_idle=lambda: None):
+        m = middleware.DONE_RE.match(body.decode('utf-8'))
+        forwarded = middleware._forward_foreign_done(
+            channel=channel,
+            worker_name=STAGE,
+            method_frame=method,
+            m=m,
+            body=body,
+            correlation_id=properties.correlation_id,
+            is_control=is_control
+        )
+
+        if not forwarded:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+        events.put(('forwarded' if forwarded else 'received', method.redelivered))
+
+
+def run(replicas:int) -> Counter:
+    service_config.WORKERS[STAGE] = replicas
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_ADDRESS))
+    channel = connection.channel()
+    _declare_queues(channel, replicas)
+
+    # the replicas import the middleware with their own WORKER_ID
+    context = multiprocessing.get_context('spawn')
+    events = context.Queue()
+    processes = []
+    for i in range(replicas):
+        os.environ['WORKER_ID'] = str(i)
+        process = context.Process(target=_replica, args=(replicas, events), daemon=True)
+        process.start()
+        processes.append(process)
+
+    stats = Counter()
+    while stats['ready'] < replicas:
+        event, _ = events.get()
+        stats[event] += 1
+
+    start = time.monotonic()
+    for stream in range(STREAMS):
+        middleware.send_done(channel=channel, worker=STAGE, correlation_id=f'bench_{stream}')
+
+    while stats['received'] < STREAMS * replicas:
+        event, redelivered = events.get()
+        stats[event] += 1
+        stats['deliveries'] += 1
+        stats['redeliveries'] += redelivered
+
+    stats['elapsed_ms'] = int((time.monotonic() - start) * 1000)
+
+    for process in processes:
+        process.terminate()
+        process.join()
+
+    _delete_queues(channel, replicas)
+    middleware.PUBLISHERS.pop(connection, None)
+    connection.close()
+    return stats
+
+
+if __name__ == '__main__':
+    print(f'{"replicas":>8} {"DONEs":>6} {"deliveries":>10} {"redelivered":>11} {"forwards":>8} {"ms":>7}')
+    for replicas in REPLICAS:
+        stats = run(replicas=replicas)
+        print(
+            f'{replicas:>8} {STREAMS * replicas:>6} {stats["deliveries"]:>10} '
+            f'{stats["redeliveries"]:>11} {stats["forwarded"]:>8} {stats["elapsed_ms"]:>7}'
+        )
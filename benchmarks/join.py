@@ -0,0 +1,101 @@
+"""
+Compares the rows per second joined by the `join` stage (see
+`pipeline.join.JoinStore`) with the previous approach, which went through every
+answer waiting for its question on each batch received. The rows arrive in
+batches with every answer before its question (the worst case) and in random
+order. The store is also measured with a small memory budget, so most of its
+state is moved to disk.
+
+Requires the dependencies of the pipeline:
+
+    python -m benchmarks.join
+"""
+
+import os
+import time
+import random
+import tempfile
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'benchmark')
+
+from pipeline.join import JoinStore
+
+
+QUESTIONS = 10000
+ANSWERS_PER_QUESTION = 5
+BATCH_SIZE = 500
+
+# memory budget of the store when measuring it with its state on disk
+SPILL_MEMORY_BYTES = 1024 * 1024
+
+
+def _batches(answers_first:bool):
+    questions = [{'Id': i, 'Tags': 'python java', 'Score': 1, 'CreationDate': '2010-01-01T00:00:00Z'} for i in range(QUESTIONS)]
+    answers = [
+        {'Id': QUESTIONS + i, 'ParentId': random.randrange(QUESTIONS), 'Score': 1, 'CreationDate': '2010-01-01T00:00:00Z'}
+        for i in range(QUESTIONS * ANSWERS_PER_QUESTION)
+    ]
+
+    batches = [('questions', questions[i:i + BATCH_SIZE]) for i in range(0, len(questions), BATCH_SIZE)]
+    batches += [('answers', answers[i:i + BATCH_SIZE]) for i in range(0, len(answers), BATCH_SIZE)]
+    if answers_first:
+        batches.reverse()
+    else:
+        random.shuffle(batches)
+    return batches
+
+
+def run_scan(batches) -> int:
+    questions, answers, joined_rows = {}, {}, 0
+    for table, rows in batches:
+        batch = []
+        if table == 'questions':
+            for question in rows:
+                questions[question['Id']] = question
+                batch.append(question)
+        else:
+            for answer in rows:
+                answers[answer['Id']] = answer
+
+        for answer in answers.values():
+            if question := questions.get(answer['ParentId']):
+                answer['Tags'] = question['Tags']
+                batch.append(answer)
+
+        for joined in batch:
+            if joined.get('ParentId') is not None:
+                del answers[joined['Id']]
+        joined_rows += len(batch)
+    return joined_rows
+
+
+def run_store(batches, memory_bytes:int) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        join, joined_rows = JoinStore(path=os.path.join(directory, 'join.sqlite'), memory_bytes=memory_bytes), 0
+        for table, rows in batches:
+            if table == 'questions':
+                joined_rows += len(join.add_questions(rows))
+            else:
+                joined_rows += len(join.add_answers(rows))
+        join.close()
+    return joined_rows
+
+
+if __name__ == '__main__':
+    rows = QUESTIONS * (1 + ANSWERS_PER_QUESTION)
+    methods = [
+        ('scan', run_scan),
+        ('store', lambda batches: run_store(batches, memory_bytes=2**40)),
+        ('store on disk', lambda batches: run_store(batches, memory_bytes=SPILL_MEMORY_BYTES)),
+    ]
+
+    print(f'{"order":>14} {"method":>14} {"rows/s":>10}')
+    for order, answers_first in [('answers first', True), ('random', False)]:
+        for name, run in methods:
+            batches = _batches(answers_first)
+            start = time.monotonic()
+            joined = run(batches)
+            elapsed = time.monotonic() - start
+            assert joined == rows, (joined, rows)
+            print(f'{order:>14} {name:>14} {rows / elapsed:>10.0f}')
@@ -0,0 +1,75 @@
+"""
+Measures the throughput of a stateless worker for different prefetch counts
+and ack group sizes. The messages are consumed and acknowledged with the same
+code as `consume_from` (`_InputQueues` and `_Acknowledger`) and each one is
+sent to an output queue with `send_data`, so every ack also waits for the
+confirms of the output. Use it to pick the PREFETCH_COUNT and ACK_EVERY
+defaults in `service_config`.
+
+Requires a running RabbitMQ instance:
+
+    RABBITMQ_ADDRESS=localhost python -m benchmarks.prefetch
+"""
+
+import os
+import time
+import pika
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'benchmark')
+
+import middleware
+
+
+RABBITMQ_ADDRESS = os.environ.get('RABBITMQ_ADDRESS', 'localhost')
+
+QUEUE = 'bench_prefetch'
+CONTROL_QUEUE = 'bench_prefetch_control'
+OUTPUT_QUEUE = 'bench_prefetch_output'
+MESSAGES = 20000
+PAYLOAD = b'x' * 256
+
+PREFETCH_COUNTS = [1, 10, 50, 100, 250, 1000]
+
+
+def _fill_queue(channel):
+    for queue in (QUEUE, CONTROL_QUEUE, OUTPUT_QUEUE):
+        channel.queue_declare(queue=queue, auto_delete=False)
+        channel.queue_purge(queue=queue)
+
+    for _ in range(MESSAGES):
+        channel.basic_publish(exchange='', routing_key=QUEUE, body=PAYLOAD)
+
+
+def run(prefetch_count:int, ack_every:int) -> float:
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_ADDRESS))
+    channel = connection.channel()
+    _fill_queue(channel)
+
+    channel.basic_qos(prefetch_count=prefetch_count)
+    inputs = middleware._InputQueues(channel=channel, queue_name=QUEUE, control_queue=CONTROL_QUEUE)
+    acknowledger = middleware._Acknowledger(channel=channel, ack_every=ack_every, held_tags=inputs.held_tags)
+
+    start = time.monotonic()
+    received = 0
+    for method, _, body, _ in inputs.consume(on_idle=acknowledger.flush):
+        middleware.send_data(body, channel=channel, worker=OUTPUT_QUEUE, correlation_id='bench')
+        acknowledger.processed(delivery_tag=method.delivery_tag)
+        received += 1
+        if received == MESSAGES:
+            acknowledger.flush()
+            break
+    elapsed = time.monotonic() - start
+
+    for queue in (QUEUE, CONTROL_QUEUE, OUTPUT_QUEUE):
+        channel.queue_delete(queue=queue)
+    middleware.PUBLISHERS.pop(connection, None)
+    connection.close()
+    return MESSAGES / elapsed
+
+
+if __name__ == '__main__':
+    print(f'{"prefetch":>8} {"ack every":>9} {"msg/s":>10}')
+    for prefetch_count in PREFETCH_COUNTS:
+        for ack_every in sorted({1, max(1, prefetch_count // 2)}):
+            print(f'{prefetch_count:>8} {ack_every:>9} {run(prefetch_count, ack_every):>10.0f}')
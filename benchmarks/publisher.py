@@ -0,0 +1,78 @@
+"""
+Compares the throughput of publishing small messages one by one (with and
+without publisher confirms) against the batching publisher used by the
+middleware.
+
+Requires a running RabbitMQ instance:
+
+    RABBITMQ_ADDRESS=localhost python -m benchmarks.publisher
+"""
+
+import os
+import time
+import pika
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'benchmark')
+
+import middleware
+
+
+RABBITMQ_ADDRESS = os.environ.get('RABBITMQ_ADDRESS', 'localhost')
+
+QUEUE = 'bench_publisher'
+MESSAGES = 20000
+PAYLOAD_SIZES = [64, 512, 4096]
+
+
+def _setup():
+    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_ADDRESS))
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE, auto_delete=False)
+    channel.queue_purge(queue=QUEUE)
+    return connection, channel
+
+
+def run_basic_publish(payload:bytes, confirms:bool) -> float:
+    connection, channel = _setup()
+    if confirms:
+        channel.confirm_delivery()
+
+    start = time.monotonic()
+    for _ in range(MESSAGES):
+        channel.basic_publish(exchange='', routing_key=QUEUE, body=payload)
+    elapsed = time.monotonic() - start
+
+    channel.queue_delete(queue=QUEUE)
+    connection.close()
+    return elapsed
+
+
+def run_batch_publisher(payload:bytes) -> float:
+    connection, channel = _setup()
+
+    start = time.monotonic()
+    publisher = middleware.BatchPublisher(connection)
+    for _ in range(MESSAGES):
+        publisher.send(data=payload, exchange='', routing_key=QUEUE, correlation_id='bench')
+    publisher.flush()
+    publisher.wait_for_confirms()
+    elapsed = time.monotonic() - start
+
+    channel.queue_delete(queue=QUEUE)
+    connection.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    print(f'{"payload":>8} {"publisher":>24} {"msg/s":>10}')
+    for size in PAYLOAD_SIZES:
+        payload = b'x' * size
+        runs = [
+            ('basic_publish', lambda: run_basic_publish(payload, confirms=False)),
+            ('basic_publish + confirm', lambda: run_basic_publish(payload, confirms=True)),
+            ('BatchPublisher', lambda: run_batch_publisher(payload)),
+        ]
+        for name, run in runs:
+            elapsed = run()
+            print(f'{size:>8} {name:>24} {MESSAGES / elapsed:>10.0f}')
@@ -0,0 +1,83 @@
+"""
+Compares the row deduplication of `consume_from` for list payloads
+(`check_as_list` with a `row_key`) with the previous approach, which hashed
+each row serialized again as JSON, removed the duplicates one by one and
+serialized the list again to store it.
+
+    python -m benchmarks.row_dedup
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'benchmark')
+
+import middleware
+import serialization
+
+
+ROWS = 10000
+BATCHES = 20
+
+# fraction of rows of each batch that were already received
+DUPLICATED = [0.0, 0.1, 0.5]
+
+
+def _row_keys(batch:serialization.RecordBatch):
+    # same keys as `pipeline.pipeline_3._joined_row_keys` (the pipeline package
+    # is not imported to avoid requiring its dependencies)
+    return [
+        int(id) if parent_id is not None else -int(id) - 1
+        for id, parent_id in zip(batch['Id'], batch['ParentId'])
+    ]
+
+
+def _batch(first_id:int, duplicated:float):
+    rows = []
+    for i in range(ROWS):
+        row_id = first_id + i
+        if random.random() < duplicated:
+            row_id -= ROWS
+        rows.append({'Id': str(row_id), 'ParentId': '1', 'CreationDate': '2010-01-01T00:00:00Z', 'Score': '3', 'Tags': 'python rabbitmq'})
+    return json.dumps(rows).encode('utf-8')
+
+
+def run_hashing(batches) -> float:
+    seen = set()
+    start = time.monotonic()
+    for body in batches:
+        body = json.loads(body)
+        delete_list = []
+        for i, elem in enumerate(body):
+            if hashlib.sha256(json.dumps(elem).encode('utf-8')).digest() in seen:
+                delete_list.append(i)
+
+        for delete_count, i in enumerate(delete_list):
+            del body[i - delete_count]
+
+        json.dumps(body).encode('utf-8')
+        for elem in body:
+            seen.add(hashlib.sha256(json.dumps(elem).encode('utf-8')).digest())
+    return time.monotonic() - start
+
+
+def run_row_key(batches) -> float:
+    seen = set()
+    start = time.monotonic()
+    for body in batches:
+        rows = serialization.as_batch(json.loads(body))
+        middleware._filter_new_rows(rows=rows, seen=seen, row_key=_row_keys)
+    return time.monotonic() - start
+
+
+if __name__ == '__main__':
+    print(f'{"duplicated":>10} {"method":>10} {"rows/s":>12}')
+    for duplicated in DUPLICATED:
+        batches = [_batch(first_id=i * ROWS, duplicated=duplicated) for i in range(BATCHES)]
+        for name, run in [('hashing', run_hashing), ('row key', run_row_key)]:
+            elapsed = run(batches)
+            print(f'{duplicated:>10} {name:>10} {ROWS * BATCHES / elapsed:>12.0f}')
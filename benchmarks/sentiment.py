@@ -0,0 +1,80 @@
+"""
+Compares the answers per second scored by the sentiment analysis stage with
+the previous approach, which scored the raw HTML of every answer with VADER.
+The engine is measured with an empty cache and after scoring the same answers
+once (e.g. when a stream is delivered again after a crash). The answers are
+synthetic HTML bodies with paragraphs, links and code blocks like the ones of
+the StackOverflow dataset.
+
+Requires the dependencies of the pipeline and the VADER lexicon:
+
+    python -m benchmarks.sentiment
+"""
+
+import os
+import time
+import random
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'benchmark')
+
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+from pipeline.sentiment import SentimentEngine
+
+
+ANSWERS = 2000
+
+WORDS = [
+    'this', 'is', 'not', 'a', 'good', 'idea', 'you', 'should', 'never', 'use', 'it', 'works',
+    'great', 'bad', 'wrong', 'the', 'problem', 'solution', 'fails', 'error', 'thanks', 'simply',
+]
+
+CODE = '''<pre><code>for (int i = 0; i &lt; items.length; i++) {
+    if (items[i] == null) throw new IllegalArgumentException("bad item");
+    result.add(items[i].toString());
+}
+</code></pre>'''
+
+
+def _paragraph() -> str:
+    words = random.choices(WORDS, k=random.randint(20, 80))
+    if random.random() < 0.3:
+        words.insert(random.randint(0, len(words)), '<a href="http://stackoverflow.com/q/1">this question</a>')
+    if random.random() < 0.3:
+        words.insert(random.randint(0, len(words)), '<code>foo()</code>')
+    return '<p>' + ' '.join(words) + '</p>'
+
+
+def _answer() -> str:
+    parts = [_paragraph() for _ in range(random.randint(1, 4))]
+    for _ in range(random.randint(0, 2)):
+        parts.insert(random.randint(0, len(parts)), CODE)
+    return '\n\n'.join(parts)
+
+
+def run_raw(bodies, analyzer):
+    return [analyzer.polarity_scores(body)['compound'] for body in bodies]
+
+
+if __name__ == '__main__':
+    bodies = [_answer() for _ in range(ANSWERS)]
+    analyzer = SentimentIntensityAnalyzer()
+    engine = SentimentEngine(analyzer=analyzer)
+
+    runs = [
+        ('raw html', lambda: run_raw(bodies, analyzer)),
+        ('engine, cold cache', lambda: engine.score(bodies)),
+        ('engine, warm cache', lambda: engine.score(bodies)),
+    ]
+
+    print(f'{"method":>20} {"answers/s":>10}')
+    for name, run in runs:
+        start = time.monotonic()
+        run()
+        elapsed = time.monotonic() - start
+        print(f'{name:>20} {ANSWERS / elapsed:>10.0f}')
+
+    dump = engine.dump()
+    start = time.monotonic()
+    SentimentEngine(analyzer=analyzer).load(dump)
+    print(f'cache of {len(engine.cache)} entries: {len(dump)} bytes, loaded in {(time.monotonic() - start) * 1000:.1f}ms')
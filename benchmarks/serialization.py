@@ -0,0 +1,66 @@
+"""
+Compares the size and the encoding and decoding times of the packed codec
+of each edge listed in `service_config.EDGE_SCHEMAS` against JSON.
+
+    python -m benchmarks.serialization
+"""
+
+import json
+import time
+import random
+import string
+
+import serialization
+import service_config
+
+
+ROWS = 1000
+REPEAT = 50
+
+
+def _value(field:str, type:str):
+    if type.endswith('?') and random.random() < 0.1:
+        return None
+    if type.startswith('int'):
+        return random.randint(-10, 10**8)
+    if field == 'Body':
+        return ''.join(random.choices(string.ascii_letters + ' ', k=random.randint(200, 2000)))
+    if field == 'CreationDate':
+        return '2010-01-01T00:00:00Z'
+    return ''.join(random.choices(string.ascii_lowercase + ' ', k=random.randint(5, 30)))
+
+
+def _data(schema:dict):
+    rows = [
+        {field: _value(field, type) for field, type in schema['fields'].items()}
+        for _ in range(ROWS)
+    ]
+    return {schema['table']: rows} if schema.get('table') else rows
+
+
+def _measure(encode, decode, data):
+    start = time.monotonic()
+    for _ in range(REPEAT):
+        payload = encode(data)
+    encode_time = (time.monotonic() - start) / REPEAT
+
+    start = time.monotonic()
+    for _ in range(REPEAT):
+        decode(payload)
+    decode_time = (time.monotonic() - start) / REPEAT
+
+    return len(payload), encode_time, decode_time
+
+
+if __name__ == '__main__':
+    print(f'{"edge":>52} {"codec":>7} {"bytes":>9} {"encode ms":>10} {"decode ms":>10}')
+    for (sender, receiver), schema in service_config.EDGE_SCHEMAS.items():
+        data = _data(schema)
+        codec = serialization.CODECS[serialization.edge_name(sender, receiver)]
+        runs = [
+            ('json', lambda data: json.dumps(data).encode('utf-8'), json.loads),
+            ('packed', codec.encode, codec.decode),
+        ]
+        for name, encode, decode in runs:
+            size, encode_time, decode_time = _measure(encode, decode, data)
+            print(f'{serialization.edge_name(sender, receiver):>52} {name:>7} {size:>9} {encode_time * 1000:>10.2f} {decode_time * 1000:>10.2f}')
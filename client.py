@@ -1,79 +1,270 @@
 import os
 import csv
+import mmap
+import time
 import pika
 import threading
 import middleware
+import serialization
+import service_config
 
-from io import StringIO
-from typing import List
 import sys
+from io import StringIO
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
+from pipeline.input import REQUIRED_COLUMNS
 
 def perror(msg, end='\n'):
     sys.stderr.write(msg + end)
 
-def _serialize_chunk(header:List[str], chunk:List[str]):
-    """Serializes the given CSV chunk including the header."""
-
-    sio = StringIO()
-    writer = csv.writer(sio)
-    writer.writerow(header)
-    writer.writerows(chunk)
-
-    sio.seek(0)
-    return sio.read()
+# records read to estimate the size of a chunk of `LINES_PER_CHUNK` lines
+SAMPLE_RECORDS = 1000
 
 
-def _read_lines(reader:csv.reader, n:int) -> List[str]:
-    """Reads `n` lines from the CSV reader."""
+def _record_end(mm:mmap.mmap, start:int, position:int) -> int:
+    """Returns the offset after the first record that ends at or after
+    `position`, where `start` is the beginning of a record. A newline ends a
+    record only if the number of quotes since `start` is even, otherwise it
+    is part of a quoted field (escaped quotes always come in pairs)."""
 
-    lines:List[str] = []
-    for i, line in enumerate(reader):
-        lines.append(line)
-        if i == n - 1:
-            break
+    quotes = mm[start:position].count(b'"')
+    while True:
+        newline = mm.find(b'\n', position)
+        if newline < 0:
+            return len(mm)
 
-    return lines
+        quotes += mm[position:newline].count(b'"')
+        position = newline + 1
+        if quotes % 2 == 0:
+            return position
 
 
-def read_file_by_chunks(file_name:str, lines:int, chunks:int = -1):
-    """Yields chunks of `lines` from a file. The last chunk may contain
-    less lines than indicated.
-    `chunks` is the number of chunks to yield. If negative then the whole
-    file is processed."""
-
-    with open(file_name, 'r') as fp:
-        reader = csv.reader(fp)
-        header = next(reader)
+def _bytes_per_lines(mm:mmap.mmap, start:int, lines:int) -> int:
+    """Estimates the size of `lines` records from the first ones."""
 
-        read_chunks = 0
-        while chunks < 0 or chunks > read_chunks:
-            chunk = _read_lines(reader, n=lines)
+    end, records = start, 0
+    while records < min(lines, SAMPLE_RECORDS) and end < len(mm):
+        end = _record_end(mm, end, end)
+        records += 1
 
-            yield _serialize_chunk(header=header, chunk=chunk)
-            if len(chunk) < lines:
-                # finished processing the file
-                return
+    return max(1, (end - start) * lines // max(records, 1))
 
-            read_chunks += 1
 
+def chunk_ranges(mm:mmap.mmap, lines:int, chunks:int = -1, chunk_bytes:int = 0) -> Tuple[int, List[Tuple[int, int]]]:
+    """Splits a memory mapped CSV file into chunks of about `lines` records
+    (or `chunk_bytes` bytes if set) at record boundaries. Returns the size of
+    the header and the start and end offsets of each chunk.
+    `chunks` is the number of chunks to return. If negative then the whole
+    file is processed."""
 
-def upload_csv(routing_key:str, file_name:str, lines:int, chunks:int, correlation_id:str):
+    header_end = _record_end(mm, 0, 0)
+    chunk_bytes = chunk_bytes or _bytes_per_lines(mm, header_end, lines)
+
+    ranges:List[Tuple[int, int]] = []
+    start = header_end
+    while start < len(mm) and (chunks < 0 or chunks > len(ranges)):
+        # the last byte of a chunk of exactly `chunk_bytes` is the newline
+        # that ends its last record
+        end = _record_end(mm, start, min(start + max(chunk_bytes, 1) - 1, len(mm)))
+        ranges.append((start, end))
+        start = end
+
+    return header_end, ranges
+
+
+def read_file_by_chunks(file_name:str, lines:int, chunks:int = -1, chunk_bytes:int = 0):
+    """Yields chunks of about `lines` records from a CSV file, each one
+    starting with the header (see `chunk_ranges`).
+    The chunks are slices of the file split at record boundaries, so the
+    records are sent as they are in the file without parsing them."""
+
+    if os.path.getsize(file_name) == 0:
+        return
+
+    with open(file_name, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_end, ranges = chunk_ranges(mm, lines=lines, chunks=chunks, chunk_bytes=chunk_bytes)
+        header = mm[:header_end]
+        for start, end in ranges:
+            yield header + mm[start:end]
+
+
+class ColumnPruner:
+    """Drops the columns of the CSV chunks that are not in `columns`. The
+    chunks are parsed and written again, so the pruning is skipped when the
+    file has no other columns."""
+
+    def __init__(self, header:bytes, columns:List[str]):
+        names = next(csv.reader(StringIO(header.decode('utf-8'))))
+        missing = [column for column in columns if column not in names]
+        if missing:
+            raise ValueError(f'the file does not have the columns {missing}')
+
+        indices = [names.index(column) for column in columns]
+        self.needed = len(indices) < len(names)
+        self.width = max(indices) + 1
+        self.project = itemgetter(*indices) if len(indices) > 1 else lambda row: (row[indices[0]],)
+
+    def prune(self, chunk:bytes) -> bytes:
+        if not self.needed:
+            return chunk
+
+        sio = StringIO()
+        writer = csv.writer(sio)
+        for row in csv.reader(StringIO(chunk.decode('utf-8'))):
+            if len(row) < self.width:
+                row += [''] * (self.width - len(row))
+            writer.writerow(self.project(row))
+
+        return sio.getvalue().encode('utf-8')
+
+
+class Uploader:
+    """Sends a CSV file as chunks to a stage of the pipeline through several
+    connections at once. The chunks are split into `connections` contiguous
+    byte ranges of the file and each range is published by its own thread and
+    connection, with publisher confirms (see `middleware.BatchPublisher`).
+    Before publishing a chunk, the thread waits while the input queue of the
+    stage has more than `max_queue_depth` messages. If `columns` is given, the
+    other columns of the file are dropped before publishing (see `ColumnPruner`).
+    The DONE message is sent once every chunk was confirmed by the broker."""
+
+    def __init__(self, routing_key:str, file_name:str, lines:int, chunks:int, correlation_id:str, chunk_bytes:int = 0,
+                 connections:int = service_config.UPLOAD_CONNECTIONS, max_queue_depth:int = service_config.UPLOAD_MAX_QUEUE_DEPTH,
+                 columns:Optional[List[str]] = None):
+        self.routing_key = routing_key
+        self.file_name = file_name
+        self.lines = lines
+        self.chunks = chunks
+        self.correlation_id = correlation_id
+        self.chunk_bytes = chunk_bytes
+        self.connections = connections
+        self.max_queue_depth = max_queue_depth
+        self.columns = columns
+
+        self.lock = threading.Lock()
+        self.sent_chunks = 0
+        self.sent_bytes = 0
+        self.file_bytes = 0
+        self.paused = 0.0
+        self.confirms:List[Dict[str, float]] = []
+        self.errors:List[Exception] = []
+
+    def run(self) -> Dict[str, float]:
+        """Uploads the file and returns the upload statistics."""
+
+        start = time.monotonic()
+        header_end, ranges = 0, []
+        if os.path.getsize(self.file_name) > 0:
+            with open(self.file_name, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                header_end, ranges = chunk_ranges(mm, lines=self.lines, chunks=self.chunks, chunk_bytes=self.chunk_bytes)
+
+        # contiguous ranges of chunks, one for each connection
+        size = -(-len(ranges) // self.connections) or 1
+        threads = [
+            threading.Thread(target=self._upload_range, args=(header_end, ranges[i:i + size]))
+            for i in range(0, len(ranges), size)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_ADDRESS))
+        try:
+            middleware.send_done(channel=connection.channel(), worker=self.routing_key, correlation_id=self.correlation_id)
+        finally:
+            connection.close()
+
+        return self._stats(elapsed=time.monotonic() - start)
+
+    def _upload_range(self, header_end:int, ranges:List[Tuple[int, int]]):
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_ADDRESS))
+            try:
+                channel = connection.channel()
+                with open(self.file_name, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    header = mm[:header_end]
+                    pruner = ColumnPruner(header, self.columns) if self.columns else None
+                    for start, end in ranges:
+                        self._wait_for_queue(connection, channel)
+
+                        chunk = header + mm[start:end]
+                        if pruner is not None:
+                            chunk = pruner.prune(chunk)
+
+                        middleware.send_data(chunk, channel=channel, worker=self.routing_key, correlation_id=self.correlation_id)
+                        with self.lock:
+                            self.sent_chunks += 1
+                            self.sent_bytes += len(chunk)
+                            self.file_bytes += header_end + end - start
+                            perror(f'sending chunk {self.sent_chunks}   ', end='\r')
+
+                middleware.flush_output(channel)
+                with self.lock:
+                    self.confirms.append(middleware.confirm_stats(channel))
+            finally:
+                connection.close()
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+
+    def _wait_for_queue(self, connection:pika.BlockingConnection, channel):
+        """Blocks while the input queue of the stage is too long."""
+
+        start = time.monotonic()
+        while channel.queue_declare(queue=self.routing_key, passive=True).method.message_count > self.max_queue_depth:
+            # keeps processing the confirms and heartbeats while waiting
+            connection.sleep(service_config.UPLOAD_QUEUE_POLL_INTERVAL)
+
+        with self.lock:
+            self.paused += time.monotonic() - start
+
+    def _stats(self, elapsed:float) -> Dict[str, float]:
+        confirms = sum(stats['confirms'] for stats in self.confirms)
+        return {
+            'chunks': self.sent_chunks,
+            'bytes': self.sent_bytes,
+            'file_bytes': self.file_bytes,
+            'seconds': elapsed,
+            'mb_per_second': self.sent_bytes / max(elapsed, 1e-9) / 2**20,
+            'paused_seconds': self.paused,
+            'avg_confirm_latency': sum(stats['avg_latency'] * stats['confirms'] for stats in self.confirms) / max(confirms, 1),
+            'max_confirm_latency': max((stats['max_latency'] for stats in self.confirms), default=0.0),
+        }
+
+
+def upload_csv(routing_key:str, file_name:str, lines:int, chunks:int, correlation_id:str, chunk_bytes:int = 0,
+               connections:int = service_config.UPLOAD_CONNECTIONS):
     """Sends a CSV file as chunks through a rabbit MQ exchange. The CSV header
-    is repeated on each chunk."""
-
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_ADDRESS))
-    channel = connection.channel()
-
-    try:
-        for i, chunk in enumerate(read_file_by_chunks(file_name=file_name, lines=lines, chunks=chunks)):
-            perror(f'sending chunk {i}   ', end='\r')
+    is repeated on each chunk. Only the columns used by the stage (see
+    `pipeline.input.REQUIRED_COLUMNS`) are sent. Prints the upload statistics
+    at the end."""
+
+    uploader = Uploader(
+        routing_key=routing_key,
+        file_name=file_name,
+        lines=lines,
+        chunks=chunks,
+        correlation_id=correlation_id,
+        chunk_bytes=chunk_bytes,
+        connections=connections,
+        columns=REQUIRED_COLUMNS[routing_key]
+    )
+    stats = uploader.run()
 
-            middleware.send_data(chunk.encode('utf-8'), channel=channel, worker=routing_key, correlation_id=correlation_id)
+    perror(
+        f'uploaded {file_name}: {stats["chunks"]} chunks, {stats["bytes"] / 2**20:.1f} MB '
+        f'({stats["file_bytes"] / 2**20:.1f} MB before dropping the unused columns) in {stats["seconds"]:.2f}s '
+        f'({stats["mb_per_second"]:.1f} MB/s, paused {stats["paused_seconds"]:.2f}s by the queue depth), '
+        f'confirm latency avg {stats["avg_confirm_latency"] * 1000:.1f}ms max {stats["max_confirm_latency"] * 1000:.1f}ms'
+    )
 
-        middleware.send_done(channel=channel, worker=routing_key, correlation_id=correlation_id)
-    finally:
-        channel.close()
-        connection.close()
+    compression = middleware.compression_stats().get(serialization.edge_name(middleware.WORKER_TASK, routing_key))
+    if compression:
+        perror(f'compressed {compression["messages"]} chunks of {file_name} with ratio {compression["ratio"]:.2f} in {compression["seconds"]:.2f}s')
 
 
 if __name__ == '__main__':
@@ -81,6 +272,8 @@ if __name__ == '__main__':
 
     LINES_PER_CHUNK = int(os.environ.get('LINES_PER_CHUNK', 1000))
     NUM_CHUNKS = int(os.environ.get('NUM_CHUNKS', -1))
+    BYTES_PER_CHUNK = int(os.environ.get('BYTES_PER_CHUNK') or 0)
+    UPLOAD_CONNECTIONS = int(os.environ.get('UPLOAD_CONNECTIONS') or service_config.UPLOAD_CONNECTIONS)
     CORRELATION_ID = os.environ.get('CORRELATION_ID')
 
     connection, channel, response_queue, correlation_id = middleware.build_response_queue(
@@ -96,7 +289,9 @@ if __name__ == '__main__':
             file_name='data/answers.csv',
             lines=LINES_PER_CHUNK,
             chunks=NUM_CHUNKS,
-            correlation_id=correlation_id
+            correlation_id=correlation_id,
+            chunk_bytes=BYTES_PER_CHUNK,
+            connections=UPLOAD_CONNECTIONS
         )
 
     def upload_questions():
@@ -105,7 +300,9 @@ if __name__ == '__main__':
             file_name='data/questions.csv',
             lines=LINES_PER_CHUNK,
             chunks=NUM_CHUNKS,
-            correlation_id=correlation_id
+            correlation_id=correlation_id,
+            chunk_bytes=BYTES_PER_CHUNK,
+            connections=UPLOAD_CONNECTIONS
         )
 
 
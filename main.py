@@ -16,6 +16,7 @@ if __name__ == '__main__':
     logging.getLogger("pika").setLevel(logging.WARNING)
 
     liveness_agent.start_server_in_new_thread()
+    liveness_agent.register_status_provider('compression', middleware.compression_stats)
 
     connection = middleware.connect(RABBITMQ_ADDRESS)
     channel = connection.channel()
@@ -3,15 +3,20 @@ import os
 import json
 import pika
 import time
-import hashlib
+import zlib
+import struct
 import logging
+import threading
 
+import serialization
 import service_config
 
-from typing import Callable, Dict, Generator, List, Optional, Set, Tuple, Union
+from typing import Any, Callable, Dict, Generator, Hashable, List, Optional, Set, Tuple, Union
 from services import storage, killer
+from babel_library.commons import constants
 from functools import wraps
-from collections import defaultdict
+from contextlib import contextmanager
+from collections import defaultdict, deque
 from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
 
 
@@ -28,7 +33,11 @@ LOG_FILES = {}
 # number of workers in the previous stage (see WORKERS_TO_WAIT).
 # the DONE message consist of an initial byte \x00, then the ID of the worker
 # that sent the message and finally the ID of the worker meant to receive
-# the message
+# the message. DONE messages are sent through the data queues, behind the data
+# sent before them, and are marked with the DONE_HEADER. A worker that takes a
+# DONE meant for another replica of its stage forwards it to the control queue
+# of that replica (see CONTROL_EXCHANGE)
+DONE_HEADER = 'x-done'
 DONE_RE = re.compile('^\x00(.+?)\x1c(\\d+)$')
 
 
@@ -52,6 +61,65 @@ STORAGE_ID = f"{WORKER_TASK}_{WORKER_ID}"
 # name of the exchange where the client output is sent
 CLIENT_RESPONSE_EXCHANGE = 'client_output'
 
+# name of the exchange used to forward the "DONE" messages. Each worker has its
+# own control queue bound to this exchange using its storage ID as routing key
+# so a forwarded DONE message is delivered straight to the worker it is meant for
+CONTROL_EXCHANGE = 'control'
+
+# content type of the messages that carry several payloads coalesced by the
+# publisher. The body is a sequence of payloads, each one prefixed by its
+# length as a 4 bytes big endian integer
+BATCH_CONTENT_TYPE = 'application/x-batch'
+BATCH_LEN = struct.Struct('>I')
+
+# headers used to identify each payload sent by `send_data`. The sender is a
+# name that is constant across restarts and the sequence number increases by
+# one with each payload sent to the same queue (see `_next_sequence`).
+# Coalesced messages carry a list of sequence numbers, one for each payload
+SENDER_HEADER = 'x-sender'
+SEQ_HEADER = 'x-seq'
+
+# the records of the stream logs start with the sequence number and the lengths
+# of the sender and content type, followed by them and the payload
+LOG_RECORD_HEADER = struct.Struct('>qHH')
+
+# messages stored by `store_msg` waiting to be appended to the log of each
+# stream
+PENDING_MSGS:Dict[str, List[bytes]] = defaultdict(list)
+
+# requests to the storage sent without waiting for the response. They are
+# waited before acknowledging the input (see `flush_stored_msgs`)
+PENDING_WRITES:List = []
+
+# stateful workers (the ones that replay their input after a crash) number
+# their output with a counter for each stream and destination queue, given by
+# its exchange and routing key. Since the replay produces the same output in
+# the same order, the numbers are the same after a restart
+SEQUENCES:Dict[str, Dict[Tuple[str, str], int]] = defaultdict(lambda: defaultdict(int))
+SEQUENCES_LOCK = threading.Lock()
+
+# correlation ID, sender and sequence number of the input payload being
+# processed by a stateless worker, the destination queues that got a payload
+# for it and whether the worker took the lineage to send the output later (see
+# `_next_sequence` and `input_lineage`)
+INPUT_LINEAGE:Optional[Tuple[str, str, int]] = None
+OUTPUT_QUEUES:Set[Tuple[str, str]] = set()
+LINEAGE_TAKEN = False
+
+# content encoding of the messages compressed by the publisher (see
+# `service_config.COMPRESS_MIN_BYTES`)
+DEFLATE_ENCODING = 'deflate'
+
+# size of the messages before and after compressing them and time spent, for
+# each edge the worker sends data to or receives data from (see
+# `compression_stats`). The edges are named `sender>receiver`
+COMPRESSION_STATS:Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(int))
+COMPRESSION_STATS_LOCK = threading.Lock()
+
+# publisher used by each connection (see `_get_publisher`)
+PUBLISHERS:Dict[BlockingConnection, 'BatchPublisher'] = {}
+PUBLISHERS_LOCK = threading.Lock()
+
 
 class END_OF_STREAM:
     """Just a type to indicate that a stream finished."""
@@ -89,6 +157,7 @@ def setup_communication(channel:BlockingChannel) -> None:
 
     # creates the queue where the clients receive the output
     channel.exchange_declare(exchange=CLIENT_RESPONSE_EXCHANGE, exchange_type='direct')
+    channel.exchange_declare(exchange=CONTROL_EXCHANGE, exchange_type='direct')
 
     for worker in service_config.WORKERS:
         if worker.startswith('client'):
@@ -99,6 +168,20 @@ def setup_communication(channel:BlockingChannel) -> None:
         else:
             channel.queue_declare(queue=worker, durable=True)
 
+        # the control queues of every worker are declared upfront so DONE
+        # messages are never dropped because the receiver didn't start yet
+        for i in range(service_config.WORKERS[worker]):
+            control_queue = _control_queue_name(worker=worker, worker_id=i)
+            channel.queue_declare(queue=control_queue, durable=True)
+            channel.queue_bind(exchange=CONTROL_EXCHANGE, queue=control_queue, routing_key=f'{worker}_{i}')
+
+
+def _control_queue_name(worker:str, worker_id:Union[int, str]) -> str:
+    """Returns the name of the queue where the worker with the given ID
+    receives the "DONE" messages."""
+
+    return f'{worker}_{worker_id}_control'
+
 
 def execute_worker(name:str, channel:BlockingChannel) -> None:
     """Executes the corresponding worker by its name. The worker must be
@@ -107,20 +190,29 @@ def execute_worker(name:str, channel:BlockingChannel) -> None:
     REGISTERED_WORKERS[name](channel, worker_id=WORKER_ID)
 
 
-def send_data(data:Union[bytes, str], channel:BlockingChannel, worker:str, correlation_id:str, shard_key:Optional[Union[int, USE_HASH]]=None):
+def send_data(data:Any, channel:BlockingChannel, worker:str, correlation_id:str, shard_key:Optional[Union[int, USE_HASH]]=None):
     """Sends `data` to a stage of the pipeline. `worker` is the name of the
-    workers in the destination stage. The `correlation_id` parameter is passed as
+    workers in the destination stage. Bytes and strings are sent as they are.
+    Other values are serialized with the codec of the edge (see `serialization`),
+    so the receiver must consume them with `decode` set. The `correlation_id` parameter is passed as
     the message correlation ID and it's used to identify the request that the chunk is
     associated with.
     The `shard_key` is for sharded stages, where each worker expects to receive
     a subset of the messages based on the `shard_key`. This is only used for
-    workers that are in the SHARDED list in the `service_config`."""
+    workers that are in the SHARDED list in the `service_config`.
+    The data may be buffered to be sent along with other payloads to the same
+    destination. Use `flush_output` to make sure it reached the broker."""
 
+    content_type = None
     if isinstance(data, str):
         data = data.encode('utf-8')
+    elif not isinstance(data, bytes):
+        data, content_type = serialization.encode(data, sender=WORKER_TASK, receiver=worker)
 
     if isinstance(shard_key, USE_HASH) or shard_key is USE_HASH:
-        shard_key = hash(data)
+        # the built-in hash is randomized for each process, so a message sent
+        # again after a restart could reach another shard
+        shard_key = zlib.crc32(data)
 
     if shard_key is not None:
         assert isinstance(shard_key, int), repr(shard_key)
@@ -135,38 +227,460 @@ def send_data(data:Union[bytes, str], channel:BlockingChannel, worker:str, corre
         exchange, routing_key = worker, str(shard_key)
 
     if LOG_MESSAGES:
-        file_name = f'/logs/{correlation_id}/output/{exchange}-{routing_key}.txt'
-        if file_name not in LOG_FILES:
-            os.makedirs(os.path.dirname(file_name), exist_ok=True)
-            LOG_FILES[file_name] = open(f'/logs/{correlation_id}/output/{exchange}-{routing_key}.txt', 'wb', buffering=0)
-
-        LOG_FILES[file_name].write(data + b'\n')
-
-    channel.basic_publish(
-        exchange=exchange,
-        routing_key=routing_key,
-        body=data,
-        mandatory=1,
-        properties=pika.BasicProperties(
-            #delivery_mode=1,  # transient delivery mode
-            correlation_id=correlation_id,
-        )
-    )
+        _log_output(data=data, correlation_id=correlation_id, exchange=exchange, routing_key=routing_key)
+
+    # empty payloads mark the inputs that produced no output (see `_complete_output`)
+    assert data, 'empty payloads can not be sent'
+
+    sequence = _next_sequence(correlation_id=correlation_id, exchange=exchange, routing_key=routing_key)
+    _get_publisher(channel).send(data=data, exchange=exchange, routing_key=routing_key, correlation_id=correlation_id, sequence=sequence, content_type=content_type)
+
+
+def _next_sequence(correlation_id:str, exchange:str, routing_key:str) -> Tuple[str, int]:
+    """Returns the sender and sequence number of the next payload sent to the
+    given queue. Stateful workers (and clients) use their storage ID and a
+    counter for each queue. Stateless workers don't replay their input, so
+    after a crash the redelivered messages may be processed by another replica
+    and in a different order. In that case the payload is identified by the
+    input that produced it: the sender is the path of stages the data went
+    through and the number is the one of the input. Stateless workers send
+    exactly one payload to each queue of the next stages for each input (see
+    `_complete_output`), so every queue receives the numbers of each sender
+    without gaps."""
+
+    if INPUT_LINEAGE is None:
+        with SEQUENCES_LOCK:
+            counters = SEQUENCES[correlation_id]
+            seq = counters[exchange, routing_key]
+            counters[exchange, routing_key] += 1
+        return STORAGE_ID, seq
+
+    _, sender, seq = INPUT_LINEAGE
+    assert (exchange, routing_key) not in OUTPUT_QUEUES, f'more than one payload sent to {exchange or routing_key} {routing_key} for the same input'
+    OUTPUT_QUEUES.add((exchange, routing_key))
+    return f'{WORKER_TASK}<{sender}', seq
+
+
+def _output_queues(worker:str) -> List[Tuple[str, str]]:
+    """Returns the exchange and routing key of each queue of the next stages
+    of the worker."""
+
+    queues = []
+    for next_task in service_config.NEXT_TASK.get(worker, []):
+        if next_task in service_config.SHARDED:
+            queues += [(next_task, str(shard)) for shard in range(service_config.WORKERS[next_task])]
+        else:
+            queues.append(('', next_task))
+    return queues
+
+
+def _complete_output(channel:BlockingChannel):
+    """Sends an empty payload numbered after the input being processed by a
+    stateless worker to each queue of the next stages that got no output for
+    it, so the receivers see the numbers of the sender without gaps (see
+    `_SenderSequences`). The empty payloads are not yielded to the workers."""
+
+    if INPUT_LINEAGE is None:
+        return
+
+    correlation_id = INPUT_LINEAGE[0]
+    for exchange, routing_key in _output_queues(WORKER_TASK):
+        if (exchange, routing_key) not in OUTPUT_QUEUES:
+            sequence = _next_sequence(correlation_id=correlation_id, exchange=exchange, routing_key=routing_key)
+            _get_publisher(channel).send(data=b'', exchange=exchange, routing_key=routing_key, correlation_id=correlation_id, sequence=sequence)
+
+
+def _begin_input(lineage:Optional[Tuple[str, str, int]]):
+    """Sets the input whose output is being sent by a stateless worker."""
+
+    global INPUT_LINEAGE, LINEAGE_TAKEN
+
+    INPUT_LINEAGE, LINEAGE_TAKEN = lineage, False
+    OUTPUT_QUEUES.clear()
+
+
+def input_lineage() -> Optional[Tuple[str, str, int]]:
+    """Returns the lineage of the input being processed by a stateless worker
+    (see `_next_sequence`). Workers that send the output of an input after
+    consuming the next ones must take its lineage with this function and send
+    the output within `output_of`, even if there is none."""
+
+    global LINEAGE_TAKEN
+
+    LINEAGE_TAKEN = True
+    return INPUT_LINEAGE
+
+
+@contextmanager
+def output_of(channel:BlockingChannel, lineage:Optional[Tuple[str, str, int]]):
+    """Numbers the payloads sent in the block as the output of the input with
+    the given lineage (see `input_lineage`). All the output of an input must be
+    sent in a single block, at most one payload to each queue."""
+
+    global INPUT_LINEAGE, LINEAGE_TAKEN
+
+    saved = INPUT_LINEAGE, set(OUTPUT_QUEUES), LINEAGE_TAKEN
+    _begin_input(lineage)
+    try:
+        yield
+        _complete_output(channel)
+    finally:
+        INPUT_LINEAGE, queues, LINEAGE_TAKEN = saved
+        OUTPUT_QUEUES.clear()
+        OUTPUT_QUEUES.update(queues)
+
+
+def _log_output(data:bytes, correlation_id:str, exchange:str, routing_key:str):
+    """Writes an outgoing message to the log files of the stream."""
+
+    file_name = f'/logs/{correlation_id}/output/{exchange}-{routing_key}.txt'
+    if file_name not in LOG_FILES:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        LOG_FILES[file_name] = open(file_name, 'wb', buffering=0)
+
+    LOG_FILES[file_name].write(data + b'\n')
 
 
 def send_to_client(channel:BlockingChannel, correlation_id:str, body:bytes):
     """Sends a message to a client identified by the `correlation_id`. This function is
     used to send the final pipeline response to the clients."""
 
-    channel.basic_publish(
+    _get_publisher(channel).publish(
         exchange=CLIENT_RESPONSE_EXCHANGE,
         routing_key=correlation_id,
         body=body,
-        mandatory=1,
         properties=pika.BasicProperties(correlation_id=correlation_id)
     )
 
 
+def flush_output(channel:BlockingChannel):
+    """Publishes the buffered messages and blocks until the broker confirms
+    every message sent through the connection of the `channel`. Messages
+    produced while processing an input must be flushed before the input is
+    acknowledged."""
+
+    publisher = _get_publisher(channel)
+    publisher.flush()
+    publisher.wait_for_confirms()
+
+
+def confirm_stats(channel:BlockingChannel) -> Dict[str, float]:
+    """Returns the number of messages confirmed by the broker through the
+    connection of the `channel` and the average and maximum time it took."""
+
+    publisher = _get_publisher(channel)
+    return {
+        'confirms': publisher.confirms,
+        'avg_latency': publisher.confirm_time_total / max(publisher.confirms, 1),
+        'max_latency': publisher.confirm_time_max,
+    }
+
+
+def _get_publisher(channel:BlockingChannel) -> 'BatchPublisher':
+    """Returns the publisher associated to the connection of the channel,
+    creating it if needed."""
+
+    connection = channel.connection
+    with PUBLISHERS_LOCK:
+        if connection not in PUBLISHERS:
+            PUBLISHERS[connection] = BatchPublisher(connection)
+        return PUBLISHERS[connection]
+
+
+# destination, correlation ID, sender and content type of the buffered payloads
+BufferKey = Tuple[str, str, str, Optional[str], Optional[str]]
+
+
+class BatchPublisher:
+    """Publishes messages through a dedicated channel in publisher confirms
+    mode. Small payloads sent to the same destination are coalesced into a
+    single message (see BATCH_CONTENT_TYPE) which is published once it reaches
+    `service_config.PUBLISH_BATCH_BYTES`, after `service_config.PUBLISH_LINGER`
+    seconds, or when the output is flushed (see `flush_output`). Workers flush
+    it before acknowledging each group of input messages, so their batches
+    hold at most the output of one group. Only payloads with the same content type are coalesced, and the
+    content type of the batch includes it as the `codec` parameter.
+    The input messages stored by `store_msg` are appended to the stream logs
+    before publishing any payload, so a message produced by a stateful worker
+    is always produced again when the worker replays its input.
+    The confirms are tracked asynchronously by delivery tag, so several messages
+    can be in flight at the same time (up to `service_config.PUBLISH_MAX_IN_FLIGHT`)
+    and the publisher only blocks in `wait_for_confirms`."""
+
+    def __init__(self, connection:BlockingConnection):
+        self.connection = connection
+        self.channel = connection.channel()
+
+        # payloads waiting to be published for each destination, sender and
+        # content type, along with their sequence number
+        self.buffers:Dict[BufferKey, List[Tuple[bytes, int]]] = {}
+        self.buffer_sizes:Dict[BufferKey, int] = defaultdict(int)
+        self.buffer_start:Dict[BufferKey, float] = {}
+
+        # delivery tags of the messages not yet confirmed by the broker, in
+        # publishing order
+        self.next_delivery_tag = 1
+        self.unconfirmed:Dict[int, float] = {}
+        self.nacked:List[int] = []
+
+        # time between publishing each message and receiving its confirm
+        self.confirms = 0
+        self.confirm_time_total = 0.0
+        self.confirm_time_max = 0.0
+
+        # condition the publisher is blocked on, if any (see `_wait`)
+        self.waiting_for:Optional[Callable[[], bool]] = None
+
+        # the blocking channel only supports waiting for the confirm of each
+        # message, so the confirms are requested through the underlying
+        # asynchronous channel
+        select_ok = []
+        self.channel._impl.confirm_delivery(
+            ack_nack_callback=self._on_confirm,
+            callback=lambda frame: select_ok.append(frame)
+        )
+        while not select_ok:
+            self.connection.process_data_events(time_limit=0.1)
+
+    def send(self, data:bytes, exchange:str, routing_key:str, correlation_id:str, sequence:Optional[Tuple[str, int]] = None, content_type:Optional[str] = None):
+        """Buffers the payload to be published to the given destination. The
+        `sequence` is the sender and sequence number of the payload."""
+
+        sender, seq = sequence or (None, 0)
+        key = (exchange, routing_key, correlation_id, sender, content_type)
+
+        if self.buffer_sizes[key] + BATCH_LEN.size + len(data) > service_config.PUBLISH_BATCH_BYTES:
+            self._flush_buffer(key)
+
+        if len(data) >= service_config.PUBLISH_BATCH_BYTES:
+            # large payloads are not worth coalescing
+            self._publish_payloads(key, [(data, seq)])
+        else:
+            if key not in self.buffers:
+                self.buffers[key] = []
+                self.buffer_start[key] = time.monotonic()
+
+            self.buffers[key].append((data, seq))
+            self.buffer_sizes[key] += BATCH_LEN.size + len(data)
+
+        self.flush_expired()
+
+    def flush_expired(self):
+        """Publishes the buffers that were waiting for longer than the linger
+        time."""
+
+        now = time.monotonic()
+        for key, start in list(self.buffer_start.items()):
+            if now - start >= service_config.PUBLISH_LINGER:
+                self._flush_buffer(key)
+
+    def flush(self):
+        """Publishes all the buffered payloads."""
+
+        for key in list(self.buffers):
+            self._flush_buffer(key)
+
+    def publish(self, exchange:str, routing_key:str, body:bytes, properties:pika.BasicProperties):
+        """Publishes a message without buffering it. Blocks while there are too
+        many messages waiting for a confirm."""
+
+        self._wait(lambda: len(self.unconfirmed) < service_config.PUBLISH_MAX_IN_FLIGHT)
+
+        self.channel._impl.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=properties,
+            mandatory=True
+        )
+        self.unconfirmed[self.next_delivery_tag] = time.monotonic()
+        self.next_delivery_tag += 1
+
+        # writes the message to the socket without waiting for the confirm
+        self.connection.process_data_events(time_limit=0)
+
+    def wait_for_confirms(self):
+        """Blocks until all the published messages are confirmed by the broker."""
+
+        self._wait(lambda: not self.unconfirmed)
+
+        if self.nacked:
+            nacked, self.nacked = self.nacked, []
+            raise Exception(f'{len(nacked)} messages were rejected by the broker (delivery tags {nacked[:10]})')
+
+    def _wait(self, done:Callable[[], bool]):
+        """Processes the connection events until `done` returns true. The
+        confirms are received through the asynchronous channel, which doesn't
+        make `process_data_events` return, so `_on_confirm` wakes it up once
+        `done` holds."""
+
+        while not done():
+            self.waiting_for = done
+            self.connection.process_data_events(time_limit=None)
+        self.waiting_for = None
+
+    def _flush_buffer(self, key:BufferKey):
+        payloads = self.buffers.pop(key, None)
+        self.buffer_sizes.pop(key, None)
+        self.buffer_start.pop(key, None)
+
+        if payloads:
+            self._publish_payloads(key, payloads)
+
+    def _publish_payloads(self, key:BufferKey, payloads:List[Tuple[bytes, int]]):
+        exchange, routing_key, correlation_id, sender, codec = key
+
+        # the input that produced the payloads must be in the stream log
+        # before they leave this worker (see `_next_sequence`)
+        if PENDING_MSGS:
+            flush_stored_msgs()
+
+        headers = None
+        if len(payloads) == 1:
+            (body, seq), = payloads
+            content_type = codec
+            if sender is not None:
+                headers = {SENDER_HEADER: sender, SEQ_HEADER: seq}
+        else:
+            body = b''.join(BATCH_LEN.pack(len(payload)) + payload for payload, _ in payloads)
+            content_type = f'{BATCH_CONTENT_TYPE};codec={codec}' if codec else BATCH_CONTENT_TYPE
+            if sender is not None:
+                headers = {
+                    SENDER_HEADER: sender,
+                    SEQ_HEADER: [seq for _, seq in payloads],
+                }
+
+        content_encoding = None
+        stage = exchange or routing_key
+        min_bytes = service_config.COMPRESS_MIN_BYTES.get(stage, service_config.DEFAULT_COMPRESS_MIN_BYTES)
+        if min_bytes is not None and len(body) >= min_bytes:
+            body, content_encoding = _compress(body, edge=serialization.edge_name(WORKER_TASK, stage))
+
+        self.publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(correlation_id=correlation_id, content_type=content_type, content_encoding=content_encoding, headers=headers)
+        )
+
+    def _on_confirm(self, frame):
+        """Called by the connection for each Basic.Ack and Basic.Nack received
+        from the broker."""
+
+        method = frame.method
+        if method.multiple:
+            confirmed = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+        else:
+            confirmed = [method.delivery_tag]
+
+        now = time.monotonic()
+        for tag in confirmed:
+            published = self.unconfirmed.pop(tag, None)
+            if published is not None:
+                self.confirms += 1
+                self.confirm_time_total += now - published
+                self.confirm_time_max = max(self.confirm_time_max, now - published)
+
+        if isinstance(method, pika.spec.Basic.Nack):
+            self.nacked.extend(confirmed)
+
+        if self.waiting_for is not None and self.waiting_for():
+            # a single wake-up for the condition the publisher is blocked on
+            self.waiting_for = None
+            self.connection.call_later(0, lambda: None)
+
+
+def _compress(body:bytes, edge:str) -> Tuple[bytes, Optional[str]]:
+    """Returns the compressed body and its content encoding. The body is sent
+    as is if compressing it doesn't make it smaller."""
+
+    start = time.monotonic()
+    compressed = zlib.compress(body, service_config.COMPRESSION_LEVEL)
+    elapsed = time.monotonic() - start
+
+    with COMPRESSION_STATS_LOCK:
+        stats = COMPRESSION_STATS[edge]
+        stats['messages'] += 1
+        stats['bytes'] += len(body)
+        stats['compressed_bytes'] += min(len(compressed), len(body))
+        stats['seconds'] += elapsed
+
+    if len(compressed) >= len(body):
+        return body, None
+    return compressed, DEFLATE_ENCODING
+
+
+def _decompress(body:bytes, edge:str) -> bytes:
+    start = time.monotonic()
+    decompressed = zlib.decompress(body)
+    elapsed = time.monotonic() - start
+
+    with COMPRESSION_STATS_LOCK:
+        stats = COMPRESSION_STATS[edge]
+        stats['messages'] += 1
+        stats['bytes'] += len(decompressed)
+        stats['compressed_bytes'] += len(body)
+        stats['seconds'] += elapsed
+
+    return decompressed
+
+
+def compression_stats() -> Dict[str, Dict[str, float]]:
+    """Returns the number of compressed messages, their size before and after
+    compressing them, the compression ratio and the time spent compressing or
+    decompressing them for each edge the worker sends data to or receives data
+    from."""
+
+    with COMPRESSION_STATS_LOCK:
+        return {
+            edge: {**stats, 'ratio': stats['bytes'] / max(stats['compressed_bytes'], 1)}
+            for edge, stats in COMPRESSION_STATS.items()
+        }
+
+
+def _sender_stage(sender:Optional[str]) -> str:
+    """Returns the stage that sent a message given its sender (see
+    `_next_sequence`): either the storage ID of the worker or its stage
+    followed by the lineage of the input."""
+
+    if sender is None:
+        return 'unknown'
+    if '<' in sender:
+        return sender.partition('<')[0]
+    return sender.rpartition('_')[0] or sender
+
+
+def _unpack_payloads(properties:pika.BasicProperties, body:bytes) -> List[Tuple[bytes, Optional[str], int, Optional[str]]]:
+    """Returns the payloads carried in a message, splitting the ones that were
+    coalesced by the publisher, along with their sender, sequence number and
+    content type. The sender is None if the message was not numbered.
+    Compressed messages are decompressed first."""
+
+    headers = properties.headers or {}
+    sender = headers.get(SENDER_HEADER)
+    if isinstance(sender, bytes):
+        sender = sender.decode('utf-8')
+
+    if properties.content_encoding == DEFLATE_ENCODING:
+        body = _decompress(body, edge=serialization.edge_name(_sender_stage(sender), WORKER_TASK))
+
+    content_type = properties.content_type
+    if not content_type or not content_type.startswith(BATCH_CONTENT_TYPE):
+        return [(body, sender, headers.get(SEQ_HEADER, 0), content_type)]
+
+    codec = content_type.partition(';codec=')[2] or None
+
+    payloads, view, offset = [], memoryview(body), 0
+    while offset < len(body):
+        length, = BATCH_LEN.unpack_from(body, offset)
+        offset += BATCH_LEN.size
+        payloads.append(bytes(view[offset:offset + length]))
+        offset += length
+
+    seqs = headers.get(SEQ_HEADER) or [0] * len(payloads)
+    return [(payload, sender, seq, codec) for payload, seq in zip(payloads, seqs)]
+
+
 def build_response_queue(rbmq_address:str, correlation_id:str) -> Tuple[BlockingConnection, BlockingChannel, str, str]:
     """Builds the queue that clients can use to recover the final pipeline
     response once it finishes.
@@ -202,11 +716,30 @@ def consume_response(channel:BlockingChannel, queue_name:str) -> Generator[str,
 
 def send_done(channel:BlockingChannel, worker:str, correlation_id:str):
     """Sends a special package indicating the worker has finished sending all
-    the data."""
+    the data. A package for each worker in the `worker` stage is sent through
+    the same queue as the data, so it's delivered after the data sent before."""
+
+    # the data must be in the queues before the DONE messages are sent,
+    # otherwise the receiver might see them in the wrong order
+    flush_output(channel)
 
+    publisher = _get_publisher(channel)
     num_messages = service_config.WORKERS[worker]
     for i in range(num_messages):
-        send_data(data=f'\x00{WORKER_TASK}_{WORKER_ID}\x1c{i}', channel=channel, worker=worker, shard_key=i, correlation_id=correlation_id)
+        data = f'\x00{WORKER_TASK}_{WORKER_ID}\x1c{i}'.encode('utf-8')
+        exchange, routing_key = (worker, str(i)) if worker in service_config.SHARDED else ('', worker)
+
+        if LOG_MESSAGES:
+            _log_output(data=data, correlation_id=correlation_id, exchange=exchange, routing_key=routing_key)
+
+        publisher.publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=data,
+            properties=pika.BasicProperties(correlation_id=correlation_id, headers={DONE_HEADER: True})
+        )
+
+    publisher.wait_for_confirms()
 
 
 def as_worker(task_callback):
@@ -226,8 +759,8 @@ def as_worker(task_callback):
         # we need to check in case we were sending "DONE" messages and were interrupted
         # to do so, we check if we had already reached the expected number of packages
         # from the previous stage.
-        active_streams = _get_active_streams()
-        for correlation_id, done_messages_received in _load_done_count_from_storage().items():
+        active_streams, done_count = _load_state_from_storage()
+        for correlation_id, done_messages_received in done_count.items():
             print('[RECOVERY] send DONE messages for stream', correlation_id)
             send_done_messages_if_task_is_done(
                 channel=channel,
@@ -248,15 +781,30 @@ def consume_from(
         channel:BlockingChannel,
         worker_name:str,
         remove_duplicates:bool = False,
-        check_as_list=False
-    ) -> Generator[Tuple[str, Union[END_OF_STREAM, bytes]], None, None]:
+        check_as_list=False,
+        row_key:Optional[Callable[[serialization.RecordBatch], List[Hashable]]] = None,
+        decode:bool = False,
+        before_ack:Optional[Callable[[], None]] = None
+    ) -> Generator[Tuple[str, Any], None, None]:
     """Yields messages received from the indicated stage `worker_name` until
-    all "DONE" signals are received."""
-
-    # maps correlation IDs to sets of message hashes
+    all "DONE" signals are received.
+    If `remove_duplicates` is set, the input is stored to be replayed after a
+    crash and the payloads already received from the same sender (see
+    `_next_sequence`) are discarded.
+    If `decode` is set, the payloads are yielded deserialized according to
+    their content type (see `serialization`) instead of as bytes.
+    `check_as_list` is the same, but the payloads must be lists of rows, which
+    are yielded as a `serialization.RecordBatch`. In that case `row_key` may be
+    given to also discard the rows whose key was already received in the
+    stream. It receives the batch and returns the key of each row.
+    `before_ack` is called before acknowledging the processed messages, so
+    workers that process them asynchronously can send their output first."""
+
+    # maps correlation IDs to the sequence numbers received from each sender
     msg_count:Dict[str, int] = defaultdict(int)
-    seen_messages:Dict[str, set] = defaultdict(set)
-    active_streams = _get_active_streams()
+    seen_messages:Dict[str, Dict[str, _SenderSequences]] = defaultdict(dict)
+    seen_rows:Dict[str, Set[Hashable]] = defaultdict(set)
+    active_streams, done_messages_received = _load_state_from_storage()
 
     if worker_name in service_config.SHARDED:
         # sharded stages guarantee that the messages are routed by the worker
@@ -269,42 +817,62 @@ def consume_from(
         # normal stages use a named queue as the routing key
         queue_name = worker_name
 
-    done_messages_received = _load_done_count_from_storage()
+    prefetch_count = service_config.PREFETCH_COUNT.get(worker_name, service_config.DEFAULT_PREFETCH_COUNT)
+    ack_every = service_config.ACK_EVERY.get(worker_name, service_config.DEFAULT_ACK_EVERY)
+    channel.basic_qos(prefetch_count=prefetch_count)
 
     # if we are recovering from an unexpected shutdown and this is a stateful
     # node, we need to replay the stream in order to get consistent results
     if remove_duplicates:
         for correlation_id in active_streams:
             print('replaying stream', correlation_id)
-            for body in _load_stream(correlation_id=correlation_id):
+            for body, sender, seq, content_type in _load_stream(correlation_id=correlation_id):
+                # the log may contain duplicates if a storage node applied an
+                # append twice while recovering, so they are filtered again
+                if not _is_new_payload(seen_set=seen_messages, correlation_id=correlation_id, sender=sender, seq=seq):
+                    continue
+
+                if not body:
+                    # an input that produced no output for this worker
+                    continue
+
+                if decode or check_as_list:
+                    body = serialization.decode(body, content_type)
+
+                if check_as_list:
+                    body = serialization.as_batch(body)
+                    if row_key is not None:
+                        body = _filter_new_rows(rows=body, seen=seen_rows[correlation_id], row_key=row_key)
+                        if not body:
+                            continue
+
                 # make sure to update the message count for the rest of the stream
                 msg_count[correlation_id] += 1
-                if check_as_list:
-                    body = json.loads(body)
-                    for elem in body:
-                        mark_message_as_seen(seen_set=seen_messages, msg=json.dumps(elem).encode('utf-8'), correlation_id=correlation_id)
-                else:
-                    mark_message_as_seen(seen_set=seen_messages, msg=body, correlation_id=correlation_id)
 
                 yield correlation_id, body
 
                 killer.kill_if_applies(stage='during_stream_replay', correlation_id=correlation_id)
 
-    
-    # starts consuming events from the queue
-    for method_frame, properties, body in channel.consume(queue_name, auto_ack=False):
+    inputs = _InputQueues(channel=channel, queue_name=queue_name, control_queue=_control_queue_name(worker=worker_name, worker_id=WORKER_ID))
+    acknowledger = _Acknowledger(channel=channel, ack_every=min(ack_every, prefetch_count), held_tags=inputs.held_tags, before_ack=before_ack)
+
+    # starts consuming events from the queue and from the worker's control queue
+    for method_frame, properties, body, is_control in inputs.consume(on_idle=acknowledger.flush):
         cid = properties.correlation_id
 
-        if LOG_MESSAGES:
-            file_name = f'/logs/{cid}/input/{STORAGE_ID}.txt'
-            if file_name not in LOG_FILES:
-                os.makedirs(os.path.dirname(file_name), exist_ok=True)
-                LOG_FILES[file_name] = open(file_name, 'wb', buffering=0)
+        if is_control or _is_done_message(properties):
+            if LOG_MESSAGES:
+                _log_input(data=body, correlation_id=cid)
+
+            # every message received before the DONE was processed, so we
+            # acknowledge them before handling the end of the stream
+            acknowledger.flush()
 
-            LOG_FILES[file_name].write(body + b'\n')
+            m = DONE_RE.match(body.decode('utf-8'))
+            if _forward_foreign_done(channel=channel, worker_name=worker_name, method_frame=method_frame, m=m, body=body, correlation_id=cid, is_control=is_control):
+                continue
 
-        if m := DONE_RE.match(body.decode('utf-8')):
-            accepted = _handle_done_message(
+            accepted = m and _handle_done_message(
                 m=m,
                 received=done_messages_received,
                 correlation_id=cid,
@@ -314,13 +882,18 @@ def consume_from(
                 if _is_task_done(worker_name, done_messages_received[cid]):
                     # send the EOS message before sending the DONEs because the worker
                     # might send a final package when this message is received
+                    _begin_input(None)
                     yield cid, END_OF_STREAM()
+                    seen_rows.pop(cid, None)
 
+                # the final packages must reach the broker before the new count
+                # is stored, because after that the EOS is not produced again
+                flush_output(channel)
                 _update_done_counter(counters=done_messages_received)
 
-                # once we stored the new count we can acknowledge the DONE
-                # in RBMQ, because the operation to send DONEs will be retried
-                # in case of error
+                # once we stored the new count we can acknowledge the DONE in
+                # RBMQ, because the operation to send DONEs will be retried in
+                # case of error
                 channel.basic_ack(delivery_tag=method_frame.delivery_tag)
 
                 killer.kill_if_applies(stage='before_sending_done', correlation_id=cid)
@@ -335,51 +908,202 @@ def consume_from(
                     active_streams=active_streams
                 )
             else:
-                channel.basic_nack(delivery_tag=method_frame.delivery_tag)
+                # DONE messages are only forwarded to the worker they are meant
+                # for, so this can only be a malformed message. Retrying it won't help
+                print('discarding unexpected control message', cid, body[:120])
+                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
 
             continue
 
         if cid not in active_streams:
             active_streams.add(cid)
             print('new stream detected', cid)
-            _store_active_streams(active_streams)
 
-        if remove_duplicates:
-            if check_as_list:
-                body = json.loads(body)
-                assert isinstance(body, list), type(body)
-                delete_list = []
-                for i, elem in enumerate(body):
-                    if was_msg_seen(seen_set=seen_messages, msg=json.dumps(elem).encode('utf-8'), correlation_id=cid):
-                        delete_list.append(i)
+            # the new stream must be stored before acknowledging its messages
+            PENDING_WRITES.append(_store_active_streams(active_streams, wait=False))
 
-                for delete_count, i in enumerate(delete_list):
-                    del body[i - delete_count]
+        # a single delivery may carry several payloads coalesced by the sender
+        for body, sender, seq, content_type in _unpack_payloads(properties, body):
+            if LOG_MESSAGES:
+                _log_input(data=body, correlation_id=cid)
 
-                if not body:
-                    channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            if remove_duplicates:
+                if not _is_new_payload(seen_set=seen_messages, correlation_id=cid, sender=sender, seq=seq):
                     continue
+
+                # store the message in case we need to replay the stream after a crash
+                store_msg(data=body, correlation_id=cid, sender=sender, seq=seq, content_type=content_type)
             else:
-                if was_msg_seen(seen_set=seen_messages, msg=body, correlation_id=cid):
-                    channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-                    continue
+                # the output is numbered after the input that produced it
+                _begin_input((cid, sender, seq) if sender is not None else None)
+
+            # empty payloads only mark the inputs that produced no output for
+            # this worker (see `_complete_output`)
+            has_data = bool(body)
+
+            if has_data and (decode or check_as_list):
+                body = serialization.decode(body, content_type)
+
+            if has_data and check_as_list:
+                assert isinstance(body, (list, serialization.RecordBatch)), type(body)
+                body = serialization.as_batch(body)
+                if row_key is not None:
+                    body = _filter_new_rows(rows=body, seen=seen_rows[cid], row_key=row_key)
+                    has_data = bool(body)
+
+            if has_data:
+                yield cid, body
+
+                msg_count[cid] += 1
+
+                killer.kill_if_applies(stage='after_msg', correlation_id=cid, msg_count=msg_count[cid])
+
+            if not remove_duplicates and not LINEAGE_TAKEN:
+                _complete_output(channel)
+
+        acknowledger.processed(delivery_tag=method_frame.delivery_tag)
+
+
+def _log_input(data:bytes, correlation_id:str):
+    """Writes an incoming message to the log files of the stream."""
+
+    file_name = f'/logs/{correlation_id}/input/{STORAGE_ID}.txt'
+    if file_name not in LOG_FILES:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        LOG_FILES[file_name] = open(file_name, 'wb', buffering=0)
+
+    LOG_FILES[file_name].write(data + b'\n')
+
+
+class _InputQueues:
+    """Consumes from the input queue and the control queue of the worker at the
+    same time on a single channel. The deliveries of both queues are yielded in
+    the order they were received. A DONE is forwarded to the control queue after
+    the data sent before it was delivered from the input queue, so the data
+    delivered to this worker is always yielded before the DONE."""
+
+    def __init__(self, channel:BlockingChannel, queue_name:str, control_queue:str):
+        self.channel = channel
+        self.queue_name = queue_name
+        self.deliveries = deque()
+
+        channel.basic_consume(
+            queue=queue_name,
+            on_message_callback=lambda ch, method, props, body: self.deliveries.append((method, props, body, False)),
+            auto_ack=False
+        )
+        channel.basic_consume(
+            queue=control_queue,
+            on_message_callback=lambda ch, method, props, body: self.deliveries.append((method, props, body, True)),
+            auto_ack=False
+        )
+
+    def held_tags(self) -> List[int]:
+        """Returns the delivery tags of the DONE messages received but not
+        yielded yet."""
+
+        return [
+            method.delivery_tag
+            for method, props, _, is_control in self.deliveries
+            if is_control or _is_done_message(props)
+        ]
 
-            # store the message in case we need to replay the stream after a crash
-            if check_as_list:
-                store_msg(data=json.dumps(body).encode('utf-8'), correlation_id=cid, id=msg_count[cid])
-                for elem in body:
-                    mark_message_as_seen(seen_set=seen_messages, msg=json.dumps(elem).encode('utf-8'), correlation_id=cid)
+    def consume(self, on_idle:Callable[[], None]) -> Generator[Tuple[pika.spec.Basic.Deliver, pika.BasicProperties, bytes, bool], None, None]:
+        """Yields the method, properties, body and whether the message came from
+        the control queue. `on_idle` is called before blocking to wait for new
+        deliveries."""
+
+        connection = self.channel.connection
+        while True:
+            # dispatch the deliveries already received without blocking
+            connection.process_data_events(time_limit=0)
+
+            if self.deliveries:
+                yield self.deliveries.popleft()
             else:
-                store_msg(data=body, correlation_id=cid, id=msg_count[cid])
-                mark_message_as_seen(seen_set=seen_messages, msg=body, correlation_id=cid)
+                on_idle()
+
+                # block until there are new deliveries
+                connection.process_data_events(time_limit=None)
+
+
+class _Acknowledger:
+    """Acknowledges the processed deliveries in groups of `ack_every` using a
+    single cumulative ack. Before acknowledging, `before_ack` is called, the
+    messages are appended to the stream logs and the output produced while
+    processing them is flushed, so no message is lost if the worker crashes."""
+
+    def __init__(self, channel:BlockingChannel, ack_every:int, held_tags:Callable[[], List[int]], before_ack:Optional[Callable[[], None]] = None):
+        self.channel = channel
+        self.ack_every = ack_every
+        self.held_tags = held_tags
+        self.before_ack = before_ack
+        self.pending:List[int] = []
+
+    def processed(self, delivery_tag:int):
+        """Registers a delivery as processed. It is acknowledged once the group
+        is complete."""
+
+        self.pending.append(delivery_tag)
+        if len(self.pending) >= self.ack_every:
+            self.flush()
+
+    def flush(self):
+        """Acknowledges every delivery registered as processed."""
+
+        if not self.pending:
+            return
+
+        if self.before_ack is not None:
+            self.before_ack()
+
+        flush_stored_msgs()
+        flush_output(self.channel)
+
+        last_tag = max(self.pending)
+        if any(tag < last_tag for tag in self.held_tags()):
+            # a cumulative ack would also acknowledge a DONE message that was
+            # received before but is still waiting to be processed
+            for tag in self.pending:
+                self.channel.basic_ack(delivery_tag=tag)
+        else:
+            self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+
+        self.pending = []
+
+
+def _is_done_message(properties:pika.BasicProperties) -> bool:
+    return bool(properties.headers and properties.headers.get(DONE_HEADER))
+
+
+def _forward_foreign_done(channel:BlockingChannel, worker_name:str, method_frame:pika.spec.Basic.Deliver, m:Optional[re.Match], body:bytes, correlation_id:str, is_control:bool) -> bool:
+    """Forwards a DONE meant for another replica taken from the shared input
+    queue to the control queue of that replica, and acknowledges it. The data
+    sent before it was already delivered, so the replica can handle it as soon
+    as it gets it. The messages of the control queue are always meant for this
+    worker, so they are never forwarded again. Returns whether the message was
+    forwarded."""
+
+    if m is None or is_control or m.group(2) == WORKER_ID:
+        return False
 
-        yield cid, body
+    _forward_done(channel=channel, worker_name=worker_name, target_id=m.group(2), body=body, correlation_id=correlation_id)
+    channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+    return True
 
-        msg_count[cid] += 1
 
-        killer.kill_if_applies(stage='after_msg', correlation_id=cid, msg_count=msg_count[cid])
+def _forward_done(channel:BlockingChannel, worker_name:str, target_id:str, body:bytes, correlation_id:str):
+    """Sends a DONE message to the control queue of the worker it is meant for
+    and waits until the broker stores it."""
 
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+    publisher = _get_publisher(channel)
+    publisher.publish(
+        exchange=CONTROL_EXCHANGE,
+        routing_key=f'{worker_name}_{target_id}',
+        body=body,
+        properties=pika.BasicProperties(correlation_id=correlation_id)
+    )
+    publisher.wait_for_confirms()
 
 
 def _handle_done_message(m:re.Match, received:Dict[str, list], correlation_id:str):
@@ -407,13 +1131,13 @@ def send_done_messages_if_task_is_done(
         worker_name:str,
         correlation_id:str,
         received_ids:List[int],
-        seen_messages:Dict[str, Set[bytes]],
+        seen_messages:Optional[Dict[str, Dict[str, '_SenderSequences']]],
         active_streams:Set[str]
     ) -> bool:
     if _done_messages_sent(correlation_id):
         _delete_stream(correlation_id=correlation_id, active_streams=active_streams)
-        if seen_messages:
-            del seen_messages[correlation_id]
+        if seen_messages is not None:
+            seen_messages.pop(correlation_id, None)
 
         print('DONE messages were already sent, skipping')
         return False
@@ -427,8 +1151,8 @@ def send_done_messages_if_task_is_done(
 
         _mark_done_messages_as_sent(correlation_id=correlation_id)
         _delete_stream(correlation_id=correlation_id, active_streams=active_streams)
-        if seen_messages:
-            del seen_messages[correlation_id]
+        if seen_messages is not None:
+            seen_messages.pop(correlation_id, None)
 
         print('sending DONE messages complete!')
         return True
@@ -446,13 +1170,7 @@ def _is_task_done(worker_name:str, done_messages_received:List[str]):
     return received == WORKERS_TO_WAIT[worker_name]
 
 
-def _load_done_count_from_storage() -> Dict[str, List[str]]:
-    """Load the count about done messages received for each request so far
-    from the distributed storage layer. This is required in case the node id recreated
-    after an unexpected shutdown."""
-
-    data = storage.read(id=STORAGE_ID, key='done_count')
-
+def _parse_done_count(data:Optional[bytes]) -> Dict[str, List[str]]:
     counters:Dict[str, List[str]] = defaultdict(list)
     if data:
         persisted_counters = json.loads(data)
@@ -461,6 +1179,19 @@ def _load_done_count_from_storage() -> Dict[str, List[str]]:
     return counters
 
 
+def _load_state_from_storage() -> Tuple[Set[str], Dict[str, List[str]]]:
+    """Loads from the distributed storage layer the correlation IDs of the
+    client streams that were being processed and the DONE messages received
+    for each one so far. This is required in case the node is recreated after
+    an unexpected shutdown. Both values are read with concurrent requests."""
+
+    active_streams, done_count = storage.gather(
+        storage.read(id=STORAGE_ID, key='correlation_ids', wait=False),
+        storage.read(id=STORAGE_ID, key='done_count', wait=False),
+    )
+    return _parse_active_streams(active_streams), _parse_done_count(done_count)
+
+
 def _update_done_counter(counters:Dict[str, List[int]]):
     """Increments the DONE counter in the persistent storage."""
 
@@ -468,12 +1199,6 @@ def _update_done_counter(counters:Dict[str, List[int]]):
     storage.set(id=STORAGE_ID, key='done_count', value=data)
 
 
-def _delete_stream_from_done_counter(correlation_id:str):
-    counters = _load_done_count_from_storage()
-    counters.pop(correlation_id, None)
-    _update_done_counter(counters=counters)
-
-
 def _done_messages_sent(correlation_id:str) -> bool:
     """Returns whether the DONE messages for the given worker
     and correlation ID were already sent."""
@@ -490,37 +1215,113 @@ def _mark_done_messages_as_sent(correlation_id:str):
     print('finished stream', correlation_id)
 
 
-def mark_message_as_seen(seen_set:Dict[str, set], msg:bytes, correlation_id:str):
-    m = hashlib.sha256()
-    m.update(msg)
-    digest = m.digest()
-    seen_set[correlation_id].add(digest)
+class _SenderSequences:
+    """Sequence numbers received from a sender. Each queue receives the numbers
+    of a sender without gaps (see `_next_sequence`), so the numbers below the
+    first one not received yet are kept as a single value and only the ones
+    above it, received out of order, are kept in a set."""
+
+    __slots__ = ('received_below', 'ahead')
+
+    def __init__(self):
+        self.received_below = 0
+        self.ahead:Set[int] = set()
+
+    def add(self, seq:int) -> bool:
+        """Registers the sequence number. Returns whether it was not received
+        before."""
+
+        if seq < self.received_below or seq in self.ahead:
+            return False
+
+        self.ahead.add(seq)
+        while self.received_below in self.ahead:
+            self.ahead.remove(self.received_below)
+            self.received_below += 1
+
+        return True
+
+
+def _filter_new_rows(rows:serialization.RecordBatch, seen:Set[Hashable], row_key:Callable[[serialization.RecordBatch], List[Hashable]]) -> serialization.RecordBatch:
+    """Returns the rows whose key is not in `seen`, adding their keys."""
+
+    new_rows = []
+    for i, key in enumerate(row_key(rows)):
+        if key not in seen:
+            seen.add(key)
+            new_rows.append(i)
 
+    if len(new_rows) == len(rows):
+        return rows
 
-def was_msg_seen(seen_set:Dict[str, set], msg:bytes, correlation_id:str) -> bool:
-    m = hashlib.sha256()
-    m.update(msg)
-    digest = m.digest()
-    if digest in seen_set[correlation_id]:
-        print('duplicated message detected', correlation_id, digest, msg[:120])
+    print('discarded', len(rows) - len(new_rows), 'duplicated rows')
+    return rows.take(new_rows)
+
+
+def _is_new_payload(seen_set:Dict[str, Dict[str, _SenderSequences]], correlation_id:str, sender:Optional[str], seq:int) -> bool:
+    """Returns whether the payload was not received before, registering it."""
+
+    if sender is None:
+        # messages that are not numbered can't be checked
+        return True
+
+    windows = seen_set[correlation_id]
+    if sender not in windows:
+        windows[sender] = _SenderSequences()
+
+    if windows[sender].add(seq=seq):
         return True
+
+    print('duplicated message detected', correlation_id, sender, seq)
     return False
 
 
-def store_msg(data:bytes, correlation_id:str, id:int):
+def store_msg(data:bytes, correlation_id:str, sender:Optional[str] = None, seq:int = 0, content_type:Optional[str] = None):
     """Function used to store the stream of messages that a particular
-    worker received as input.
-    The `id` must be an unique sequential identifier that starts from 0 and has no
-    gaps."""
+    worker received as input. The messages are appended to the log of the
+    stream in bulk by `flush_stored_msgs`, which must be called before
+    acknowledging them. The sender and sequence number are stored along with
+    the message to detect duplicates after replaying the log, and the content
+    type to decode it."""
+
+    sender_bytes, type_bytes = (sender or '').encode('utf-8'), (content_type or '').encode('utf-8')
+    record = LOG_RECORD_HEADER.pack(seq, len(sender_bytes), len(type_bytes)) + sender_bytes + type_bytes + data
+    PENDING_MSGS[correlation_id].append(record)
+
+
+def flush_stored_msgs():
+    """Appends the messages registered by `store_msg` to the log of each
+    stream and waits for the writes registered in PENDING_WRITES. Raises if
+    any of them failed, so the messages are not acknowledged."""
+
+    # the appends of every stream and the pending writes are sent at once
+    # so the storage processes them concurrently
+    futures = [
+        storage.append(id=STORAGE_ID, stream=_stream_log(correlation_id), records=records, wait=False)
+        for correlation_id, records in PENDING_MSGS.items()
+    ]
+    futures += PENDING_WRITES
+    if not futures:
+        # stateless workers don't store their input
+        return
+
+    PENDING_MSGS.clear()
+    PENDING_WRITES.clear()
 
-    storage.set(id=STORAGE_ID, key=f'{correlation_id}.{id}', value=data)
+    results = storage.gather(*futures)
+    failed = [res for res in results if res["status"] != constants.OK_STATUS]
+    if failed:
+        # the messages would be missing when replaying the stream after a crash
+        raise Exception(f'{len(failed)} of {len(results)} writes to the storage failed: {failed[0].get("message")}')
 
 
-def _get_active_streams() -> Set[str]:
-    """Returns a list of the correlation IDs associated to client streams that
-    were being processed (possibly before an unexpected shutdown)."""
+def _stream_log(correlation_id:str) -> str:
+    """Returns the name of the log that stores the input of a stream."""
 
-    data = storage.read(id=STORAGE_ID, key=f'correlation_ids')
+    return f'{correlation_id}.log'
+
+
+def _parse_active_streams(data:Optional[bytes]) -> Set[str]:
     if data is None:
         return set()
 
@@ -531,33 +1332,33 @@ def _get_active_streams() -> Set[str]:
     return set(ids)
 
 
-def _store_active_streams(active_streams:Set[str]):
+def _store_active_streams(active_streams:Set[str], wait:bool = True):
     """Stores the set of active streams as a list in the storage service."""
 
     streams_list = list(active_streams)
     data = json.dumps(streams_list).encode('utf-8')
-    storage.set(id=STORAGE_ID, key=f'correlation_ids', value=data)
+    return storage.set(id=STORAGE_ID, key=f'correlation_ids', value=data, wait=wait)
 
     
-def _load_stream(correlation_id:str) -> Generator[bytes, None, None]:
+def _load_stream(correlation_id:str) -> Generator[Tuple[bytes, Optional[str], int, Optional[str]], None, None]:
     """Returns a generator that outputs all the messages stored for a particular stream
     (identified by the `correlation_id`) in the original order for the worker calling
-    this function."""
-
-    # read incrementing the message ID until we don't find a message in the storage.
-    # Once we fail to find a value, we can safely assume the stream ended
-    # because there is only one node writing in the same STORAGE_ID at a time
-    id = 0
-    while True:
-        value = storage.read(id=STORAGE_ID, key=f'{correlation_id}.{id}')
-        if value is None:
-            # this means that there is no message associated to this ID, so
-            # the stream finished here
-            print('last ID tried when recovering stream', correlation_id, 'was', id)
-            return
-        
-        yield value
-        id += 1
+    this function, along with their sender, sequence number and content type."""
+
+    # the log is read before replaying it. There is only one node writing in
+    # the same STORAGE_ID at a time, so nothing is appended while we read it.
+    # A failed read raises instead of replaying the stream as empty
+    records = storage.scan(id=STORAGE_ID, stream=_stream_log(correlation_id))
+    print('recovering', len(records), 'messages of stream', correlation_id)
+
+    for record in records:
+        seq, sender_length, type_length = LOG_RECORD_HEADER.unpack_from(record)
+        offset = LOG_RECORD_HEADER.size
+        sender = record[offset:offset + sender_length].decode('utf-8') or None
+        offset += sender_length
+        content_type = record[offset:offset + type_length].decode('utf-8') or None
+        offset += type_length
+        yield record[offset:], sender, seq, content_type
 
 
 def _delete_stream(correlation_id:str, active_streams:Set[str]):
@@ -566,12 +1367,24 @@ def _delete_stream(correlation_id:str, active_streams:Set[str]):
 
     print('[ DELETE ] start', correlation_id)
 
+    futures = []
     if correlation_id in active_streams:
         active_streams.remove(correlation_id)
-        _store_active_streams(active_streams=active_streams)
-    
+        futures.append(_store_active_streams(active_streams=active_streams, wait=False))
+
+    # the stream is no longer active, so it will not be replayed
+    PENDING_MSGS.pop(correlation_id, None)
+    SEQUENCES.pop(correlation_id, None)
+    futures.append(storage.delete(id=STORAGE_ID, key=_stream_log(correlation_id), wait=False))
+
+    # the counter is read while the other requests are processed
+    futures.append(storage.read(id=STORAGE_ID, key='done_count', wait=False))
+    *_, done_count = storage.gather(*futures)
+
     # this should be the last operation because after this is done, the stream
     # will be effectively considered deleted by this worker
-    _delete_stream_from_done_counter(correlation_id=correlation_id)
+    counters = _parse_done_count(done_count)
+    counters.pop(correlation_id, None)
+    _update_done_counter(counters=counters)
 
     print('[ DELETE ] finished', correlation_id)
@@ -4,11 +4,12 @@ client. This is the entrypoint of the pipeline.
 """
 
 import csv
-import json
 import service_config
 
 from io import StringIO
-from typing import List
+from operator import itemgetter
+from typing import Dict, List, Optional
+from serialization import RecordBatch
 from middleware import END_OF_STREAM, consume_from, send_data, as_worker, USE_HASH
 from pika.adapters.blocking_connection import BlockingChannel
 
@@ -18,31 +19,27 @@ def answers_csv_parser_callback(channel:BlockingChannel, worker_id:str):
     """Parses CSV chunks of answers and sends the relevant columns of each row
     to the next stages of the pipeline."""
 
+    # questions and answers related to them must be sent to the same "join"
+    # worker. That is why we use the Id as the sharding key
+    parser = CsvProjection(edges=ANSWERS_EDGES, shard_column='ParentId', shards=service_config.WORKERS['join'])
+
     for correlation_id, body in consume_from(channel, 'answers_csv_parser'):
         if isinstance(body, END_OF_STREAM):
             continue
 
-        # questions and answers related to them must be sent to the same "join"
-        # worker. That is why we use the Id as the sharding key
-        sharded_data = [list() for _ in range(service_config.WORKERS['join'])]
-
-        rows = _csv_parse(body)
+        shards = parser.parse(body)
+        rows = RecordBatch.concat(shards)
 
-        data = json.dumps({'answers': _select_cols(rows, ['OwnerUserId', 'Score'])})
+        data = {'answers': rows.select(ANSWERS_EDGES['score_by_user'])}
         send_data(data, channel=channel, worker='score_by_user', correlation_id=correlation_id, shard_key=USE_HASH)
 
-        data = json.dumps({'answers': _select_cols(rows, ['Body', 'Score'])})
+        data = {'answers': rows.select(ANSWERS_EDGES['filter_by_score'])}
         send_data(data, channel=channel, worker='filter_by_score', correlation_id=correlation_id)
 
-        # collect batches of rows to join to avoid sending too many messages
-        for row in _select_cols(rows, ['Id', 'ParentId', 'CreationDate', 'Score']):
-            shard = int(row['ParentId']) % service_config.WORKERS['join']
-            sharded_data[shard].append(row)
-
-        # regularly flushes data to avoid chunks from getting too big
-        for shard, data in enumerate(sharded_data):
-            if data:
-                send_data(json.dumps({'answers': data}), channel=channel, worker='join', shard_key=shard, correlation_id=correlation_id)
+        for shard, data in enumerate(shards):
+            if len(data):
+                data = {'answers': data.select(ANSWERS_EDGES['join'])}
+                send_data(data, channel=channel, worker='join', shard_key=shard, correlation_id=correlation_id)
 
 
 @as_worker
@@ -50,43 +47,92 @@ def questions_csv_parser_callback(channel:BlockingChannel, worker_id:str):
     """Parses CSV chunks of questions and sends the relevant columns of each
     row to the next stages of the pipeline."""
 
+    parser = CsvProjection(edges=QUESTIONS_EDGES, shard_column='Id', shards=service_config.WORKERS['join'])
+
     for correlation_id, body in consume_from(channel, 'questions_csv_parser'):
         if isinstance(body, END_OF_STREAM):
             continue
 
-        sharded_data = [list() for _ in range(service_config.WORKERS['join'])]
+        shards = parser.parse(body)
+        rows = RecordBatch.concat(shards)
+
+        data = {'questions': rows.select(QUESTIONS_EDGES['score_by_user'])}
+        send_data(data, channel=channel, worker='score_by_user', correlation_id=correlation_id, shard_key=USE_HASH)
+
+        for shard, data in enumerate(shards):
+            if len(data):
+                data = {'questions': data.select(QUESTIONS_EDGES['join'])}
+                send_data(data, channel=channel, worker='join', shard_key=shard, correlation_id=correlation_id)
+
+
+# columns sent by each parser to the next stages
+ANSWERS_EDGES:Dict[str, List[str]] = {
+    'score_by_user': ['OwnerUserId', 'Score'],
+    'filter_by_score': ['Body', 'Score'],
+    'join': ['Id', 'ParentId', 'CreationDate', 'Score'],
+}
+
+QUESTIONS_EDGES:Dict[str, List[str]] = {
+    'score_by_user': ['OwnerUserId', 'Score'],
+    'join': ['Id', 'Tags', 'Score', 'CreationDate'],
+}
+
+
+def _used_columns(edges:Dict[str, List[str]]) -> List[str]:
+    return list(dict.fromkeys(column for columns in edges.values() for column in columns))
+
+
+# columns of the CSV files read by each parser. The client drops the other
+# columns before uploading the files
+REQUIRED_COLUMNS:Dict[str, List[str]] = {
+    'answers_csv_parser': _used_columns(ANSWERS_EDGES),
+    'questions_csv_parser': _used_columns(QUESTIONS_EDGES),
+}
+
+# columns whose values are converted to integers (the rest are kept as strings)
+INT_COLUMNS = {'Id', 'ParentId', 'Score'}
 
-        rows = _csv_parse(body=body)
 
-        data = _select_cols(rows, ['OwnerUserId', 'Score'])
-        json_data = json.dumps({'questions': data})
-        send_data(json_data, channel=channel, worker='score_by_user', correlation_id=correlation_id, shard_key=USE_HASH)
+class CsvProjection:
+    """Parses CSV chunks keeping only the columns sent to any of the `edges`.
+    The rows are read once, taking the needed fields of each one, and are split
+    by the value of `shard_column` as they are read. Missing values are None,
+    as with `csv.DictReader`."""
 
-        # collect batches of rows to join to avoid sending too many messages
-        for row in _select_cols(rows, ['Id', 'Tags', 'Score', 'CreationDate']):
-            shard = int(row['Id']) % service_config.WORKERS['join']
-            sharded_data[shard].append(row)
+    def __init__(self, edges:Dict[str, List[str]], shard_column:str, shards:int):
+        self.columns = _used_columns(edges)
+        self.shard_index = self.columns.index(shard_column)
+        self.shards = shards
 
-        for shard, data in enumerate(sharded_data):
-            if data:
-                send_data(json.dumps({'questions': data}), channel=channel, worker='join', shard_key=shard, correlation_id=correlation_id)
+    def parse(self, body:bytes) -> List[RecordBatch]:
+        """Returns the rows of each shard."""
 
+        reader = csv.reader(StringIO(body.decode('utf-8')))
+        header = next(reader, [])
+        indices = [header.index(column) for column in self.columns]
+        width = max(indices) + 1
+        project = itemgetter(*indices) if len(indices) > 1 else lambda row: (row[indices[0]],)
 
-def _csv_parse(body:bytes):
-    """Parses a CSV from `body` and returns a list of dictionaries for each row."""
+        shards:List[list] = [list() for _ in range(self.shards)]
+        shard_index = self.shard_index
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row += [None] * (width - len(row))
 
-    data = StringIO(body.decode('utf-8'))
-    return list(csv.DictReader(data))
+            values = project(row)
+            shards[int(values[shard_index]) % self.shards].append(values)
 
+        return [self._batch(rows) for rows in shards]
 
-def _select_cols(records:List[dict], cols:List[str]) -> List[dict]:
-    """Return a new list containing dictionaries with only the subset of listed
-    fields in `cols`."""
+    def _batch(self, rows:List[tuple]) -> RecordBatch:
+        columns = zip(*rows) if rows else ([] for _ in self.columns)
+        return RecordBatch({
+            name: list(map(_to_int, values)) if name in INT_COLUMNS else list(values)
+            for name, values in zip(self.columns, columns)
+        }, len(rows))
 
-    def _select_fields(record:dict) -> dict:
-        return {
-            field: record[field]
-            for field in cols
-        }
 
-    return [_select_fields(record) for record in records]
+def _to_int(value:Optional[str]) -> Optional[int]:
+    return int(value) if value else None
@@ -0,0 +1,202 @@
+"""
+State of the `join` stage for a stream. See `pipeline.pipeline_3.join_callback`.
+"""
+
+import os
+import struct
+import sqlite3
+
+from typing import Dict, Iterable, List, Optional
+
+import service_config
+
+
+# each answer waiting for its question is stored as its Id, Score and the
+# length of its CreationDate, followed by the CreationDate
+ANSWER_RECORD = struct.Struct('>qqH')
+
+# approximate memory used by each entry of the in-memory tables, besides the
+# size of the values
+QUESTION_ENTRY_BYTES = 100
+PENDING_ENTRY_BYTES = 200
+TAGS_ENTRY_BYTES = 150
+
+# max number of parameters of a single query
+QUERY_BATCH = 500
+
+
+class JoinStore:
+    """Joins the answers with their questions as they arrive, in any order.
+    The questions are indexed by Id and the answers waiting for their question
+    are indexed by ParentId, so each row only probes the rows it joins with.
+    Joined answers get the `Tags` of their question and are not kept.
+    Only the data needed to join is kept: for each question the id of its
+    interned `Tags`, and for each pending answer a packed record (see
+    `ANSWER_RECORD`). Once the tables use more than `memory_bytes`, they are
+    moved to a SQLite database at `path` and the later lookups also check it."""
+
+    def __init__(self, path:str, memory_bytes:int = service_config.JOIN_MEMORY_BYTES):
+        self.path = path
+        self.memory_bytes = memory_bytes
+
+        self.tag_ids:Dict[str, int] = {}
+        self.tag_names:List[str] = []
+        self.questions:Dict[int, int] = {}
+        self.pending:Dict[int, bytearray] = {}
+
+        self.memory = 0
+        self.pending_count = 0
+        self.spills = 0
+        self.db:Optional[sqlite3.Connection] = None
+
+        # the database of a previous run of the worker is stale, since the
+        # stream is replayed from the start
+        self._remove_db_file()
+
+    def add_questions(self, questions:List[dict]) -> List[dict]:
+        """Returns the new questions and the answers joined with them."""
+
+        ids = [int(question['Id']) for question in questions]
+        spilled = self._pop_spilled_answers(ids) if self.db is not None else {}
+
+        joined = []
+        for question, id in zip(questions, ids):
+            assert id not in self.questions, id
+            tags = question['Tags']
+            self.questions[id] = self._intern(tags)
+            self.memory += QUESTION_ENTRY_BYTES
+            joined.append(question)
+
+            records = self.pending.pop(id, None)
+            if records is not None:
+                self.memory -= PENDING_ENTRY_BYTES + len(records)
+                joined.extend(self._joined_answers(id, records, tags))
+
+            for records in spilled.get(id, []):
+                joined.extend(self._joined_answers(id, records, tags))
+
+        self._check_memory()
+        return joined
+
+    def add_answers(self, answers:List[dict]) -> List[dict]:
+        """Returns the answers whose question was already received, joined
+        with it. The rest wait for their question."""
+
+        parents = [int(answer['ParentId']) for answer in answers]
+        spilled:Dict[int, str] = {}
+        if self.db is not None:
+            spilled = self._spilled_questions({parent for parent in parents if parent not in self.questions})
+
+        joined = []
+        for answer, parent in zip(answers, parents):
+            tag_id = self.questions.get(parent)
+            tags = self.tag_names[tag_id] if tag_id is not None else spilled.get(parent)
+            if tags is not None:
+                joined.append({**answer, 'Tags': tags})
+                continue
+
+            date = answer['CreationDate'].encode('utf-8')
+            record = ANSWER_RECORD.pack(int(answer['Id']), int(answer['Score']), len(date)) + date
+            if parent not in self.pending:
+                self.pending[parent] = bytearray()
+                self.memory += PENDING_ENTRY_BYTES
+            self.pending[parent] += record
+            self.memory += len(record)
+            self.pending_count += 1
+
+        self._check_memory()
+        return joined
+
+    def close(self):
+        """Releases the resources of the store, removing the database."""
+
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        self._remove_db_file()
+
+    def stats(self) -> dict:
+        return {
+            'questions': len(self.questions),
+            'pending_answers': self.pending_count,
+            'memory_bytes': self.memory,
+            'spills': self.spills,
+        }
+
+    def _intern(self, tags:str) -> int:
+        tag_id = self.tag_ids.get(tags)
+        if tag_id is None:
+            tag_id = self.tag_ids[tags] = len(self.tag_names)
+            self.tag_names.append(tags)
+            self.memory += TAGS_ENTRY_BYTES + len(tags)
+        return tag_id
+
+    def _joined_answers(self, parent:int, records:bytes, tags:str) -> List[dict]:
+        answers, offset = [], 0
+        while offset < len(records):
+            id, score, length = ANSWER_RECORD.unpack_from(records, offset)
+            offset += ANSWER_RECORD.size
+            date = records[offset:offset + length].decode('utf-8')
+            offset += length
+
+            answers.append({'Id': id, 'ParentId': parent, 'CreationDate': date, 'Score': score, 'Tags': tags})
+            self.pending_count -= 1
+
+        return answers
+
+    def _check_memory(self):
+        if self.memory > self.memory_bytes:
+            self._spill()
+
+    def _spill(self):
+        """Moves the in-memory tables to the database."""
+
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.path)
+            # the database is rebuilt after a crash, so it doesn't need to be durable
+            self.db.execute('PRAGMA journal_mode = OFF')
+            self.db.execute('PRAGMA synchronous = OFF')
+            self.db.execute('CREATE TABLE questions (id INTEGER PRIMARY KEY, tags TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE pending (parent INTEGER NOT NULL, records BLOB NOT NULL)')
+            self.db.execute('CREATE INDEX pending_parent ON pending (parent)')
+
+        self.db.executemany('INSERT INTO questions VALUES (?, ?)', ((id, self.tag_names[tag_id]) for id, tag_id in self.questions.items()))
+        self.db.executemany('INSERT INTO pending VALUES (?, ?)', ((parent, bytes(records)) for parent, records in self.pending.items()))
+        self.db.commit()
+
+        self.tag_ids, self.tag_names = {}, []
+        self.questions, self.pending = {}, {}
+        self.memory = 0
+        self.spills += 1
+
+    def _spilled_questions(self, ids:Iterable[int]) -> Dict[int, str]:
+        """Returns the tags of the given questions found in the database."""
+
+        found = {}
+        for chunk in _chunks(list(ids)):
+            query = f'SELECT id, tags FROM questions WHERE id IN ({",".join("?" * len(chunk))})'
+            found.update(self.db.execute(query, chunk))
+        return found
+
+    def _pop_spilled_answers(self, parents:List[int]) -> Dict[int, List[bytes]]:
+        """Removes the pending answers of the given questions from the database
+        and returns their records."""
+
+        found:Dict[int, List[bytes]] = {}
+        for chunk in _chunks(parents):
+            placeholders = ",".join("?" * len(chunk))
+            for parent, records in self.db.execute(f'SELECT parent, records FROM pending WHERE parent IN ({placeholders})', chunk):
+                found.setdefault(parent, []).append(records)
+            self.db.execute(f'DELETE FROM pending WHERE parent IN ({placeholders})', chunk)
+        self.db.commit()
+        return found
+
+    def _remove_db_file(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _chunks(values:List[int]) -> Iterable[List[int]]:
+    for i in range(0, len(values), QUERY_BATCH):
+        yield values[i:i + QUERY_BATCH]
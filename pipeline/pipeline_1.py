@@ -9,30 +9,37 @@ import service_config
 
 from typing import Dict
 from collections import defaultdict
-from middleware import as_worker, consume_from, send_data, send_to_client, END_OF_STREAM
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
+from serialization import as_batch
+from middleware import as_worker, consume_from, send_data, send_to_client, input_lineage, output_of, END_OF_STREAM, STORAGE_ID
+from pipeline.sentiment import SentimentEngine, SentimentPool
+from services import liveness_agent, storage
 from pika.adapters.blocking_connection import BlockingChannel
 
 
+# key of the sentiment scores cache of each worker in the storage
+SENTIMENT_CACHE_KEY = 'sentiment_cache'
+
+
 @as_worker
 def filter_by_score_callback(channel:BlockingChannel, worker_id:str):
     """Receives batches of answers, filters them and then redirects the
     remaining ones to the next stages of the pipeline."""
 
     batch_id:Dict[str, int] = defaultdict(int)
-    for correlation_id, body in consume_from(channel, 'filter_by_score'):
+    for correlation_id, body in consume_from(channel, 'filter_by_score', decode=True):
         if isinstance(body, END_OF_STREAM):
             batch_id.pop(correlation_id, None)
             continue
 
-        records = json.loads(body)['answers']
-        filtered = [
-            record for record in records
-            if record['Score'] is not None and int(record['Score']) > 10
+        records = as_batch(body['answers'])
+        selected = [
+            i for i, score in enumerate(records['Score'])
+            if score is not None and int(score) > 10
         ]
 
-        if filtered:
-            send_data(json.dumps(filtered), channel=channel, worker='filter_by_sentiment_analysis', correlation_id=correlation_id)
+        if selected:
+            filtered = records.select(['Body', 'Score']).take(selected)
+            send_data(filtered, channel=channel, worker='filter_by_sentiment_analysis', correlation_id=correlation_id)
             send_data(
                 # include batch ID so the next stage can detect duplicates
                 json.dumps({'id': f'{worker_id}_{batch_id[correlation_id]}', 'denominator': len(filtered)}),
@@ -48,30 +55,62 @@ def filter_by_score_callback(channel:BlockingChannel, worker_id:str):
 def filter_by_sentiment_analysis_callback(channel:BlockingChannel, worker_id:str):
     """Applies sentiment analysis to the batch of answers received and filters
     the ones with negative value. The count of the remaining answers is sent to
-    the last stage that calculates the percentage."""
+    the last stage that calculates the percentage.
+    The scores are cached (see `pipeline.sentiment`) and the cache is stored
+    regularly, so the answers received again after a crash are not scored
+    again.
+    The batches are scored in a pool of `service_config.SENTIMENT_PROCESSES`
+    processes while the next ones are received. The counts are sent in the
+    order the batches were received, and every pending batch is finished
+    before acknowledging the input."""
 
     batch_id:Dict[str, int] = defaultdict(int)
-    analyzer = SentimentIntensityAnalyzer()
-    for correlation_id, body in consume_from(channel, 'filter_by_sentiment_analysis'):
+    engine = SentimentEngine()
+    engine.load(storage.read(id=STORAGE_ID, key=SENTIMENT_CACHE_KEY) or b'')
+    liveness_agent.register_status_provider('sentiment_cache', engine.stats)
+
+    pool = SentimentPool(engine, processes=service_config.SENTIMENT_PROCESSES)
+
+    def _wait():
+        # keeps servicing the connection (heartbeats, confirms and deliveries)
+        # while the pool scores the batches
+        channel.connection.process_data_events(time_limit=service_config.SENTIMENT_POLL_INTERVAL)
+
+    def _send_count(context, scores):
+        correlation_id, lineage = context
+        negative = sum(1 for score in scores if score < 0)
+        with output_of(channel, lineage):
+            if negative:
+                send_data(
+                    # include batch ID so the next stage can detect duplicates
+                    json.dumps({'id': f'{worker_id}_{batch_id[correlation_id]}', 'numerator': negative}),
+                    channel=channel,
+                    worker='calculate_percentage',
+                    correlation_id=correlation_id,
+                    shard_key=batch_id[correlation_id]
+                )
+                batch_id[correlation_id] += 1
+
+    def _send_pending():
+        for context, scores in pool.drain(wait=_wait):
+            _send_count(context, scores)
+
+    for correlation_id, body in consume_from(channel, 'filter_by_sentiment_analysis', decode=True, before_ack=_send_pending):
         if isinstance(body, END_OF_STREAM):
+            _send_pending()
             batch_id.pop(correlation_id, None)
+            if engine.added:
+                storage.set(id=STORAGE_ID, key=SENTIMENT_CACHE_KEY, value=engine.dump())
             continue
 
-        records = json.loads(body)
-        filtered = [
-            record for record in records
-            if analyzer.polarity_scores(record['Body'])['compound'] < 0
-        ]
-        if filtered:
-            send_data(
-                # include batch ID so the next stage can detect duplicates
-                json.dumps({'id': f'{worker_id}_{batch_id[correlation_id]}', 'numerator': len(filtered)}),
-                channel=channel,
-                worker='calculate_percentage',
-                correlation_id=correlation_id,
-                shard_key=batch_id[correlation_id]
-            )
-            batch_id[correlation_id] += 1
+        records = as_batch(body)
+        pool.submit(records['Body'], context=(correlation_id, input_lineage()))
+
+        for context, scores in pool.completed(wait=_wait):
+            _send_count(context, scores)
+
+        if engine.added >= service_config.SENTIMENT_CACHE_PERSIST_EVERY:
+            storage.set(id=STORAGE_ID, key=SENTIMENT_CACHE_KEY, value=engine.dump())
 
 
 @as_worker
@@ -7,6 +7,7 @@ and answer scores.
 import json
 from typing import Dict
 
+from serialization import as_batch
 from middleware import as_worker, consume_from, send_to_client, send_data, END_OF_STREAM
 from collections import defaultdict
 from pika.adapters.blocking_connection import BlockingChannel
@@ -28,7 +29,7 @@ def score_by_user_callback(channel:BlockingChannel, worker_id:str):
 
     batch_id:Dict[str, int] = defaultdict(int)
     score_by_user = defaultdict(lambda: defaultdict(_default))
-    for correlation_id, body in consume_from(channel, 'score_by_user', remove_duplicates=True):
+    for correlation_id, body in consume_from(channel, 'score_by_user', remove_duplicates=True, decode=True):
         if isinstance(body, END_OF_STREAM):
             data = json.dumps(score_by_user[correlation_id])
             send_data(
@@ -43,7 +44,7 @@ def score_by_user_callback(channel:BlockingChannel, worker_id:str):
             batch_id.pop(correlation_id, None)
             continue
 
-        data = json.loads(body)
+        data = body
         if 'answers' in data:
             type = 'answers'
         elif 'questions' in data:
@@ -51,10 +52,12 @@ def score_by_user_callback(channel:BlockingChannel, worker_id:str):
         else:
             assert False, f'Unexpected message {data}'[:120]
 
-        for record in data[type]:
-            user_id = record['OwnerUserId']
-            score_by_user[correlation_id][user_id][type]['score'] += int(record['Score'])
-            score_by_user[correlation_id][user_id][type]['count'] += 1
+        rows = as_batch(data[type])
+        users = score_by_user[correlation_id]
+        for user_id, score in zip(rows['OwnerUserId'], rows['Score']):
+            stats = users[user_id][type]
+            stats['score'] += int(score)
+            stats['count'] += 1
 
 
 @as_worker
@@ -3,12 +3,16 @@ This file contains the tasks that solve the third item required:
 Top 10 of tags by total score for each year.
 """
 
+import os
 import json
 import service_config
 
-from typing import Dict
-from middleware import END_OF_STREAM, USE_HASH, as_worker, consume_from, send_to_client, send_data
+from typing import Dict, Hashable, Iterable, List
+from serialization import RecordBatch
+from middleware import END_OF_STREAM, USE_HASH, STORAGE_ID, as_worker, consume_from, send_to_client, send_data
 from collections import defaultdict
+from pipeline.join import JoinStore
+from services import liveness_agent
 from pika.adapters.blocking_connection import BlockingChannel
 
 
@@ -18,54 +22,75 @@ def join_callback(channel:BlockingChannel, worker_id:str):
     matching question (by ParentID) and yields a new record also containing the
     tags from the question. The rows are sharded by the CSV parser using the
     'ParentID' for the answers an the 'Id' for the questions, so we make sure
-    that every answer is matched to the correspnding question."""
+    that every answer is matched to the correspnding question.
+    The state of each stream is kept in a `JoinStore`, which moves it to disk
+    once it uses more than `service_config.JOIN_MEMORY_BYTES`.
+    If `service_config.JOIN_COMBINER` is set, the joined rows are not sent.
+    Their scores are summed by year and tag instead, and the sums are sent as
+    partial rows every `service_config.JOIN_COMBINER_FLUSH_ROWS` joined rows and
+    at the end of the stream."""
+
+    from collections import Counter
 
     batch_id:Dict[str, int] = defaultdict(int)
-    questions, answers = defaultdict(dict), defaultdict(dict)
-    for correlation_id, body in consume_from(channel, 'join', remove_duplicates=True):
+    joins:Dict[str, JoinStore] = {}
+    combined, combined_rows = defaultdict(lambda: defaultdict(Counter)), defaultdict(int)
+
+    def send_partials(correlation_id:str):
+        # include batch ID so the next stage can detect duplicates
+        rows = [
+            {'Batch': f'{worker_id}_{batch_id[correlation_id]}', 'Year': year, 'Tag': tag, 'Score': score}
+            for year, tag_scores in combined[correlation_id].items()
+            for tag, score in tag_scores.items()
+        ]
+        if rows:
+            send_data(json.dumps(rows), channel=channel, worker='score_by_tag_and_year', correlation_id=correlation_id, shard_key=batch_id[correlation_id])
+            batch_id[correlation_id] += 1
+        combined.pop(correlation_id, None)
+        combined_rows.pop(correlation_id, None)
+
+    liveness_agent.register_status_provider('join', lambda: {cid: join.stats() for cid, join in list(joins.items())})
+
+    for correlation_id, body in consume_from(channel, 'join', remove_duplicates=True, decode=True):
         if isinstance(body, END_OF_STREAM):
-            questions.pop(correlation_id, None)
-            answers.pop(correlation_id, None)
+            if service_config.JOIN_COMBINER:
+                send_partials(correlation_id)
+            if correlation_id in joins:
+                joins.pop(correlation_id).close()
             batch_id.pop(correlation_id, None)
             continue
-            
-        batch = []
-        
-        data = json.loads(body)
+
+        if correlation_id not in joins:
+            path = os.path.join(service_config.JOIN_SPILL_DIR, f'{STORAGE_ID}_{correlation_id}.sqlite')
+            joins[correlation_id] = JoinStore(path=path)
+
+        data = body
         if 'questions' in data:
-            # we yield each new question received to the next stage
+            # we yield each new question received to the next stage, along
+            # with the answers that were waiting for it
             for question in data['questions']:
                 assert int(question['Id']) % service_config.WORKERS['join'] == int(worker_id), (question, worker_id, service_config.WORKERS['join'])
-                assert question['Id'] not in questions[correlation_id], question['Id']
-                questions[correlation_id][question['Id']] = question
-                batch.append(question)
+            batch = joins[correlation_id].add_questions(data['questions'])
         elif 'answers' in data:
-            # register the new answer in case we didn't receive the corresponding
-            # question yet
+            # the answers whose question was not received yet are kept until
+            # it arrives
             for answer in data['answers']:
                 assert int(answer['ParentId']) % service_config.WORKERS['join'] == int(worker_id), (answer, worker_id, service_config.WORKERS['join'])
-                assert answer['Id'] not in answers[correlation_id], answer['Id']
-                answers[correlation_id][answer['Id']] = answer
+            batch = joins[correlation_id].add_answers(data['answers'])
         else:
             assert False, f'unexpected message "{data}"'[:120]  # truncate the message in case is too large
 
-        # find the answers of which we already have the matching question
-        # and make the join
-        for answer in answers[correlation_id].values():
-            if question := questions[correlation_id].get(answer['ParentId']):
-                answer['Tags'] = question['Tags']
-                batch.append(answer)
-
-        # remove the joined answers from the cache because we don't need them
-        # anymore
-        for joined in batch:
-            if parent_id := joined.get('ParentId'):
-                del answers[correlation_id][joined['Id']]
-
-        if batch:
+        if batch and service_config.JOIN_COMBINER:
+            # the rows are replayed in the same order after a crash, so the
+            # partial sums are sent with the same batch IDs
+            _add_scores(combined[correlation_id], (row['CreationDate'] for row in batch), (row['Tags'] for row in batch), (row['Score'] for row in batch))
+            combined_rows[correlation_id] += len(batch)
+            if combined_rows[correlation_id] >= service_config.JOIN_COMBINER_FLUSH_ROWS:
+                send_partials(correlation_id)
+        elif batch:
             # send the new processed batch
             send_data(
-                json.dumps(batch),
+                batch,
                 channel=channel,
                 worker='score_by_tag_and_year',
                 correlation_id=correlation_id,
@@ -84,7 +109,7 @@ def score_by_tag_and_year_callback(channel:BlockingChannel, worker_id:str):
 
     batch_id:Dict[str, int] = defaultdict(int)
     received, tags_per_year = defaultdict(int), defaultdict(lambda: defaultdict(Counter))
-    for correlation_id, body in consume_from(channel, 'score_by_tag_and_year', remove_duplicates=True, check_as_list=True):
+    for correlation_id, body in consume_from(channel, 'score_by_tag_and_year', remove_duplicates=True, check_as_list=True, row_key=_joined_row_keys):
         if isinstance(body, END_OF_STREAM):
             # flush remaining data
             data = {
@@ -99,13 +124,14 @@ def score_by_tag_and_year_callback(channel:BlockingChannel, worker_id:str):
             batch_id.pop(correlation_id, None)
             continue
 
-        # body is already parsed 
-        for row in body:
-            year = row['CreationDate'][:4]
+        # body is already parsed as columns
+        if 'Batch' in body.columns:
+            # partial sums by year and tag from a join worker in combiner mode
+            for year, tag, score in zip(body['Year'], body['Tag'], body['Score']):
+                tags_per_year[correlation_id][year][tag] += score
+        else:
+            _add_scores(tags_per_year[correlation_id], body['CreationDate'], body['Tags'], body['Score'])
 
-            tags = {tag: int(row['Score']) for tag in row['Tags'].split(' ')}
-            tags_per_year[correlation_id][year].update(tags)
-            
         received[correlation_id] += len(body)
         if received[correlation_id] > 500:
             # once we accumulated a sufficiently large batch, we pass it to the
@@ -121,6 +147,28 @@ def score_by_tag_and_year_callback(channel:BlockingChannel, worker_id:str):
             batch_id[correlation_id] += 1
 
 
+def _add_scores(tags_per_year:Dict[str, Dict[str, int]], dates:Iterable[str], tags:Iterable[str], scores:Iterable[int]):
+    """Adds the score of each joined row to its tags in the year of the row."""
+
+    for date, row_tags, score in zip(dates, tags, scores):
+        score = int(score)
+        tags_per_year[date[:4]].update({tag: score for tag in row_tags.split(' ')})
+
+
+def _joined_row_keys(batch:RecordBatch) -> List[Hashable]:
+    """Identifies the rows sent by the join stage. Questions and answers come
+    from different files, so the questions are mapped to negative keys to avoid clashes.
+    Partial sums are identified by their batch, year and tag."""
+
+    if 'Batch' in batch.columns:
+        return list(zip(batch['Batch'], batch['Year'], batch['Tag']))
+
+    return [
+        int(id) if parent_id is not None else -int(id) - 1
+        for id, parent_id in zip(batch['Id'], batch['ParentId'])
+    ]
+
+
 @as_worker
 def top_10_tags_callback(channel:BlockingChannel, worker_id:str):
     """Collects the aggregated data batches and calculates the final values.
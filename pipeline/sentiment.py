@@ -0,0 +1,209 @@
+"""
+Sentiment analysis of the answer bodies used by the
+`filter_by_sentiment_analysis` stage.
+
+The bodies are HTML, so the markup and the code blocks are removed before
+scoring them with VADER. The compound score of each body is cached by the hash
+of its content, so the bodies received again (e.g. when a stream is delivered
+again after a crash) are not scored twice. The cache can be dumped to bytes to
+persist it in the storage service.
+The bodies that are not cached can be scored in a pool of processes (see
+`SentimentPool`).
+"""
+
+import re
+import html
+import struct
+import hashlib
+import multiprocessing
+
+from collections import OrderedDict, deque
+from typing import Any, Callable, Generator, List, Optional, Tuple
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+import service_config
+
+
+# code blocks are removed with their content, the rest of the tags are replaced
+# by a space
+CODE_RE = re.compile(r'<(pre|code)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r'<[^>]*>')
+
+# each entry of a dumped cache is the hash of the body and its score
+CACHE_ENTRY = struct.Struct('>8sd')
+
+
+def strip_markup(body:str) -> str:
+    """Returns the text of an HTML body without the tags and code blocks."""
+
+    if '<' not in body:
+        return html.unescape(body)
+
+    text = CODE_RE.sub(' ', body)
+    text = TAG_RE.sub(' ', text)
+    return html.unescape(text)
+
+
+def content_hash(body:str) -> bytes:
+    return hashlib.blake2b(body.encode('utf-8'), digest_size=8).digest()
+
+
+def polarity(bodies:List[str], analyzer:SentimentIntensityAnalyzer) -> List[float]:
+    """Returns the compound score of each body, without caching them."""
+
+    return [analyzer.polarity_scores(strip_markup(body))['compound'] for body in bodies]
+
+
+class SentimentEngine:
+    """Scores batches of bodies keeping the scores of the last `max_entries`
+    distinct bodies in a LRU cache."""
+
+    def __init__(self, max_entries:int = service_config.SENTIMENT_CACHE_ENTRIES, analyzer:Optional[SentimentIntensityAnalyzer] = None):
+        self.analyzer = analyzer or SentimentIntensityAnalyzer()
+        self.max_entries = max_entries
+        self.cache:OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        # entries added since the cache was last dumped
+        self.added = 0
+
+    def score(self, bodies:List[str]) -> List[float]:
+        """Returns the compound score of each body."""
+
+        keys, scores = self.cached(bodies)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            computed = polarity([bodies[i] for i in missing], self.analyzer)
+            self.fill(keys, scores, missing, computed)
+
+        return scores
+
+    def cached(self, bodies:List[str]) -> Tuple[List[bytes], List[Optional[float]]]:
+        """Returns the key of each body and its cached score, or None if it is
+        not cached."""
+
+        keys = [content_hash(body) for body in bodies]
+        scores = []
+        for key in keys:
+            score = self.cache.get(key)
+            if score is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.cache.move_to_end(key)
+            scores.append(score)
+
+        return keys, scores
+
+    def fill(self, keys:List[bytes], scores:List[Optional[float]], missing:List[int], computed:List[float]):
+        """Sets the scores computed for the `missing` positions and caches them."""
+
+        for i, score in zip(missing, computed):
+            scores[i] = score
+            self._put(keys[i], score)
+
+    def dump(self) -> bytes:
+        """Returns the cached scores, from the least to the most recently used."""
+
+        self.added = 0
+        return b''.join(CACHE_ENTRY.pack(key, score) for key, score in self.cache.items())
+
+    def load(self, data:bytes):
+        """Adds the scores dumped by `dump` to the cache."""
+
+        for key, score in CACHE_ENTRY.iter_unpack(data[:len(data) - len(data) % CACHE_ENTRY.size]):
+            self._put(key, score)
+        self.added = 0
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.cache),
+        }
+
+    def _put(self, key:bytes, score:float):
+        self.cache[key] = score
+        self.cache.move_to_end(key)
+        self.added += 1
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+
+# analyzer of each process of the pool, created when the process starts so the
+# lexicon is loaded once
+_PROCESS_ANALYZER:Optional[SentimentIntensityAnalyzer] = None
+
+
+def _init_process():
+    global _PROCESS_ANALYZER
+    _PROCESS_ANALYZER = SentimentIntensityAnalyzer()
+
+
+def _score_in_process(bodies:List[str]) -> List[float]:
+    return polarity(bodies, _PROCESS_ANALYZER)
+
+
+class SentimentPool:
+    """Scores batches of bodies in a pool of `processes` processes. The cache
+    of the `engine` is used in the calling process, so only the bodies not
+    cached are sent to the pool. The results are returned in the order the
+    batches were submitted, along with the `context` given for each batch.
+    With no processes the batches are scored in the calling process."""
+
+    def __init__(self, engine:SentimentEngine, processes:int):
+        self.engine = engine
+        # the worker already has a connection and several threads running, so
+        # the processes are not forked from it (a thread could hold a lock
+        # that would never be released in the child)
+        context = multiprocessing.get_context('forkserver')
+        self.pool = context.Pool(processes, initializer=_init_process) if processes > 0 else None
+        self.max_pending = 2 * processes
+
+        # submitted batches in order: context, keys, scores, positions not
+        # cached and the pending result of the pool
+        self.pending:deque = deque()
+
+    def submit(self, bodies:List[str], context:Any):
+        keys, scores = self.engine.cached(bodies)
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        result = None
+        if missing and self.pool is not None:
+            result = self.pool.apply_async(_score_in_process, ([bodies[i] for i in missing],))
+        elif missing:
+            self.engine.fill(keys, scores, missing, polarity([bodies[i] for i in missing], self.engine.analyzer))
+            missing = []
+
+        self.pending.append((context, keys, scores, missing, result))
+
+    def completed(self, wait:Callable[[], None]) -> Generator[Tuple[Any, List[float]], None, None]:
+        """Yields the context and scores of the batches already scored, in
+        order. Stops at the first one that is still being scored, unless there
+        are too many batches pending. `wait` is called while waiting for it."""
+
+        while self.pending:
+            result = self.pending[0][4]
+            if result is not None and not result.ready():
+                if len(self.pending) <= self.max_pending:
+                    return
+                while not result.ready():
+                    wait()
+            yield self._pop()
+
+    def drain(self, wait:Callable[[], None]) -> Generator[Tuple[Any, List[float]], None, None]:
+        """Yields the context and scores of every batch submitted, in order.
+        `wait` is called while the first pending batch is being scored."""
+
+        while self.pending:
+            result = self.pending[0][4]
+            while result is not None and not result.ready():
+                wait()
+            yield self._pop()
+
+    def _pop(self) -> Tuple[Any, List[float]]:
+        context, keys, scores, missing, result = self.pending.popleft()
+        if result is not None:
+            self.engine.fill(keys, scores, missing, result.get())
+        return context, scores
@@ -0,0 +1,236 @@
+"""
+Codecs used to serialize the data sent between the stages of the pipeline.
+
+By default the data is sent as JSON. The edges of the DAG listed in
+`service_config.EDGE_SCHEMAS` use a compact binary encoding instead, where the
+rows are stored by column: integers are packed as 8 bytes values and strings
+are stored as a single UTF-8 blob along with their lengths, so the field names
+are never repeated.
+
+The codec of each payload is indicated in the message content type, so the
+receiving stage can decode payloads in any of the formats and the edges can be
+migrated one at a time.
+
+Rows can also be sent and received as a `RecordBatch`, which keeps a list of
+values for each column instead of a dict for each row.
+"""
+
+import sys
+import json
+
+from array import array
+from itertools import accumulate, chain
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import service_config
+
+
+PACKED_CONTENT_TYPE = 'application/x-packed'
+
+# row count, number of values of an optional field and lengths of strings
+COUNT_TYPECODE = 'I'
+INT_TYPECODE = 'q'
+
+# the values are stored as little endian regardless of the platform
+SWAP_BYTES = sys.byteorder != 'little'
+
+FIELD_TYPES = ('int', 'str', 'int?', 'str?')
+
+
+class RecordBatch:
+    """Rows stored by column. `batch['Score']` returns the list of values of
+    the column. Missing columns are considered to be None for every row."""
+
+    def __init__(self, columns:Dict[str, list], length:Optional[int] = None):
+        self.columns = columns
+        self.length = length if length is not None else len(next(iter(columns.values()), []))
+
+    @classmethod
+    def from_rows(cls, rows:List[dict]) -> 'RecordBatch':
+        fields = dict.fromkeys(field for row in rows for field in row)
+        return cls({field: [row.get(field) for row in rows] for field in fields}, len(rows))
+
+    @classmethod
+    def concat(cls, batches:List['RecordBatch']) -> 'RecordBatch':
+        """Returns a batch with the rows of all the `batches`, which must have
+        the same columns."""
+        if not batches:
+            return cls({}, 0)
+        return cls({
+            field: list(chain.from_iterable(batch[field] for batch in batches))
+            for field in batches[0].columns
+        }, sum(len(batch) for batch in batches))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, field:str) -> list:
+        if field not in self.columns:
+            return [None] * self.length
+        return self.columns[field]
+
+    def select(self, fields:List[str]) -> 'RecordBatch':
+        """Returns a batch with only the given columns. The lists are shared."""
+        return RecordBatch({field: self[field] for field in fields}, self.length)
+
+    def take(self, indices:List[int]) -> 'RecordBatch':
+        """Returns a batch with the rows in the given positions."""
+        return RecordBatch({field: [values[i] for i in indices] for field, values in self.columns.items()}, len(indices))
+
+    def to_rows(self) -> List[dict]:
+        fields = list(self.columns)
+        return [dict(zip(fields, values)) for values in zip(*self.columns.values())] if fields else [{} for _ in range(self.length)]
+
+
+def as_batch(data:Union[RecordBatch, List[dict]]) -> RecordBatch:
+    """Returns the rows as a `RecordBatch`, converting them if they were
+    received as a list of dicts (i.e. through an edge that uses JSON)."""
+
+    if isinstance(data, RecordBatch):
+        return data
+    return RecordBatch.from_rows(data)
+
+
+class PackedCodec:
+    """Encodes lists of rows (dicts or a `RecordBatch`) with the fields defined
+    in `fields`. If `table` is set, the encoded data is a dict with the rows in
+    the `table` key (e.g. `{'answers': [...]}`). Fields whose type ends with `?`
+    may be None. If `batch` is set, the rows are decoded as a `RecordBatch`."""
+
+    def __init__(self, name:str, table:Optional[str], fields:Dict[str, str], batch:bool = False):
+        for field, type in fields.items():
+            assert type in FIELD_TYPES, f'unknown type {type} of field {field} in schema {name}'
+
+        self.name = name
+        self.table = table
+        self.fields = list(fields.items())
+        self.batch = batch
+        self.content_type = f'{PACKED_CONTENT_TYPE};schema={name}'
+
+    def encode(self, data:Any) -> bytes:
+        rows = data[self.table] if self.table is not None else data
+
+        chunks = [_pack(COUNT_TYPECODE, [len(rows)])]
+        for field, type in self.fields:
+            if isinstance(rows, RecordBatch):
+                values = rows[field]
+            else:
+                values = [row.get(field) for row in rows]
+
+            if type.endswith('?'):
+                present = bytes(value is not None for value in values)
+                chunks.append(present)
+                values = [value for value in values if value is not None]
+                type = type[:-1]
+
+            if type == 'int':
+                chunks.append(_pack(INT_TYPECODE, [int(value) for value in values]))
+            else:
+                # the lengths are in characters, so the blob is decoded at once
+                # and then sliced
+                chunks.append(_pack(COUNT_TYPECODE, [len(value) for value in values]))
+                blob = ''.join(values).encode('utf-8')
+                chunks.append(_pack(COUNT_TYPECODE, [len(blob)]))
+                chunks.append(blob)
+
+        return b''.join(chunks)
+
+    def decode(self, data:bytes) -> Any:
+        view = memoryview(data)
+        (count,), offset = _unpack(COUNT_TYPECODE, view, 0, 1)
+
+        columns = []
+        for _, type in self.fields:
+            present = None
+            n = count
+            if type.endswith('?'):
+                present = view[offset:offset + count]
+                offset += count
+                n = sum(present)
+                type = type[:-1]
+
+            if type == 'int':
+                values, offset = _unpack(INT_TYPECODE, view, offset, n)
+            else:
+                lengths, offset = _unpack(COUNT_TYPECODE, view, offset, n)
+                (size,), offset = _unpack(COUNT_TYPECODE, view, offset, 1)
+                blob = str(view[offset:offset + size], 'utf-8')
+                offset += size
+
+                ends = list(accumulate(lengths))
+                values = [blob[end - length:end] for end, length in zip(ends, lengths)]
+
+            if present is not None:
+                it = iter(values)
+                values = [next(it) if flag else None for flag in present]
+
+            columns.append(values)
+
+        names = [field for field, _ in self.fields]
+        if self.batch:
+            rows = RecordBatch(dict(zip(names, columns)), count)
+        else:
+            rows = [dict(zip(names, values)) for values in zip(*columns)]
+        return {self.table: rows} if self.table is not None else rows
+
+
+def _pack(typecode:str, values:List[int]) -> bytes:
+    values = array(typecode, values)
+    if SWAP_BYTES:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpack(typecode:str, view:memoryview, offset:int, count:int) -> Tuple[List[int], int]:
+    values = array(typecode)
+    end = offset + count * values.itemsize
+    values.frombytes(view[offset:end])
+    if SWAP_BYTES:
+        values.byteswap()
+    return values.tolist(), end
+
+
+def edge_name(sender:str, receiver:str) -> str:
+    return f'{sender}>{receiver}'
+
+
+# codecs of the edges listed in the config by edge name
+CODECS:Dict[str, PackedCodec] = {
+    edge_name(sender, receiver): PackedCodec(
+        name=edge_name(sender, receiver),
+        table=schema.get('table'),
+        fields=schema['fields'],
+        batch=schema.get('batch', False)
+    )
+    for (sender, receiver), schema in service_config.EDGE_SCHEMAS.items()
+}
+
+
+def encode(data:Any, sender:str, receiver:str) -> Tuple[bytes, Optional[str]]:
+    """Serializes the data sent from the `sender` stage to the `receiver`.
+    Returns the payload and its content type (None for JSON)."""
+
+    codec = CODECS.get(edge_name(sender, receiver))
+    if codec is None:
+        return json.dumps(data, default=_to_json).encode('utf-8'), None
+
+    return codec.encode(data), codec.content_type
+
+
+def _to_json(value:Any) -> Any:
+    if isinstance(value, RecordBatch):
+        return value.to_rows()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def decode(data:bytes, content_type:Optional[str]) -> Any:
+    """Deserializes a payload given its content type."""
+
+    if not content_type:
+        return json.loads(data)
+
+    mime, _, params = content_type.partition(';')
+    assert mime == PACKED_CONTENT_TYPE, f'unknown content type {content_type}'
+
+    name = params.partition('schema=')[2]
+    return CODECS[name].decode(data)
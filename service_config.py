@@ -82,9 +82,174 @@ LIBRARIANS=[
     },
 ]
 
+# replication settings of the storage (see `babel_library_client.borges.Borges`).
+# Writes are sent to every librarian and return once STORAGE_WRITE_QUORUM of
+# them answered. Reads are sent to STORAGE_READ_QUORUM librarians and return
+# once that many of them agree. With 3 librarians, R + W > N makes every read
+# reach at least one librarian with the last write, and if the ones read
+# disagree the read is sent to the third one and the majority wins. Each read
+# is executed by 2 of the 3 librarians instead of all of them, so the load of
+# the reads on the storage drops by about 1.5x (reading from a single librarian
+# would drop it by 3x, but its quorum would not overlap the one of the writes).
+# A read is also sent to the next librarian if it takes longer than the
+# STORAGE_HEDGE_PERCENTILE of the recent read latencies (and at least
+# STORAGE_HEDGE_MIN_DELAY seconds), so the third librarian is asked for about
+# 1% of the reads
+STORAGE_WRITE_QUORUM = 2
+STORAGE_READ_QUORUM = 2
+STORAGE_HEDGE_PERCENTILE = 99
+STORAGE_HEDGE_MIN_DELAY = 0.05
+
+# storage engine of the librarians: 'files' stores each key in its own file and
+# 'log' appends the writes to segment files of up to STORAGE_SEGMENT_BYTES,
+# merging them in the background once there are STORAGE_COMPACTION_SEGMENTS
+# closed segments (see `babel_library.log_structured_library`)
+STORAGE_ENGINE = 'files'
+STORAGE_SEGMENT_BYTES = 64*1024*1024
+STORAGE_COMPACTION_SEGMENTS = 4
+
+# size in bytes of the cache of recently read values of each librarian (0 disables it)
+STORAGE_CACHE_BYTES = 32*1024*1024
+
+# bytes of a log read with each request when it's scanned (see `services.storage.scan`)
+STORAGE_SCAN_CHUNK_BYTES = 4*1024*1024
+
+# number of streams retrieved with each request when a librarian recovers the
+# streams that differ from the rest of the cluster
+STORAGE_RECOVERY_BATCH_SIZE = 256
+
+# seconds to wait for each request sent while recovering. Computing the digests
+# or reading a batch of streams may take much longer than a regular request
+STORAGE_RECOVERY_TIMEOUT = 300
+
+# number of threads of each librarian that execute the requests and the number
+# of requests the librarian takes from its queue at once. The requests on the
+# same stream are always executed by the same thread
+LIBRARIAN_WORKERS = 8
+LIBRARIAN_PREFETCH_COUNT = 64
+
+# number of connections used by the client to upload each file at once, and
+# number of messages in the input queue of a CSV parser at which the client
+# stops publishing until the parsers catch up
+UPLOAD_CONNECTIONS = 4
+UPLOAD_MAX_QUEUE_DEPTH = 100
+UPLOAD_QUEUE_POLL_INTERVAL = 0.2
+
 MAX_QUEUE_SIZE=5
 TIMEOUT=1
 
 NUMBER_OF_MONITOR_CONTAINERS = 3
 BULLY_TIMEOUT = 3
-CONTAINER_EXCEPTIONS = ['client_answers', 'client_questions']
\ No newline at end of file
+CONTAINER_EXCEPTIONS = ['client_answers', 'client_questions']
+# settings of the publisher used by the workers (see `middleware.BatchPublisher`).
+# Payloads smaller than PUBLISH_BATCH_BYTES sent to the same destination are
+# coalesced into a single message, which is published once it's full, after
+# PUBLISH_LINGER seconds or when the output is flushed. `consume_from` flushes
+# it before acknowledging each group of ACK_EVERY input messages, so in the
+# workers a batch holds at most the output of one group and the linger only
+# bounds how long that output waits while the group is being processed
+PUBLISH_BATCH_BYTES = 128 * 1024
+PUBLISH_LINGER = 0.05
+
+# max number of published messages waiting for a confirm from the broker
+PUBLISH_MAX_IN_FLIGHT = 512
+
+# memory used by the state of each stream in a join worker before moving it to
+# a SQLite database in JOIN_SPILL_DIR (see `pipeline.join.JoinStore`)
+JOIN_MEMORY_BYTES = 512 * 1024 * 1024
+JOIN_SPILL_DIR = './join_spill'
+
+# if set, the join workers sum the scores of the joined rows by year and tag and
+# send the partial sums every JOIN_COMBINER_FLUSH_ROWS joined rows (and at the
+# end of each stream) instead of sending the joined rows
+JOIN_COMBINER = False
+JOIN_COMBINER_FLUSH_ROWS = 50000
+
+# number of scores of distinct answer bodies cached by each worker of the
+# sentiment analysis stage, and number of new scores after which the cache is
+# stored (it's also stored at the end of each stream)
+SENTIMENT_CACHE_ENTRIES = 200000
+SENTIMENT_CACHE_PERSIST_EVERY = 5000
+
+# number of processes used by each worker of the sentiment analysis stage to
+# score the answers (0 scores them in the worker process), and how often the
+# worker services its connection while waiting for them
+SENTIMENT_PROCESSES = 4
+SENTIMENT_POLL_INTERVAL = 0.05
+
+# messages sent to these stages are compressed with zlib when they are at least
+# the given number of bytes, and are decompressed by the receiver according to
+# their content encoding. Stages not listed use DEFAULT_COMPRESS_MIN_BYTES
+# (None disables the compression)
+COMPRESSION_LEVEL = 1
+DEFAULT_COMPRESS_MIN_BYTES = None
+COMPRESS_MIN_BYTES = {
+    # CSV chunks sent by the client
+    'answers_csv_parser': 16 * 1024,
+    'questions_csv_parser': 16 * 1024,
+    # answer bodies
+    'filter_by_score': 16 * 1024,
+    'filter_by_sentiment_analysis': 16 * 1024,
+    # dump of the scores of every user at the end of the stream
+    'filter_top_10_by_score': 16 * 1024,
+}
+
+# number of unacknowledged messages each worker of a stage can receive from
+# the broker. Stages not listed use DEFAULT_PREFETCH_COUNT
+DEFAULT_PREFETCH_COUNT = 100
+PREFETCH_COUNT = {
+    # CSV chunks are large, so there is no need to buffer many of them
+    'answers_csv_parser': 4,
+    'questions_csv_parser': 4,
+    'filter_by_sentiment_analysis': 20,
+}
+
+# number of processed messages that are acknowledged together with a single
+# cumulative ack. Messages are also acknowledged when the worker runs out of
+# input. It can't be greater than the prefetch count of the stage
+DEFAULT_ACK_EVERY = 50
+ACK_EVERY = {
+    'answers_csv_parser': 2,
+    'questions_csv_parser': 2,
+    'filter_by_sentiment_analysis': 10,
+}
+
+# edges of the DAG that use the packed binary encoding instead of JSON (see
+# `serialization.PackedCodec`), by (sender stage, receiver stage). The data is
+# a list of rows with the given fields or, if `table` is set, a dict with the
+# list of rows in that key. Fields whose type ends with '?' may be None. With
+# `batch` set, the receiver gets the rows as a `serialization.RecordBatch`
+EDGE_SCHEMAS = {
+    ('answers_csv_parser', 'score_by_user'): {
+        'batch': True,
+        'table': 'answers',
+        'fields': {'OwnerUserId': 'str?', 'Score': 'int'},
+    },
+    ('questions_csv_parser', 'score_by_user'): {
+        'batch': True,
+        'table': 'questions',
+        'fields': {'OwnerUserId': 'str?', 'Score': 'int'},
+    },
+    ('answers_csv_parser', 'filter_by_score'): {
+        'batch': True,
+        'table': 'answers',
+        'fields': {'Body': 'str', 'Score': 'int?'},
+    },
+    ('answers_csv_parser', 'join'): {
+        'table': 'answers',
+        'fields': {'Id': 'int', 'ParentId': 'int', 'CreationDate': 'str', 'Score': 'int'},
+    },
+    ('questions_csv_parser', 'join'): {
+        'table': 'questions',
+        'fields': {'Id': 'int', 'Tags': 'str', 'Score': 'int', 'CreationDate': 'str'},
+    },
+    ('filter_by_score', 'filter_by_sentiment_analysis'): {
+        'batch': True,
+        'fields': {'Body': 'str', 'Score': 'int'},
+    },
+    # joined questions don't have a ParentId
+    ('join', 'score_by_tag_and_year'): {
+        'batch': True,
+        'fields': {'Id': 'int', 'ParentId': 'int?', 'Tags': 'str', 'Score': 'int', 'CreationDate': 'str'},
+    },
+}
@@ -3,7 +3,8 @@ This module contains logic for the nodes in the system to respond to liveness pr
 from the service that controls nodes.
 
 To start the server just call `start_server_in_new_thread` and pass the number of
-port where the service should listen.
+port where the service should listen. Other modules can add their own data to the
+status response with `register_status_provider`.
 """
 
 import json
@@ -12,6 +13,10 @@ import threading
 
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
+from typing import Callable, Dict
+
+# functions that return extra data to include in the status response, by key
+STATUS_PROVIDERS: Dict[str, Callable[[], dict]] = {}
 
 
 class RequestHandler(BaseHTTPRequestHandler):
@@ -25,6 +30,8 @@ class RequestHandler(BaseHTTPRequestHandler):
             return self._bad_request(msg='only /status allowed', status=404)
 
         data = {'status': 'ok'}
+        for key, provider in list(STATUS_PROVIDERS.items()):
+            data[key] = provider()
         self._send_json(data=data, status=200)
 
     def log_message(self, *args, **kw):
@@ -40,6 +47,13 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.wfile.write(json.dumps(data).encode('utf-8'))
 
 
+def register_status_provider(key:str, provider:Callable[[], dict]):
+    """Includes the result of calling `provider` in the status response under
+    the given `key`."""
+
+    STATUS_PROVIDERS[key] = provider
+
+
 def start_server(listen_port:int):
     """Creates and starts a server that responds to HTTP liveness probes.
     This function will block until the server is closed. Use
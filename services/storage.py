@@ -2,23 +2,17 @@
 This module interfaces with the distributed storage service.
 """
 from time import sleep
+from typing import List, Tuple
 from babel_library_client.borges import Borges
 from babel_library.commons import constants 
-import base64
+import service_config
+import struct
 
 storage_client = None
 
-def bytestoBase64(input):
-    try:
-        return base64.b64encode(input).decode('utf-8')
-    except Exception as err:
-        print(err, input)
-
-def base64toBytes(input):
-    try:
-        return base64.b64decode(input)
-    except Exception as err:
-        print(err, input)
+# each record appended to a log is prefixed by its length as a 4 bytes big
+# endian integer, so the log is just the concatenation of the framed records
+RECORD_LEN = struct.Struct('>I')
 
 def connect():
     """Opens a global connection to the service."""
@@ -26,25 +20,95 @@ def connect():
     storage_client = Borges()
 
 
-def set(id:str, key:str, value:bytes):
-    """Write or replace the value associated to `key`."""
-    payload = bytestoBase64(value)
-    storage_client.save(id, key, payload)
+def set(id:str, key:str, value:bytes, wait:bool = True):
+    """Write or replace the value associated to `key`.
+    If `wait` is false, the request is sent without waiting for the response
+    and a future is returned (see `gather`). The same applies to the rest of
+    the functions of this module."""
+    return storage_client.save(id, key, value, wait=wait)
 
 
-def read(id:str, key:str):
+def read(id:str, key:str, wait:bool = True):
     """Reads the value associated to the given `key` in the storage."""
-    res = storage_client.read(id, key)
+    return storage_client.read(id, key, wait=wait, parse=_parse_read)
+
 
+def _parse_read(res):
     if res["status"] != constants.OK_STATUS:
         return None
     else:
-        return base64toBytes(res["message"])
+        return res["message"]
+
+
+def append(id:str, stream:str, records:List[bytes], wait:bool = True):
+    """Appends the `records` at the end of the log `stream` with a single
+    request. The log is created if it doesn't exist."""
+
+    framed = b''.join(RECORD_LEN.pack(len(record)) + record for record in records)
+    return storage_client.append(id, stream, framed, wait=wait)
+
+
+def scan(id:str, stream:str, from_offset:int = 0) -> List[bytes]:
+    """Reads the log `stream` and returns its records starting from the byte
+    `from_offset`, which must be the start of a record (e.g. the size of the
+    records already read). The log is read in chunks of
+    `service_config.STORAGE_SCAN_CHUNK_BYTES`, each with its own request, so
+    a large log doesn't need to fit in a single response. Returns an empty
+    list if the log doesn't exist and raises if a read fails."""
+
+    records, pending, offset = [], b'', from_offset
+    chunk_bytes = service_config.STORAGE_SCAN_CHUNK_BYTES
+    while True:
+        res = storage_client.read(id, stream, offset=offset, length=chunk_bytes)
+        if res["status"] == constants.NOT_FOUND_STATUS and offset == from_offset:
+            return []
+        if res["status"] != constants.OK_STATUS:
+            raise Exception(f'could not read {stream} from offset {offset}: {res.get("message")}')
+
+        chunk = res["message"]
+        offset += len(chunk)
+
+        # the last record of the chunk may continue in the next one
+        complete, pending = _unframe_complete(pending + chunk)
+        records += complete
+
+        if len(chunk) < chunk_bytes:
+            break
+
+    if pending:
+        raise Exception(f'{stream} ends with a truncated record of {len(pending)} bytes')
+
+    return records
+
+
+def gather(*futures) -> list:
+    """Waits for the requests sent with `wait=False` and returns their results
+    in the same order. The requests are processed concurrently by the storage,
+    so this takes as long as the slowest one."""
+
+    return storage_client.gather(futures)
+
+
+def _unframe_complete(data:bytes) -> Tuple[List[bytes], bytes]:
+    """Splits a sequence of framed records. Returns the complete records and
+    the bytes of the last one if it's incomplete."""
+
+    records, offset = [], 0
+    while offset + RECORD_LEN.size <= len(data):
+        length, = RECORD_LEN.unpack_from(data, offset)
+        end = offset + RECORD_LEN.size + length
+        if end > len(data):
+            break
+
+        records.append(data[offset + RECORD_LEN.size:end])
+        offset = end
+
+    return records, data[offset:]
 
 
-def delete(id:str, key:str):
+def delete(id:str, key:str, wait:bool = True):
     """Deletes the key and value from the storage."""
-    storage_client.delete(id, key)
+    return storage_client.delete(id, key, wait=wait)
 
 def lock(id, key):
     for _ in range(0,5):
@@ -0,0 +1,139 @@
+import os
+import random
+import types
+
+from collections import Counter, deque
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'join')
+
+import pika
+import middleware
+import service_config
+
+
+STAGE = 'filter_by_score'
+REPLICAS = 4
+STREAMS = 25
+
+
+class Broker:
+    """In-memory queues routed like the ones declared by `setup_communication`
+    for a stage that is not sharded."""
+
+    def __init__(self):
+        self.queues = {STAGE: deque()}
+        for i in range(REPLICAS):
+            self.queues[middleware._control_queue_name(worker=STAGE, worker_id=i)] = deque()
+        self.tags = 0
+
+    def route(self, exchange, routing_key, body, properties):
+        if exchange == middleware.CONTROL_EXCHANGE:
+            worker, _, worker_id = routing_key.rpartition('_')
+            queue = middleware._control_queue_name(worker=worker, worker_id=worker_id)
+        else:
+            assert exchange == '', exchange
+            queue = routing_key
+        self.queues[queue].append((body, properties))
+
+
+class Publisher:
+    """Publishes straight to the broker, which confirms every message at once."""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, exchange, routing_key, body, properties):
+        self.broker.route(exchange, routing_key, body, properties)
+
+    def flush(self):
+        pass
+
+    def wait_for_confirms(self):
+        pass
+
+
+class Connection:
+    """Delivers a single message of the queues consumed by the channel each
+    time the events are processed, so the replicas take turns on the shared
+    queue."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.consumers = {}
+
+    def pending(self):
+        return any(self.broker.queues[queue] for queue in self.consumers)
+
+    def process_data_events(self, time_limit=None):
+        queues = [queue for queue in self.consumers if self.broker.queues[queue]]
+        if not queues:
+            return
+
+        queue = random.choice(queues)
+        body, properties = self.broker.queues[queue].popleft()
+        self.broker.tags += 1
+        method = types.SimpleNamespace(delivery_tag=self.broker.tags)
+        self.consumers[queue](None, method, properties, body)
+
+
+class Channel:
+    def __init__(self, broker):
+        self.connection = Connection(broker)
+        self.acked = []
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.connection.consumers[queue] = on_message_callback
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append(delivery_tag)
+
+
+def test_each_done_is_forwarded_once(monkeypatch):
+    random.seed(1)
+    monkeypatch.setitem(service_config.WORKERS, STAGE, REPLICAS)
+
+    broker = Broker()
+    sender = Channel(broker)
+    replicas = [Channel(broker) for _ in range(REPLICAS)]
+    for channel in [sender] + replicas:
+        monkeypatch.setitem(middleware.PUBLISHERS, channel.connection, Publisher(broker))
+
+    for stream in range(STREAMS):
+        middleware.send_done(channel=sender, worker=STAGE, correlation_id=f'stream_{stream}')
+
+    inputs = [
+        middleware._InputQueues(channel=channel, queue_name=STAGE, control_queue=middleware._control_queue_name(worker=STAGE, worker_id=i))
+        for i, channel in enumerate(replicas)
+    ]
+    deliveries = [queues.consume(on_idle=lambda: None) for queues in inputs]
+
+    forwarded, received = Counter(), Counter()
+    while any(channel.connection.pending() or queues.deliveries for channel, queues in zip(replicas, inputs)):
+        i = random.choice([
+            i for i, (channel, queues) in enumerate(zip(replicas, inputs))
+            if channel.connection.pending() or queues.deliveries
+        ])
+        monkeypatch.setattr(middleware, 'WORKER_ID', str(i))
+
+        method, properties, body, is_control = next(deliveries[i])
+        assert is_control or middleware._is_done_message(properties)
+
+        m = middleware.DONE_RE.match(body.decode('utf-8'))
+        key = (properties.correlation_id, m.group(2))
+        if middleware._forward_foreign_done(channel=replicas[i], worker_name=STAGE, method_frame=method, m=m, body=body, correlation_id=properties.correlation_id, is_control=is_control):
+            forwarded[key] += 1
+            assert method.delivery_tag in replicas[i].acked
+        else:
+            # only the worker the DONE is meant for keeps it
+            assert m.group(2) == str(i)
+            received[key] += 1
+
+    expected = {(f'stream_{stream}', str(i)) for stream in range(STREAMS) for i in range(REPLICAS)}
+    assert set(received) == expected
+    assert all(count == 1 for count in received.values())
+
+    # the DONE messages taken by another replica take two hops: the shared
+    # queue and the control queue of the target, which never forwards them again
+    assert forwarded
+    assert all(count == 1 for count in forwarded.values())
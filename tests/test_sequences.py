@@ -0,0 +1,102 @@
+import os
+import random
+import types
+
+from collections import defaultdict
+
+os.environ.setdefault('WORKER_ID', '0')
+os.environ.setdefault('WORKER_TASK', 'join')
+
+import pytest
+import middleware
+
+
+class RecordingPublisher:
+    """Keeps the payloads sent instead of publishing them."""
+
+    def __init__(self):
+        self.sent = defaultdict(list)
+
+    def send(self, data, exchange, routing_key, correlation_id, sequence=None, content_type=None):
+        self.sent[exchange, routing_key].append((data, sequence))
+
+
+@pytest.fixture
+def channel():
+    channel = types.SimpleNamespace(connection=object())
+    publisher = RecordingPublisher()
+    middleware.PUBLISHERS[channel.connection] = publisher
+    middleware.SEQUENCES.clear()
+    yield channel, publisher
+    middleware.PUBLISHERS.pop(channel.connection)
+
+
+def _receive(payloads, correlation_id='1234'):
+    """Registers the payloads received by a queue, returning the ones that
+    are new and the sequences of each sender."""
+
+    seen = defaultdict(dict)
+    new = [
+        (data, sequence) for data, sequence in payloads
+        if middleware._is_new_payload(seen_set=seen, correlation_id=correlation_id, sender=sequence[0], seq=sequence[1])
+    ]
+    return new, seen[correlation_id]
+
+
+def test_stateful_sharded_output_is_numbered_without_gaps(channel, monkeypatch):
+    channel, publisher = channel
+    monkeypatch.setattr(middleware, 'STORAGE_ID', 'join_0')
+
+    for i in range(1000):
+        middleware.send_data(b'rows %d' % i, channel=channel, worker='score_by_tag_and_year', correlation_id='1234', shard_key=i)
+        middleware.send_data(b'tags %d' % i, channel=channel, worker='top_10_tags', correlation_id='1234', shard_key=middleware.USE_HASH)
+
+    for queue, payloads in publisher.sent.items():
+        # redelivers some of them out of order
+        payloads = payloads + random.Random(0).sample(payloads, 50)
+        new, senders = _receive(payloads)
+
+        assert len(new) == len(publisher.sent[queue])
+        assert senders['join_0'].ahead == set()
+        assert senders['join_0'].received_below == len(publisher.sent[queue])
+
+
+def test_stateless_output_completes_every_queue(channel, monkeypatch):
+    channel, publisher = channel
+    monkeypatch.setattr(middleware, 'WORKER_TASK', 'answers_csv_parser')
+
+    inputs = 300
+    for seq in range(inputs):
+        with middleware.output_of(channel, ('1234', 'client_answers_0', seq)):
+            middleware.send_data(b'users %d' % seq, channel=channel, worker='score_by_user', correlation_id='1234', shard_key=middleware.USE_HASH)
+            middleware.send_data(b'answers %d' % seq, channel=channel, worker='filter_by_score', correlation_id='1234')
+            if seq % 3:
+                middleware.send_data(b'join %d' % seq, channel=channel, worker='join', correlation_id='1234', shard_key=seq)
+
+    assert set(publisher.sent) == set(middleware._output_queues('answers_csv_parser'))
+
+    sender = 'answers_csv_parser<client_answers_0'
+    for queue, payloads in publisher.sent.items():
+        new, senders = _receive(payloads)
+
+        assert len(new) == inputs
+        assert set(senders) == {sender}
+        assert senders[sender].ahead == set()
+        assert senders[sender].received_below == inputs
+
+    # the payloads sent again by another replica after a crash are discarded
+    for queue, payloads in publisher.sent.items():
+        new, _ = _receive(payloads + payloads[100:110])
+        assert len(new) == inputs
+
+    assert sum(1 for data, _ in publisher.sent['join', '0'] if data) == inputs // 3
+
+
+def test_stateless_output_sends_one_payload_per_queue(channel, monkeypatch):
+    channel, _ = channel
+    monkeypatch.setattr(middleware, 'WORKER_TASK', 'answers_csv_parser')
+
+    with pytest.raises(AssertionError):
+        with middleware.output_of(channel, ('1234', 'client_answers_0', 0)):
+            middleware.send_data(b'answers', channel=channel, worker='filter_by_score', correlation_id='1234')
+            middleware.send_data(b'answers', channel=channel, worker='filter_by_score', correlation_id='1234')